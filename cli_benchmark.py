@@ -1,6 +1,7 @@
 from lib.scene.VolumetricScene import VolumetricScene
 from lib.simulation import Simulation
-from lib.parameters import SimulationParameters
+from lib.simulation_backend import BACKEND_OPENCL, BACKENDS
+from lib.parameters import PRECISION_DOUBLE, PRECISIONS, SimulationParameters
 from lib.impulse_generators import GaussianModulatedImpulseGenerator
 import time
 import argparse
@@ -12,6 +13,14 @@ cli_argument_parser.add_argument("-s", "--steps", default=2 ** 3, type=int)
 cli_argument_parser.add_argument(
     "-o", "--oversampling", default=16, type=float)
 cli_argument_parser.add_argument("-v", "--volume", default=50, type=float)
+cli_argument_parser.add_argument(
+    "--precision", default=PRECISION_DOUBLE, choices=PRECISIONS)
+cli_argument_parser.add_argument(
+    "--fused", default=False, action="store_true")
+cli_argument_parser.add_argument("--time-block", default=1, type=int)
+cli_argument_parser.add_argument(
+    "--backend", default=BACKEND_OPENCL, choices=BACKENDS)
+cli_argument_parser.add_argument("--slabs", default=1, type=int)
 
 arguments = cli_argument_parser.parse_args()
 print(arguments)
@@ -21,41 +30,58 @@ step_count = arguments.steps
 params = SimulationParameters()
 params.set_max_frequency(200)
 params.set_oversampling(arguments.oversampling)
+params.set_precision(arguments.precision)
 scene = VolumetricScene(params, arguments.volume)
 
 grid = scene.build()
 grid.select_source_locations([grid.source_set[0]])
-sim = Simulation(params, grid)
-sim.generator = GaussianModulatedImpulseGenerator(params.max_frequency)
-
-sim.print_statistics()
 
 iteration_count = iterations_per_step * step_count
 test_time = iteration_count * params.dt
-print('Setting up simulation...')
-print(
-    f'[Benchmark] iterations/step: {iterations_per_step}\tcount: {step_count}x')
-print(f'[Benchmark] iterations: {iteration_count}\ttime: {test_time}s')
-sim.step()
-
-print('Starting up simulation...')
-start = time.time()
-for i in range(step_count):
-  sim.step(iterations_per_step)
-  p = (i + 1) / step_count
-  print(f'{p:.1%} done')
-end = time.time()
-
-diff = end - start
-time_factor = diff / sim.time
-cell_count = grid.grid_size
-normalised_cells = cell_count / time_factor
-normalised_volume = arguments.volume / time_factor
-
-print(f'Elapsed: {diff}s IRL, {sim.time}s simulated.')
-print(f'Factor: {(time_factor)}x.')
-print(
-    f'Average: {(1000 * diff / step_count / iterations_per_step)}ms per step.')
-print(f'cells/s:\t{normalised_cells:0.1f}')
-print(f'm^3/s:\t{normalised_volume:0.4f}')
+
+
+def run_benchmark(slab_count: int) -> float:
+  """Run the benchmark iterations, returns the elapsed seconds"""
+  sim = Simulation(params, grid, fuse_analysis=arguments.fused,
+                   time_block=arguments.time_block, backend=arguments.backend, slab_count=slab_count)
+  sim.generator = GaussianModulatedImpulseGenerator(params.max_frequency)
+
+  sim.print_statistics()
+
+  print('Setting up simulation...')
+  print(
+      f'[Benchmark] iterations/step: {iterations_per_step}\tcount: {step_count}x\tslabs: {slab_count}')
+  print(f'[Benchmark] iterations: {iteration_count}\ttime: {test_time}s')
+  sim.step()
+
+  print('Starting up simulation...')
+  start = time.time()
+  for i in range(step_count):
+    sim.step(iterations_per_step)
+    p = (i + 1) / step_count
+    print(f'{p:.1%} done')
+  end = time.time()
+
+  diff = end - start
+  time_factor = diff / sim.time
+  cell_count = grid.grid_size
+  normalised_cells = cell_count / time_factor
+  normalised_volume = arguments.volume / time_factor
+
+  print(f'Elapsed: {diff}s IRL, {sim.time}s simulated.')
+  print(f'Factor: {(time_factor)}x.')
+  print(
+      f'Average: {(1000 * diff / step_count / iterations_per_step)}ms per step.')
+  print(f'cells/s:\t{normalised_cells:0.1f}')
+  print(f'm^3/s:\t{normalised_volume:0.4f}')
+  return diff
+
+
+elapsed = run_benchmark(arguments.slabs)
+if arguments.slabs > 1:
+  # strong scaling, the same grid on a single slab
+  single_elapsed = run_benchmark(1)
+  speedup = single_elapsed / elapsed
+  print(f'Speedup: {speedup:0.2f}x on {arguments.slabs} slabs.')
+  print(f'Scaling efficiency: {speedup / arguments.slabs:0.1%}')
 print('Ran simulation!')
@@ -0,0 +1,37 @@
+from lib.scene.scenes import SCENES, create_scene
+from lib.parameters import SimulationParameters
+import time
+import argparse
+
+cli_argument_parser = argparse.ArgumentParser()
+cli_argument_parser.add_argument(
+    "-o", "--oversampling", default=16, type=float)
+cli_argument_parser.add_argument("-f", "--frequency", default=200, type=float)
+cli_argument_parser.add_argument("-r", "--rebuilds", default=8, type=int)
+
+arguments = cli_argument_parser.parse_args()
+print(arguments)
+
+params = SimulationParameters()
+params.set_max_frequency(arguments.frequency)
+params.set_oversampling(arguments.oversampling)
+
+# compile the numba functions before timing
+warm_up_scene = create_scene("shoebox", params)
+warm_up_scene.build()
+warm_up_scene.rebuild()
+
+print('scene\tcells\tbuild (s)\trebuild (s)')
+for name, create in SCENES.items():
+  scene = create(params)
+  start = time.time()
+  grid = scene.build()
+  build_time = time.time() - start
+
+  # a sweep rebuilds the scene for every frequency band
+  start = time.time()
+  for _ in range(arguments.rebuilds):
+    scene.rebuild()
+  rebuild_time = (time.time() - start) / max(1, arguments.rebuilds)
+  print(
+      f'{name}\t{grid.grid_size}\t{build_time:.3f}\t{rebuild_time:.3f}')
@@ -1,32 +1,33 @@
 
 from lib.simulation import Simulation
+from lib.simulation_backend import BACKEND_OPENCL, BACKENDS, READBACK_NONE
 from lib.scene.scene import Scene
-from lib.scene.BedroomScene import BedroomScene
-from lib.scene.BellBoxScene import BellBoxScene
-from lib.scene.ConcertHallScene import ConcertHallScene
-from lib.scene.CuboidReferenceScene import CuboidReferenceScene
-from lib.scene.LShapedRoomScene import LShapedRoomScene
-from lib.scene.OfficeScene import OfficeScene
-from lib.scene.ShoeboxReferenceScene import ShoeboxReferenceScene
-from lib.scene.StudioRoomScene import StudioRoomScene
-from lib.scene.RealLifeRoomScene import RealLifeRoomScene
-
-from lib.parameters import SimulationParameters
+from lib.scene.scenes import SCENES, create_scene
+
+from lib.parameters import PRECISION_DOUBLE, PRECISIONS, SimulationParameters
 from lib.math.octaves import get_octaval_center_frequencies
 from lib.math.decibel_weightings import get_a_weighting
 from lib.impulse_generators import SimpleSinoidGenerator
-from lib.analysis.source_pairs import get_n_pairs_with_min_distance
-from lib.analysis.frequency_sweep import get_avg_dev, get_avg_spl, run_sweep_analysis
+from lib.analysis.source_pairs import iterate_n_pairs_with_min_distance
+from lib.analysis.sweep_output import SWEEP_OUTPUT_EXTENSION, SweepOutputWriter, load_sweep_output, read_sweep_csv
+from lib.analysis.frequency_sweep import get_avg_dev, run_sweep_analysis
+from lib.analysis.impulse_sweep import get_listener_spl, run_impulse_sweep
 import matplotlib.pyplot as plt
 
 import csv
+import itertools
+import json
 import math
 import logging
+import logging.handlers
+import multiprocessing
 import os
 import sys
 import argparse
+from typing import List, Tuple
 from datetime import datetime
 from time import time
+import numba
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
@@ -34,19 +35,35 @@ matplotlib.use('Agg')
 # TODO: combine with full sweep!
 
 cli_argument_parser = argparse.ArgumentParser()
-cli_argument_parser.add_argument("-s", "--scene", default="shoebox")
+cli_argument_parser.add_argument(
+    "-s", "--scene", default="shoebox", choices=list(SCENES))
 cli_argument_parser.add_argument("-t", "--time", default=0.3, type=float)
 cli_argument_parser.add_argument(
     "-o", "--oversampling", default=16, type=float)
 cli_argument_parser.add_argument("-f", "--frequency", default=200, type=float)
+cli_argument_parser.add_argument(
+    "--precision", default=PRECISION_DOUBLE, choices=PRECISIONS)
 cli_argument_parser.add_argument("-b", "--bands", default=24, type=float)
 cli_argument_parser.add_argument("-x", "--speakers", default=1, type=int)
+cli_argument_parser.add_argument(
+    "-p", "--parallel-bands", default=1, type=int)
 cli_argument_parser.add_argument("--distance", default=2.0, type=int)
+cli_argument_parser.add_argument("--stride", default=1, type=int)
+cli_argument_parser.add_argument(
+    "--impulse", default=False, action="store_true")
+cli_argument_parser.add_argument(
+    "--fused", default=False, action="store_true")
+cli_argument_parser.add_argument("--time-block", default=1, type=int)
+cli_argument_parser.add_argument(
+    "--backend", default=BACKEND_OPENCL, choices=BACKENDS)
+cli_argument_parser.add_argument("--slabs", default=1, type=int)
+cli_argument_parser.add_argument("-w", "--workers", default=1, type=int)
 cli_argument_parser.add_argument(
     "--novisuals", default=False, action="store_true")
 cli_argument_parser.add_argument(
     "--nologs", default=False, action="store_true")
 cli_argument_parser.add_argument("--nocsv", default=False, action="store_true")
+cli_argument_parser.add_argument("--resume", default=None, type=str)
 
 arguments = cli_argument_parser.parse_args()
 
@@ -56,56 +73,77 @@ MAX_FREQUENCY = arguments.frequency
 OVERSAMPLING = arguments.oversampling
 OCTAVE_BANDS = arguments.bands
 SPEAKERS = arguments.speakers
+PARALLEL_BANDS = arguments.parallel_bands
+USE_IMPULSE_SWEEP = arguments.impulse
+FUSE_ANALYSIS = arguments.fused
+TIME_BLOCK = arguments.time_block
+BACKEND = arguments.backend
+SLAB_COUNT = arguments.slabs
+WORKERS = arguments.workers
 MIN_DISTANCE_BETWEEN_SPEAKERS = arguments.distance
+# only every n-th valid source set is simulated
+SOURCE_STRIDE = max(1, arguments.stride)
 OUTPUT_VISUALS = not arguments.novisuals
 OUTPUT_FILE_LOGS = not arguments.nologs
 OUTPUT_CSV = not arguments.nocsv
+# output uid of an interrupted sweep, finished source sets are read from its csv
+RESUME_UID = arguments.resume
 LOG_LEVEL = logging.DEBUG
+# source sets between writes of the .npz output
+SWEEP_OUTPUT_INTERVAL = 32
 # -----
 
 print(arguments)
 
+if WORKERS > 1:
+  # with the tbb threading layer, the main process hangs on exit after a fork
+  numba.config.THREADING_LAYER = "workqueue"
+
+if RESUME_UID is not None and not OUTPUT_CSV:
+  raise ValueError("A sweep can only be resumed from its csv output")
+
 # ---- Simulation ----
 parameters = SimulationParameters()
 parameters.set_oversampling(OVERSAMPLING)
 parameters.set_max_frequency(MAX_FREQUENCY)
+parameters.set_precision(arguments.precision)
 # parameters.set_scheme(1.0, 1 / 4, 1 / 16)
 
 runtime_steps = int(SIMULATED_TIME / parameters.dt)
 testing_frequencies = get_octaval_center_frequencies(
     20, 200, fraction=OCTAVE_BANDS)
 
+if USE_IMPULSE_SWEEP:
+  # all bands share the material betas of the center frequency
+  parameters.set_signal_frequency(
+      math.sqrt(testing_frequencies[0] * testing_frequencies[-1]))
+
 # -- SELECT SCENE --
-scene: Scene = None
-if arguments.scene == "real-reference":
-  scene = RealLifeRoomScene(parameters, True)
-if arguments.scene == "real-scene":
-  scene = RealLifeRoomScene(parameters)
-if arguments.scene == "bedroom":
-  scene = BedroomScene(parameters)
-elif arguments.scene == "bellbox":
-  scene = BellBoxScene(parameters)
-elif arguments.scene == "concert":
-  scene = ConcertHallScene(parameters)
-elif arguments.scene == "shoebox":
-  scene = ShoeboxReferenceScene(parameters)
-elif arguments.scene == "lshape":
-  scene = LShapedRoomScene(parameters)
-elif arguments.scene == "cuboid":
-  scene = CuboidReferenceScene(parameters)
-elif arguments.scene == "office":
-  scene = OfficeScene(parameters)
-elif arguments.scene == "studio":
-  scene = StudioRoomScene(parameters)
+scene: Scene = create_scene(arguments.scene, parameters)
 
 grid = scene.build()
 # -----
 
-sim = Simulation(grid=grid, parameters=parameters)
-sim.print_statistics()
-analysis_key_index = sim.grid.analysis_keys["LEQ"]
-position_sets = get_n_pairs_with_min_distance(
-    grid.source_set, SPEAKERS, parameters.dx, MIN_DISTANCE_BETWEEN_SPEAKERS)
+PARALLEL_BANDS = max(1, min(PARALLEL_BANDS, testing_frequencies.size))
+if USE_IMPULSE_SWEEP:
+  # a single impulse response covers all bands
+  PARALLEL_BANDS = 1
+
+
+def create_simulation() -> Simulation:
+  simulation = Simulation(grid=grid, parameters=parameters,
+                          band_count=PARALLEL_BANDS, fuse_analysis=FUSE_ANALYSIS,
+                          time_block=TIME_BLOCK, backend=BACKEND, slab_count=SLAB_COUNT)
+  # the SPL is reduced on the device, the impulse sweep only uses the listener history
+  simulation.set_readback(READBACK_NONE)
+  return simulation
+
+
+# worker processes create their own simulation, the OpenCL context is not shared
+sim: Simulation = None
+if WORKERS <= 1:
+  sim = create_simulation()
+  sim.print_statistics()
 
 # ---- Logging ----
 file_dir = os.path.dirname(__file__)
@@ -114,7 +152,7 @@ log.setLevel(LOG_LEVEL)
 logFormatter = logging.Formatter(
     "%(asctime)s [%(levelname)-5.5s] - %(message)s")
 
-output_uid = f'{datetime.now().strftime("%Y-%m-%d %H_%M_%S")} {scene.__class__.__name__} [{SIMULATED_TIME*1000:.0f}ms-{MAX_FREQUENCY}f-{OVERSAMPLING}o-{OCTAVE_BANDS}b-{SPEAKERS}x]'
+output_uid = RESUME_UID if RESUME_UID is not None else f'{datetime.now().strftime("%Y-%m-%d %H_%M_%S")} {scene.__class__.__name__} [{SIMULATED_TIME*1000:.0f}ms-{MAX_FREQUENCY}f-{OVERSAMPLING}o-{OCTAVE_BANDS}b-{SPEAKERS}x]'
 
 if OUTPUT_FILE_LOGS:
   fileHandler = logging.FileHandler(
@@ -127,18 +165,52 @@ consoleHandler.setFormatter(logFormatter)
 log.addHandler(consoleHandler)
 
 log.info('---- Statring simulation ----')
-log.info('%d pair(s)', len(position_sets))
+log.info('%d source location(s), %d speaker(s), every %d. set',
+         len(grid.source_set), SPEAKERS, SOURCE_STRIDE)
 log.info('%d steps per sim', runtime_steps)
 log.info('%d frequencies', testing_frequencies.size)
+if USE_IMPULSE_SWEEP:
+  log.info('Impulse response sweep, betas at %.2fhz',
+           parameters.signal_frequency)
+  if scene.has_frequency_dependent_betas(testing_frequencies):
+    log.warning('%s has frequency dependent materials, every band uses the betas at %.2fhz',
+                scene.__class__.__name__, parameters.signal_frequency)
+else:
+  log.info('%d frequencies per simulation pass', PARALLEL_BANDS)
+log.info('%d worker process(es)', max(1, WORKERS))
 log.info('Scene: %s', scene.__class__.__name__)
 log.info('-----------------------------')
 # ----- Simulation end -----
 
 # ---- CSV ----
+def read_completed_rows(path: str, header_row: List[str]) -> List[List[str]]:
+  """Get the complete rows of the csv of an earlier run, without the header. A csv with other bands or speakers is refused."""
+  if not os.path.exists(path):
+    raise FileNotFoundError(f"Cannot resume, there is no output at {path}")
+  with open(path, 'r', encoding="utf-8", newline='') as file:
+    rows = list(csv.reader(file))
+  if len(rows) == 0 or rows[0] != header_row:
+    raise ValueError(
+        f"Cannot resume, the bands or speakers of {path} differ from the arguments")
+  return [row for row in rows[1:] if len(row) == len(header_row)]
+
+
+def check_resume_metadata(path: str, metadata: dict) -> None:
+  """Refuse to resume a sweep of other arguments, the source set indices would not match"""
+  if not os.path.exists(path):
+    raise FileNotFoundError(
+        f"Cannot resume, there is no {path} to check the arguments against")
+  stored = load_sweep_output(path).metadata
+  # compared after a json round trip, like the metadata was stored
+  different = [key for key, value in json.loads(json.dumps(metadata)).items()
+               if stored.get(key) != value]
+  if len(different) > 0:
+    raise ValueError(
+        f"Cannot resume, the arguments {', '.join(different)} differ from the earlier run")
+
+
 if OUTPUT_CSV:
   csv_path = os.path.join(file_dir, "output", f"{output_uid}.csv")
-  csv_file = open(csv_path, 'w', encoding="utf-8", newline='')
-  writer = csv.writer(csv_file)
 
   header_row = [
       "Time",
@@ -162,8 +234,46 @@ if OUTPUT_CSV:
       *map(lambda x: f'{x:.2f}', testing_frequencies.tolist())
   ]
 
-  writer.writerow(header_row)
-  csv_file.flush()
+  # everything needed to rebuild the scene and the source sets
+  sweep_metadata = {
+      "scene": arguments.scene,
+      "scene_type": scene.__class__.__name__,
+      "time": SIMULATED_TIME,
+      "max_frequency": MAX_FREQUENCY,
+      "oversampling": OVERSAMPLING,
+      "precision": arguments.precision,
+      "bands": OCTAVE_BANDS,
+      "speakers": SPEAKERS,
+      "distance": MIN_DISTANCE_BETWEEN_SPEAKERS,
+      "stride": SOURCE_STRIDE,
+      "impulse": USE_IMPULSE_SWEEP,
+      "dx": parameters.dx,
+  }
+  sweep_output_path = os.path.join(
+      file_dir, "output", f"{output_uid}{SWEEP_OUTPUT_EXTENSION}")
+
+  completed_rows = []
+  if RESUME_UID is not None:
+    completed_rows = read_completed_rows(csv_path, header_row)
+    check_resume_metadata(sweep_output_path, sweep_metadata)
+
+  # rewriting the completed rows drops a row cut off by an interrupted write,
+  # it is replaced at once so a crash while rewriting keeps the earlier csv
+  temporary_csv_path = csv_path + ".tmp"
+  with open(temporary_csv_path, 'w', encoding="utf-8", newline='') as temporary_csv_file:
+    temporary_writer = csv.writer(temporary_csv_file)
+    temporary_writer.writerow(header_row)
+    temporary_writer.writerows(completed_rows)
+  os.replace(temporary_csv_path, csv_path)
+  csv_file = open(csv_path, 'a', encoding="utf-8", newline='')
+  writer = csv.writer(csv_file)
+
+  # the same rows as columns, saved right away so a resume can check the arguments
+  sweep_output = SweepOutputWriter(
+      sweep_output_path, testing_frequencies, SPEAKERS, sweep_metadata)
+  if RESUME_UID is not None:
+    sweep_output.extend(read_sweep_csv(csv_path))
+  sweep_output.save()
 
 # state
 spl_values_per_source = []
@@ -172,6 +282,21 @@ min_spl_values_per_source = []
 sources_covered = []
 deviations = []
 
+if RESUME_UID is not None:
+  deviation_column = header_row.index("Deviation")
+  for row in completed_rows:
+    sources_covered.append(int(row[1]))
+    deviations.append(float(row[deviation_column]))
+  log.info('Resuming %s, %d source sets done',
+           output_uid, len(sources_covered))
+completed_indices = set(sources_covered)
+
+# the source sets are generated while the sweep runs, the index of a set is stable for the same arguments
+position_sets = iterate_n_pairs_with_min_distance(
+    grid.source_set, SPEAKERS, parameters.dx, MIN_DISTANCE_BETWEEN_SPEAKERS, SOURCE_STRIDE)
+pending_sets = ((index, source_set) for index, source_set in enumerate(position_sets)
+                if index not in completed_indices)
+
 # ---- Chart & Axis ----
 # get and set style
 plt.style.use(os.path.join(file_dir, './styles/poster.mplstyle'))
@@ -216,41 +341,72 @@ for (modal_frequency, axis_type) in room_modes:
   axis_best_spl.axvline(modal_frequency, linestyle='--', color='k', alpha=0.5)
 
 
-def run_source_analysis_iteration(source_index: int) -> bool:
-  global min_dev, max_dev
-  source_set = position_sets[source_index]
+def init_sweep_worker(log_queue) -> None:
+  """Every worker process keeps one simulation for all its source sets, the scene and grid are copied on fork"""
+  global sim
+  # the inherited handlers are not shared safely, the parent writes the records of all workers
+  for handler in list(log.handlers):
+    log.removeHandler(handler)
+  log.addHandler(logging.handlers.QueueHandler(log_queue))
+  sim = create_simulation()
+
+
+def simulate_source_set(indexed_source_set: Tuple[int, np.ndarray]) -> Tuple[int, np.ndarray, List[float], List[float], List[float]]:
+  """Get the (average, max, min) SPL per testing frequency for a source set, along with the index and set"""
+  source_index, source_set = indexed_source_set
   sim.grid.select_source_locations(source_set)
   spl_values = []
   max_spl_values = []
   min_spl_values = []
-  frequencies_covered = []
-  sources_covered.append(source_index)
 
-  start = time()
   log.info(
-      f'Picked source set {source_index + 1}/{len(position_sets)} with positions:')
+      f'Picked source set {source_index + 1} with positions:')
 
   for pos in source_set:
     log.info('%d, %d, %d', *pos)
 
-  for (index,), frequency in np.ndenumerate(testing_frequencies):
-    parameters.set_signal_frequency(frequency)
-    frequencies_covered.append(frequency)
-    sim.generator = SimpleSinoidGenerator(parameters.signal_frequency)
-    scene.rebuild()
-    sim.reset()
+  if USE_IMPULSE_SWEEP:
     sim.sync_read_buffers()
-    # run single simulation
-    sim.step(runtime_steps)
-    avg_spl, min_spl, max_spl = get_avg_spl(
-        grid.analysis, grid.geometry, analysis_key_index)
-    # a_weighting = get_a_weighting(frequency)
-    # a_spl = avg_spl + a_weighting
-    a_spl = avg_spl
-    max_spl_values.append(max_spl)
-    min_spl_values.append(min_spl)
-    spl_values.append(a_spl)
-    log.info(f'[{source_index}] {frequency:.2f}hz: {a_spl:.2f} SPL (dB)')
+    band_leq = run_impulse_sweep(sim, testing_frequencies, runtime_steps)
+    band_spl = get_listener_spl(band_leq)
+    for (index,), frequency in np.ndenumerate(testing_frequencies):
+      avg_spl, min_spl, max_spl = band_spl[index]
+      max_spl_values.append(max_spl)
+      min_spl_values.append(min_spl)
+      spl_values.append(avg_spl)
+      log.info(f'[{source_index}] {frequency:.2f}hz: {avg_spl:.2f} SPL (dB)')
+  else:
+    # simulate PARALLEL_BANDS frequencies per pass
+    for batch_start in range(0, testing_frequencies.size, PARALLEL_BANDS):
+      batch = testing_frequencies[batch_start:batch_start + PARALLEL_BANDS]
+      for band, frequency in enumerate(batch):
+        parameters.set_signal_frequency(frequency)
+        scene.rebuild()
+        sim.set_band(band, SimpleSinoidGenerator(parameters.signal_frequency))
+      # unused bands of the last batch stay silent
+      for band in range(batch.size, PARALLEL_BANDS):
+        sim.set_band(band, None)
+      sim.reset()
+      sim.sync_read_buffers()
+      # run single simulation
+      sim.step(runtime_steps)
+      band_spl = sim.get_listener_statistics("LEQ")
+      for band, frequency in enumerate(batch):
+        avg_spl, min_spl, max_spl = band_spl[band]
+        # a_weighting = get_a_weighting(frequency)
+        # a_spl = avg_spl + a_weighting
+        a_spl = avg_spl
+        max_spl_values.append(max_spl)
+        min_spl_values.append(min_spl)
+        spl_values.append(a_spl)
+        log.info(f'[{source_index}] {frequency:.2f}hz: {a_spl:.2f} SPL (dB)')
+  return source_index, source_set, spl_values, max_spl_values, min_spl_values
+
+
+def run_source_analysis_iteration(source_index: int, source_set: np.ndarray, spl_values: List[float], max_spl_values: List[float], min_spl_values: List[float], start: float) -> bool:
+  global min_dev, max_dev
+  sources_covered.append(source_index)
+
   derrivative2 = np.diff(spl_values, n=1)
   deviation = np.sum(np.power(derrivative2, 2))
   avg_spl = np.average(spl_values)
@@ -296,28 +452,59 @@ def run_source_analysis_iteration(source_index: int) -> bool:
     ]
     writer.writerow(csv_row)
     csv_file.flush()
+    sweep_output.add(source_index, csv_row[0], source_set, deviation, spl_values)
+    # the csv is the complete record, the columnar output is rewritten now and then
+    if len(sources_covered) % SWEEP_OUTPUT_INTERVAL == 0:
+      sweep_output.save()
   # report timing
   end = time()
   diff = end - start
   timings.append(diff)
   avg_timing = np.average(timings)
-  indexes_left = len(position_sets) - source_index - 1
-  time_left = indexes_left * avg_timing
-  hours = math.floor(time_left / 60 / 60)
-  minutes = math.floor((time_left - hours * 60 * 60) / 60)
-  seconds = time_left - hours * 60 * 60 - minutes * 60
+  # the number of sets is unknown until the generator is done
   log.info(
-      f'Elapsed: {diff:.1f}s, est: {avg_timing:.1f}s/run = {hours:}h {minutes:.0f}m {seconds:.2f}s left')
+      f'Elapsed: {diff:.1f}s, est: {avg_timing:.1f}s/run, {len(sources_covered)} set(s) done')
 
   # done, signal next iteration
   log.info('----- End iteration %d -----', source_index)
   return False
 
 
+def iterate_pool_results(pool, source_sets):
+  """Hand the source sets to the workers in chunks, the pool would otherwise drain the whole generator up front"""
+  while True:
+    chunk = list(itertools.islice(source_sets, WORKERS * 4))
+    if len(chunk) == 0:
+      return
+    yield from pool.imap(simulate_source_set, chunk)
+
+
 start_time = time()
-for i in range(len(position_sets)):
-  run_source_analysis_iteration(i)
+if WORKERS <= 1:
+  results = map(simulate_source_set, pending_sets)
+else:
+  # fork, so the workers share the scene and grid
+  fork_context = multiprocessing.get_context("fork")
+  log_queue = fork_context.Queue()
+  log_listener = logging.handlers.QueueListener(
+      log_queue, *log.handlers, respect_handler_level=True)
+  log_listener.start()
+  pool = fork_context.Pool(
+      WORKERS, initializer=init_sweep_worker, initargs=(log_queue,))
+  results = iterate_pool_results(pool, pending_sets)
+
+# results arrive in index order
+iteration_start = time()
+for source_index, source_set, spl_values, max_spl_values, min_spl_values in results:
+  run_source_analysis_iteration(
+      source_index, source_set, spl_values, max_spl_values, min_spl_values, iteration_start)
   deviation_plot.set_data(sources_covered, deviations)
+  iteration_start = time()
+
+if WORKERS > 1:
+  pool.close()
+  pool.join()
+  log_listener.stop()
 
 end_time = time()
 diff = end_time - start_time
@@ -338,3 +525,4 @@ if OUTPUT_VISUALS:
 
 if OUTPUT_CSV:
   csv_file.close()
+  sweep_output.save()
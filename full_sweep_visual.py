@@ -11,6 +11,7 @@ import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
 from lib.analysis.frequency_sweep import get_avg_dev, get_avg_spl, run_sweep_analysis
+from lib.analysis.impulse_sweep import get_listener_spl, run_impulse_sweep
 from lib.analysis.source_pairs import get_n_pairs_with_min_distance
 from lib.impulse_generators import SimpleSinoidGenerator
 from lib.math.decibel_weightings import get_a_weighting
@@ -28,6 +29,7 @@ OCTAVE_BANDS = 6
 SPEAKERS = 1
 MIN_DISTANCE_BETWEEN_SPEAKERS = 2.0
 USE_REALTIME_VISUALS = False
+USE_IMPULSE_SWEEP = False
 OUTPUT_VISUALS = True
 OUTPUT_FILE_LOGS = True
 OUTPUT_CSV = True
@@ -45,6 +47,10 @@ testing_frequencies = get_octaval_center_frequencies(
 
 # -- SELECT SCENE --
 # scene = ShoeboxReferenceScene(parameters)
+if USE_IMPULSE_SWEEP:
+  # all bands share the material betas of the center frequency
+  parameters.set_signal_frequency(
+      math.sqrt(testing_frequencies[0] * testing_frequencies[-1]))
 scene = RealLifeRoomScene(parameters, False)
 grid = scene.build()
 # -----
@@ -192,7 +198,27 @@ def run_source_analysis_iteration(source_index: int) -> bool:
   for pos in source_set:
     log.info('%d, %d, %d', *pos)
 
+  if USE_IMPULSE_SWEEP:
+    sim.sync_read_buffers()
+    band_leq = run_impulse_sweep(sim, testing_frequencies, runtime_steps)
+    band_spl = get_listener_spl(band_leq)
+    # only listener cells have a value
+    impulse_analysis = np.full(grid.analysis_shape, np.nan)
+    flat_analysis = impulse_analysis.reshape(grid.analysis_values, -1)
+
   for (index,), frequency in np.ndenumerate(testing_frequencies):
+    if USE_IMPULSE_SWEEP:
+      frequencies_covered.append(frequency)
+      flat_analysis[analysis_key_index, grid.listener_indices] = band_leq[index]
+      run_sweep_analysis(impulse_analysis, sweep_sum, sweep_sum_sqr,
+                         sweep_deviation, sweep_ranking, analysis_key_index, index + 1)
+      avg_spl, min_spl, max_spl = band_spl[index]
+      max_spl_values.append(max_spl)
+      min_spl_values.append(min_spl)
+      spl_values.append(avg_spl)
+      log.info(f'[{source_index}] {frequency:.2f}hz: {avg_spl:.2f} SPL (dB)')
+      continue
+
     parameters.set_signal_frequency(frequency)
     frequencies_covered.append(frequency)
     sim.generator = SimpleSinoidGenerator(parameters.signal_frequency)
@@ -24,10 +24,10 @@ def run_sweep_analysis(step_analysis: np.ndarray, summation: np.ndarray, sum_sqr
   """Set neighbour flags for geometry"""
   _max = -1e99
   _min = 1e99
-  for w in prange(step_analysis.shape[0]):
-    for h in prange(step_analysis.shape[1]):
-      for d in prange(step_analysis.shape[2]):
-        spl_value = step_analysis[w, h, d, analysis_value]
+  for w in prange(step_analysis.shape[1]):
+    for h in prange(step_analysis.shape[2]):
+      for d in prange(step_analysis.shape[3]):
+        spl_value = step_analysis[analysis_value, w, h, d]
         if math.isnan(spl_value):
           deviation[w, h, d] = math.nan
           continue
@@ -41,9 +41,9 @@ def run_sweep_analysis(step_analysis: np.ndarray, summation: np.ndarray, sum_sqr
         deviation[w, h, d] = _dev
 
   _range = _max - _min
-  for w in prange(step_analysis.shape[0]):
-    for h in prange(step_analysis.shape[1]):
-      for d in prange(step_analysis.shape[2]):
+  for w in prange(step_analysis.shape[1]):
+    for h in prange(step_analysis.shape[2]):
+      for d in prange(step_analysis.shape[3]):
         standart_dev_leq = deviation[w, h, d]
         if math.isnan(standart_dev_leq):
           ranking[w, h, d] = 0
@@ -85,14 +85,14 @@ def get_avg_spl(analytical_values: np.ndarray, flags: np.ndarray, leq_index: int
   _min: float = 1e999
   _max: float = -1e999
 
-  for w in prange(analytical_values.shape[0]):
-    for h in prange(analytical_values.shape[1]):
-      for d in prange(analytical_values.shape[2]):
+  for w in prange(analytical_values.shape[1]):
+    for h in prange(analytical_values.shape[2]):
+      for d in prange(analytical_values.shape[3]):
         cell_flags = flags[w, h, d]
         if cell_flags & LISTENER_FLAG == 0:
           continue
 
-        v_l_eq: float = analytical_values[w, h, d, leq_index]
+        v_l_eq: float = analytical_values[leq_index, w, h, d]
         if math.isnan(v_l_eq):
           continue
         _sum += v_l_eq
@@ -0,0 +1,53 @@
+from typing import Dict, Iterable, List, Tuple
+
+
+class AnalysisMetric:
+  """A value the analysis kernel can keep for every cell"""
+
+  def __init__(self, key: str, requires: Tuple[str, ...] = (), is_decibel: bool = False):
+    self.key = key
+    # metrics that are computed from the value of other metrics
+    self.requires = requires
+    # decibel values are undefined (nan) inside walls and are only computed
+    # by finalize_analysis, right before the host reads the analysis values
+    self.is_decibel = is_decibel
+
+
+# all metrics supported by analysis_step, in storage order
+ANALYSIS_METRICS: Dict[str, AnalysisMetric] = {
+    metric.key: metric for metric in [
+        AnalysisMetric("PRESSURE"),
+        AnalysisMetric("RMS"),
+        AnalysisMetric("LEQ", requires=("RMS",), is_decibel=True),
+        AnalysisMetric("EWMA"),
+        AnalysisMetric("EWMA_L", requires=("EWMA",), is_decibel=True),
+    ]
+}
+
+DEFAULT_METRICS = ("RMS", "LEQ")
+
+
+def resolve_metrics(keys: Iterable[str]) -> List[str]:
+  """Get the enabled metrics including their requirements, in storage order"""
+  enabled = set()
+  pending = list(keys)
+  while len(pending) > 0:
+    key = pending.pop()
+    if key not in ANALYSIS_METRICS:
+      raise ValueError(
+          f"Unknown analysis metric {key}, use one of {list(ANALYSIS_METRICS)}")
+    if key in enabled:
+      continue
+    enabled.add(key)
+    pending.extend(ANALYSIS_METRICS[key].requires)
+  return [key for key in ANALYSIS_METRICS if key in enabled]
+
+
+def get_metric_build_options(analysis_keys: Dict[str, int]) -> List[str]:
+  """Kernel defines with the storage slot of every enabled metric"""
+  return [f'-D{key}_INDEX={index}' for key, index in analysis_keys.items()]
+
+
+def has_decibel_metrics(analysis_keys: Dict[str, int]) -> bool:
+  """Whether finalize_analysis has to run before reading back analysis values"""
+  return any(ANALYSIS_METRICS[key].is_decibel for key in analysis_keys)
@@ -1,35 +1,69 @@
-import itertools
 import math
-from typing import Tuple, List
-
-def get_n_pairs_with_min_distance(locations: List[Tuple[int, int, int]], n_count:int, spacing: float, min_space: float) -> List[List[Tuple[int, int, int]]]:
-  if n_count == 1:
-    return list(map(lambda x: [x], locations))
-  pairs:  List[List[Tuple[int, int, int]]] = []
-  combined = itertools.combinations(locations, n_count)
-  rel_dist = (min_space / spacing)
-  dist_check = rel_dist * rel_dist
-  combined_length = 0
-  
-  for combination in combined:
-    combined_length += 1
-    paired = itertools.combinations(combination, 2)
-    use = True
-    for pair in paired:
-      position1, position2 = pair
-      width_1, height_1, depth_1 = position1
-      width_2, height_2, depth_2 = position2
-      delta_width = width_2 - width_1
-      delta_height = height_2 - height_1
-      delta_depth = depth_2 - depth_1
-      dist = delta_width * delta_width + delta_height * delta_height + delta_depth * delta_depth
-      
-      if dist < dist_check:
-        use = False
-        break
-    if use:
-      pairs.append(combination)
-      
-  print(f'{len(locations)} -> {combined_length}/{len(pairs)}')
-  return pairs
-  
\ No newline at end of file
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+
+
+class LocationBuckets:
+  """Spatial index of grid locations in cubic buckets of at least the minimum distance, so only neighbouring buckets have to be checked"""
+
+  def __init__(self, locations: np.ndarray, min_distance: float) -> None:
+    self.locations = locations
+    self.min_distance_squared = min_distance * min_distance
+    self.bucket_size = max(1, math.ceil(min_distance))
+    keys = locations // self.bucket_size
+    self.buckets: Dict[Tuple[int, int, int], np.ndarray] = {}
+    for index, key in enumerate(map(tuple, keys.tolist())):
+      self.buckets.setdefault(key, []).append(index)
+    self.buckets = {key: np.array(indices, dtype="int64")
+                    for key, indices in self.buckets.items()}
+
+  def get_close_indices(self, index: int) -> np.ndarray:
+    """Indices of all locations closer than the minimum distance to a location, including itself"""
+    if self.min_distance_squared <= 0.0:
+      return np.zeros(shape=(0,), dtype="int64")
+    location = self.locations[index]
+    (w, h, d) = (location // self.bucket_size).tolist()
+    candidates = [self.buckets[key] for key in (
+        (w + o_w, h + o_h, d + o_d) for o_w in (-1, 0, 1) for o_h in (-1, 0, 1) for o_d in (-1, 0, 1))
+        if key in self.buckets]
+    candidates = np.concatenate(candidates)
+    delta = self.locations[candidates] - location
+    distance = np.einsum("ij,ij->i", delta, delta)
+    return candidates[distance < self.min_distance_squared]
+
+
+def iterate_valid_combinations(buckets: LocationBuckets, n_count: int, chosen: List[int], candidates: np.ndarray, is_close: np.ndarray) -> Iterator[List[int]]:
+  """Depth first over the candidates, the sorted locations that are not close to any chosen location, in the order of itertools.combinations"""
+  if len(chosen) == n_count - 1:
+    for index in candidates.tolist():
+      yield chosen + [index]
+    return
+
+  for position, index in enumerate(candidates.tolist()):
+    # narrow the later candidates with the shared mask, it is cleared again before going deeper
+    close_indices = buckets.get_close_indices(index)
+    is_close[close_indices] = True
+    remaining = candidates[position + 1:]
+    remaining = remaining[~is_close[remaining]]
+    is_close[close_indices] = False
+    yield from iterate_valid_combinations(buckets, n_count, chosen + [index], remaining, is_close)
+
+
+def iterate_n_pairs_with_min_distance(locations: np.ndarray, n_count: int, spacing: float, min_space: float, stride: int = 1) -> Iterator[np.ndarray]:
+  """Lazily get the (n_count, 3) sets of locations that are at least min_space apart, in the order of itertools.combinations. Only every stride-th set is returned."""
+  locations = np.asarray(locations, dtype="int32").reshape(-1, 3)
+  buckets = LocationBuckets(locations.astype("int64"), min_space / spacing)
+  candidates = np.arange(locations.shape[0], dtype="int64")
+  is_close = np.zeros(shape=(locations.shape[0],), dtype="bool")
+  for count, combination in enumerate(iterate_valid_combinations(buckets, n_count, [], candidates, is_close)):
+    if count % stride == 0:
+      yield locations[combination]
+
+
+def get_n_pairs_with_min_distance(locations: np.ndarray, n_count: int, spacing: float, min_space: float, stride: int = 1) -> np.ndarray:
+  """Get all sets of n_count locations that are at least min_space apart, as an (sets, n_count, 3) array"""
+  pairs = list(iterate_n_pairs_with_min_distance(
+      locations, n_count, spacing, min_space, stride))
+  print(f'{len(locations)} -> {len(pairs)}')
+  return np.array(pairs, dtype="int32").reshape(-1, n_count, 3)
@@ -0,0 +1,108 @@
+import csv
+import json
+import os
+from typing import Dict, List
+
+import numpy as np
+
+# the columnar output is written next to the csv of a sweep
+SWEEP_OUTPUT_EXTENSION = ".npz"
+
+
+class SweepOutput:
+  """Results of a source sweep as columns, one row per simulated source set"""
+
+  def __init__(self, frequencies: np.ndarray, indices: np.ndarray, times: np.ndarray, positions: np.ndarray, deviations: np.ndarray, spl: np.ndarray, metadata: Dict) -> None:
+    self.frequencies = frequencies
+    self.indices = indices
+    self.times = times
+    # (sets, speakers, 3) grid indices
+    self.positions = positions
+    self.deviations = deviations
+    # (sets, frequencies) average SPL in dB
+    self.spl = spl
+    # scene and parameters of the sweep, empty for outputs read from a csv
+    self.metadata = metadata
+
+  @property
+  def speaker_count(self) -> int:
+    return self.positions.shape[1]
+
+
+class SweepOutputWriter:
+  """Collects the rows of a sweep and writes them as a single .npz"""
+
+  def __init__(self, path: str, frequencies: np.ndarray, speaker_count: int, metadata: Dict) -> None:
+    self.path = path
+    self.frequencies = np.asarray(frequencies, dtype="float64")
+    self.speaker_count = speaker_count
+    self.metadata = metadata
+    self.indices: List[int] = []
+    self.times: List[float] = []
+    self.positions: List[np.ndarray] = []
+    self.deviations: List[float] = []
+    self.spl: List[np.ndarray] = []
+
+  def add(self, index: int, time: float, source_set: np.ndarray, deviation: float, spl_values: List[float]) -> None:
+    self.indices.append(index)
+    self.times.append(time)
+    self.positions.append(np.asarray(source_set, dtype="int32"))
+    self.deviations.append(deviation)
+    self.spl.append(np.asarray(spl_values, dtype="float64"))
+
+  def extend(self, output: SweepOutput) -> None:
+    """Add the rows of an earlier run, for a resumed sweep"""
+    for row in range(output.indices.size):
+      self.add(int(output.indices[row]), float(output.times[row]), output.positions[row],
+               float(output.deviations[row]), output.spl[row])
+
+  def save(self) -> None:
+    # written to a temporary file first, an interrupted save keeps the last output
+    temporary_path = self.path + ".tmp" + SWEEP_OUTPUT_EXTENSION
+    np.savez(
+        temporary_path,
+        frequencies=self.frequencies,
+        indices=np.array(self.indices, dtype="int64"),
+        times=np.array(self.times, dtype="float64"),
+        positions=np.array(self.positions, dtype="int32").reshape(
+            -1, self.speaker_count, 3),
+        deviations=np.array(self.deviations, dtype="float64"),
+        spl=np.array(self.spl, dtype="float64").reshape(
+            -1, self.frequencies.size),
+        metadata=np.array(json.dumps(self.metadata)),
+    )
+    os.replace(temporary_path, self.path)
+
+
+def load_sweep_output(path: str) -> SweepOutput:
+  with np.load(path) as file:
+    return SweepOutput(
+        file["frequencies"], file["indices"], file["times"], file["positions"],
+        file["deviations"], file["spl"], json.loads(str(file["metadata"])))
+
+
+def read_sweep_csv(path: str) -> SweepOutput:
+  """Read the csv of a sweep as columns, incomplete rows are skipped"""
+  with open(path, 'r', encoding="utf-8", newline='') as file:
+    rows = list(csv.reader(file))
+  header = rows[0]
+  speaker_count = sum(1 for column in header
+                      if column.startswith("W") and column.endswith(" idx"))
+  band_start = header.index("Bands (SPL dB):") + 1
+  frequencies = np.array(header[band_start:], dtype="float64")
+
+  # a row cut off by an interrupted write has fewer columns, the band label column is empty and skipped
+  values = np.array([row[:band_start - 1] + row[band_start:] for row in rows[1:]
+                     if len(row) == len(header)], dtype="float64").reshape(-1, len(header) - 1)
+
+  # (Time, Index, speakers * (idx, m, idx, m, idx, m), Deviation, SPL, bands...)
+  position_columns = values[:, 2:2 + speaker_count * 6:2]
+  deviation_column = 2 + speaker_count * 6
+  return SweepOutput(
+      frequencies,
+      values[:, 1].astype("int64"),
+      values[:, 0],
+      position_columns.astype("int32").reshape(-1, speaker_count, 3),
+      values[:, deviation_column],
+      values[:, deviation_column + 2:],
+      {})
@@ -0,0 +1,230 @@
+import math
+import platform
+from typing import List
+
+import numpy as np
+from numba import njit, prange
+
+from lib.simulation_backend import READBACK_LISTENERS, SimulationBackend
+
+# equal to the values in accelerated_fdtd.cl
+USE_HYBRID_HARD_SOURCE = True
+ALPHA_TIMING = 0.01
+RMS_FACTOR = 25e8
+
+
+def get_neighbour_offsets(grid_shape) -> np.ndarray:
+  """Flat index offsets in the order of the neighbour flag bits"""
+  (_, height, depth) = grid_shape
+  w, h, d = height * depth, depth, 1
+  return np.array([
+      # D1 - 1x neighbours
+      -w, w, -h, h, -d, d,
+      # D2 - 2x neighbours
+      -w - h, -w + h, w + h, w - h,
+      -d - h, -d + h, d + h, d - h,
+      -w - d, -w + d, w + d, w - d,
+      # D3 - 3x neighbours
+      -w - h - d, -w - h + d, -w + h - d, -w + h + d,
+      w - h - d, w - h + d, w + h - d, w + h + d,
+  ], dtype="int64")
+
+
+@njit(parallel=True)
+def scheme_step(previous: np.ndarray, current: np.ndarray, next_: np.ndarray, betas: np.ndarray, geometry: np.ndarray, neighbours: np.ndarray, cells: np.ndarray, offsets: np.ndarray, lambda_courant: float, d1: float, d2: float, d3: float, d4: float, signals: np.ndarray) -> None:
+  """compact_schema_step for every band and the given (flat) cells"""
+  for band in range(current.shape[0]):
+    signal = signals[band]
+    for k in prange(cells.size):
+      i = cells[k]
+      neighbour_flag = neighbours[i]
+
+      k_neighbour_1 = 0
+      k_neighbour_2 = 0
+      k_neighbour_3 = 0
+      d1_sum = 0.0
+      d2_sum = 0.0
+      d3_sum = 0.0
+      for bit in range(26):
+        if neighbour_flag >> bit & 1 == 0:
+          continue
+        if bit < 6:
+          k_neighbour_1 += 1
+          if d1 != 0.0:
+            d1_sum += current[band, i + offsets[bit]]
+        elif bit < 18:
+          k_neighbour_2 += 1
+          if d2 != 0.0:
+            d2_sum += current[band, i + offsets[bit]]
+        else:
+          k_neighbour_3 += 1
+          if d3 != 0.0:
+            d3_sum += current[band, i + offsets[bit]]
+      total_neighbours = k_neighbour_1 + k_neighbour_2 + k_neighbour_3
+      has_k1_neighbours = d1 == 0.0 or k_neighbour_1 == 6
+      has_k2_neighbours = d2 == 0.0 or k_neighbour_2 == 12
+      has_k3_neighbours = d3 == 0.0 or k_neighbour_3 == 8
+
+      neighbour_factor = d4
+      beta_1_factor = 1.0
+      beta_2_factor = 1.0
+      if not has_k1_neighbours or not has_k2_neighbours or not has_k3_neighbours:
+        neighbour_factor = 2 - k_neighbour_1 * d1 - \
+            k_neighbour_2 * d2 - k_neighbour_3 * d3
+        beta_k = (26 - total_neighbours) * \
+            lambda_courant * betas[band, i] * 0.5
+        beta_2_factor = 1.0 - beta_k
+        beta_1_factor = 1.0 / (1 + beta_k)
+
+      stencil_sum = d1 * d1_sum + d2 * d2_sum + d3 * d3_sum
+      current_sum = neighbour_factor * current[band, i]
+      next_value = beta_1_factor * \
+          (stencil_sum + current_sum - beta_2_factor * previous[band, i])
+
+      is_source = geometry[i] >> 1 & 1
+      if is_source and not math.isnan(signal):
+        if USE_HYBRID_HARD_SOURCE:
+          next_value = signal
+        else:
+          next_value += signal
+
+      next_[band, i] = next_value
+
+
+@njit(parallel=True)
+def analysis_step(current: np.ndarray, analysis: np.ndarray, cells: np.ndarray, dt: float, time_elapsed: float, pressure_index: int, rms_index: int, ewma_index: int) -> None:
+  """analysis_step for every band and the given (flat) cells, disabled metrics have index -1"""
+  alpha = dt / ALPHA_TIMING
+  for band in range(current.shape[0]):
+    for k in prange(cells.size):
+      i = cells[k]
+      actual_pressure = current[band, i]
+      if pressure_index >= 0:
+        analysis[band, pressure_index, i] = actual_pressure
+
+      rms_addition = actual_pressure * actual_pressure * RMS_FACTOR
+      if rms_index >= 0:
+        analysis[band, rms_index, i] = analysis[band,
+                                                rms_index, i] + dt * rms_addition
+
+      if ewma_index >= 0 and time_elapsed > 0:
+        current_ewma = analysis[band, ewma_index, i]
+        analysis[band, ewma_index, i] = alpha * \
+            rms_addition + (1 - alpha) * current_ewma
+
+
+@njit(parallel=True)
+def finalize_analysis(analysis: np.ndarray, cells: np.ndarray, time_elapsed: float, rms_index: int, leq_index: int, ewma_index: int, ewma_l_index: int) -> None:
+  """finalize_analysis for every band and the given (flat) cells"""
+  if time_elapsed <= 0:
+    return
+  for band in range(analysis.shape[0]):
+    for k in prange(cells.size):
+      i = cells[k]
+      if leq_index >= 0:
+        rms_value = (1.0 / time_elapsed) * analysis[band, rms_index, i]
+        analysis[band, leq_index, i] = 10.0 * \
+            math.log10(rms_value) if rms_value > 0 else 0.0
+      if ewma_l_index >= 0:
+        ewma = analysis[band, ewma_index, i]
+        analysis[band, ewma_l_index, i] = 10.0 * \
+            math.log10(ewma) if ewma > 0 else 0.0
+
+
+class NumbaBackend(SimulationBackend):
+  """Runs the simulation on the cpu, directly on the band arrays of the simulation"""
+
+  def __init__(self, simulation) -> None:
+    super().__init__(simulation)
+    grid = simulation.grid
+    band_count = simulation.band_count
+    self.offsets = get_neighbour_offsets(grid.grid_shape)
+    self.metric_indices = {key: grid.analysis_keys.get(key, -1)
+                           for key in ["PRESSURE", "RMS", "LEQ", "EWMA", "EWMA_L"]}
+    self.listener_history: np.ndarray = None
+
+    # flat views, the values are never copied
+    self.geometry = grid.geometry.reshape(-1)
+    self.neighbours = grid.neighbours.reshape(-1)
+    self.betas = simulation.band_beta.reshape(band_count, -1)
+    self.analysis = simulation.band_analysis.reshape(
+        band_count, grid.analysis_values, -1)
+    self.pressure_arrays = [
+        simulation.band_pressure_previous.reshape(band_count, -1),
+        simulation.band_pressure.reshape(band_count, -1),
+        simulation.band_pressure_next.reshape(band_count, -1),
+    ]
+    self.output = self.pressure_arrays[1]
+    # (previous, current, next) pressure, rotated every iteration
+    self.state = list(self.pressure_arrays)
+
+  def get_name(self) -> str:
+    return f'numba ({platform.processor() or platform.machine()})'
+
+  def sync_read_buffers(self, beta_cells_only: bool = False) -> None:
+    # the kernels read the grid and band arrays directly
+    pass
+
+  def sync_pressure_buffers(self) -> None:
+    pass
+
+  def reset(self) -> None:
+    self.state = list(self.pressure_arrays)
+
+  def record_listeners(self, step_count: int) -> None:
+    sim = self.simulation
+    self.listener_history = np.zeros(
+        shape=(step_count, sim.band_count, sim.grid.listener_indices.size), dtype=sim.parameters.pressure_dtype)
+
+  def get_listener_history(self) -> np.ndarray:
+    return self.listener_history
+
+  def read_state(self) -> List[np.ndarray]:
+    return [values.reshape(self.simulation.band_pressure.shape).copy() for values in self.state]
+
+  def write_state(self, pressure: List[np.ndarray]) -> None:
+    for values, state in zip(pressure, self.pressure_arrays):
+      np.copyto(state, values.reshape(state.shape))
+    self.state = list(self.pressure_arrays)
+
+  def settle_state(self) -> None:
+    """Move the pressure the analysis saw last into band_pressure, like the OpenCL read back"""
+    previous, current, unused = self.state
+    if previous is self.output:
+      return
+    if unused is self.output:
+      np.copyto(unused, previous)
+      self.state = [unused, current, previous]
+      return
+    # band_pressure holds the latest values, keep those in the unused array
+    np.copyto(unused, current)
+    np.copyto(current, previous)
+    self.state = [current, unused, previous]
+
+  def step(self, times: np.ndarray, signals: np.ndarray) -> None:
+    sim = self.simulation
+    grid = sim.grid
+    params = sim.parameters
+    indices = self.metric_indices
+    dt = params.dt
+    listener_indices = grid.listener_indices
+
+    for i in range(times.size):
+      previous, current, next_ = self.state
+      analysis_step(current, self.analysis, grid.air_indices, dt, times[i],
+                    indices["PRESSURE"], indices["RMS"], indices["EWMA"])
+
+      record_row = sim.iteration + i - sim.record_start
+      if 0 <= record_row < sim.record_length:
+        self.listener_history[record_row] = current[:, listener_indices]
+
+      scheme_step(previous, current, next_, self.betas, self.geometry, self.neighbours, grid.air_indices, self.offsets,
+                  params.lambda_courant, params.arg_d1, params.arg_d2, params.arg_d3, params.arg_d4, signals[i])
+      self.state = [current, next_, previous]
+
+    finalize_analysis(self.analysis, grid.air_indices, times[-1], indices["RMS"],
+                      indices["LEQ"], indices["EWMA"], indices["EWMA_L"])
+    self.settle_state()
+    # the band arrays are the state, they are always up to date
+    if sim.readback == READBACK_LISTENERS:
+      self.gather_listener_values()
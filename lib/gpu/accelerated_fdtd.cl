@@ -1,4 +1,16 @@
+// REAL is the type of pressure values and scheme parameters, ACCUMULATOR the
+// type of the analysis values. Both are set with build options.
+#ifndef REAL
+#define REAL double
+#endif
+
+#ifndef ACCUMULATOR
+#define ACCUMULATOR double
+#endif
+
+#ifdef USE_FP64
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#endif
 
 #define USE_HYBRID_HARD_SOURCE true
 // #define ALPHA_TIMING 0.05
@@ -11,12 +23,40 @@ __constant uint K_FULL = (1 << 26) - 1;
 
 bool in_range(uint size, uint index) { return index > 0 && index < size; }
 
-__kernel void compact_step(__global double *previous_pressure,
-                           __global double *pressure,
-                           __global double *pressure_next,
-                           __global double *betas, __global char *geometry,
+// one grid per metric, the slot of every enabled metric is set with build
+// options (e.g. -DLEQ_INDEX=1). Disabled metrics are neither read nor written.
+// The analysis pointer is already offset to the band of the work item.
+inline void accumulate_analysis(__global ACCUMULATOR *analysis, size_t size,
+                                size_t i, ACCUMULATOR actual_pressure,
+                                ACCUMULATOR dt, ACCUMULATOR time_elapsed) {
+  ACCUMULATOR alpha = dt / ALPHA_TIMING;
+
+#ifdef PRESSURE_INDEX
+  analysis[PRESSURE_INDEX * size + i] = actual_pressure;
+#endif
+
+  ACCUMULATOR rms_addition = actual_pressure * actual_pressure * 25e8;
+
+#ifdef RMS_INDEX
+  ACCUMULATOR rms_sum = analysis[RMS_INDEX * size + i] + dt * rms_addition;
+  analysis[RMS_INDEX * size + i] = rms_sum;
+#endif
+
+#ifdef EWMA_INDEX
+  if (time_elapsed > 0) {
+    ACCUMULATOR current_ewma = analysis[EWMA_INDEX * size + i];
+    ACCUMULATOR ewma = alpha * rms_addition + (1 - alpha) * current_ewma;
+    analysis[EWMA_INDEX * size + i] = ewma;
+  }
+#endif
+}
+
+__kernel void compact_step(__global REAL *previous_pressure,
+                           __global REAL *pressure,
+                           __global REAL *pressure_next,
+                           __global REAL *betas, __global char *geometry,
                            __global uint *neighbours, uint size_w, uint size_h,
-                           uint size_d, double lambda, double signal) {
+                           uint size_d, REAL lambda, REAL signal) {
   size_t i = get_global_id(0);
   size_t w = (i / (size_h * size_d)) % size_w;
   size_t h = (i / (size_d)) % size_h;
@@ -48,23 +88,23 @@ __kernel void compact_step(__global double *previous_pressure,
     return;
   }
 
-  double lambda2 = lambda * lambda;
+  REAL lambda2 = lambda * lambda;
   uint neighbour_count = popcount(neighbour_flag & K1_BITMASK);
-  double neighbour_factor = 2.0 - (double)(neighbour_count)*lambda2;
+  REAL neighbour_factor = 2.0 - (REAL)(neighbour_count)*lambda2;
 
-  double current = pressure[i];
-  double previous = previous_pressure[i];
+  REAL current = pressure[i];
+  REAL previous = previous_pressure[i];
 
-  double beta_1_factor = 1.0;
-  double beta_2_factor = 1.0;
+  REAL beta_1_factor = 1.0;
+  REAL beta_2_factor = 1.0;
 
   if (neighbour_count < 6) {
-    double beta = betas[i];
+    REAL beta = betas[i];
     beta_1_factor = 1.0 / (1.0 + lambda * beta);
     beta_2_factor = 1.0 - lambda * beta;
   }
 
-  double stencil_sum = 0.0;
+  REAL stencil_sum = 0.0;
   if (neighbour_flag >> 0 & 1)
     stencil_sum += pressure[i - w_stride];
   if (neighbour_flag >> 1 & 1)
@@ -78,7 +118,7 @@ __kernel void compact_step(__global double *previous_pressure,
   if (neighbour_flag >> 5 & 1)
     stencil_sum += pressure[i + d_stride];
 
-  double next_value =
+  REAL next_value =
       beta_1_factor * (neighbour_factor * current + lambda2 * stencil_sum -
                        beta_2_factor * previous);
 
@@ -94,12 +134,15 @@ __kernel void compact_step(__global double *previous_pressure,
 }
 
 __kernel void
-compact_schema_step(__global double *previous_pressure,
-                    __global double *pressure, __global double *pressure_next,
-                    __global double *betas, __global char *geometry,
+compact_schema_step(__global REAL *previous_pressure,
+                    __global REAL *pressure, __global REAL *pressure_next,
+                    __global REAL *betas, __global char *geometry,
                     __global uint *neighbours, uint size_w, uint size_h,
-                    uint size_d, double lambda, double pa, double pb, double d1,
-                    double d2, double d3, double d4, double signal) {
+                    uint size_d, REAL lambda, REAL pa, REAL pb, REAL d1,
+                    REAL d2, REAL d3, REAL d4, __global REAL *signals,
+                    uint signal_index, __global uint *cells,
+                    __global ACCUMULATOR *analysis, uint size_a,
+                    ACCUMULATOR dt, ACCUMULATOR time_elapsed) {
 
   size_t d_stride = 1;
   size_t h_stride = size_d;
@@ -110,29 +153,30 @@ compact_schema_step(__global double *previous_pressure,
   // size_t d = get_global_id(2);
   // size_t i = w * w_stride + h * h_stride + d * d_stride;
 
-  size_t i = get_global_id(0);
+  // only air cells are launched, walls are set once by the host
+  size_t i = cells[get_global_id(0)];
   size_t w = (i / (size_h * size_d)) % size_w;
   size_t h = (i / (size_d)) % size_h;
   size_t d = i % size_d;
 
   size_t size = size_d * size_h * size_w;
+
+  // every band shares the geometry, but has its own pressure field and betas
+  size_t band = get_global_id(1);
+  size_t band_count = get_global_size(1);
+  size_t band_offset = band * size;
+  previous_pressure += band_offset;
+  pressure += band_offset;
+  pressure_next += band_offset;
+  betas += band_offset;
+  REAL signal = signals[signal_index * band_count + band];
+
   char geometry_type = geometry[i];
 
-  bool is_wall = geometry_type & 1;
   bool is_source = geometry_type >> 1 & 1;
 
   uint neighbour_flag = neighbours[i];
 
-  if (i >= size || i < 0) {
-    return;
-  }
-
-  if (is_wall) {
-    pressure_next[i] = NAN;
-    // pressure_next[i] = 0.001;
-    return;
-  }
-
   // if (neighbour_flag == 0) {
   //   pressure_next[i] = 0.0;
   //   return;
@@ -148,28 +192,28 @@ compact_schema_step(__global double *previous_pressure,
   bool has_wall_neighbours =
       !has_k1_neighbours || !has_k2_neighbours || !has_k3_neighbours;
 
-  double neighbour_factor = d4;
-  double beta_1_factor = 1.0;
-  double beta_2_factor = 1.0;
-  double lambda2 = lambda * lambda;
+  REAL neighbour_factor = d4;
+  REAL beta_1_factor = 1.0;
+  REAL beta_2_factor = 1.0;
+  REAL lambda2 = lambda * lambda;
 
   if (has_wall_neighbours) {
-    double k1 = (double)(k_neighbour_1);
-    double k2 = (double)(k_neighbour_2);
-    double k3 = (double)(k_neighbour_3);
+    REAL k1 = (REAL)(k_neighbour_1);
+    REAL k2 = (REAL)(k_neighbour_2);
+    REAL k3 = (REAL)(k_neighbour_3);
     neighbour_factor = 2 - k1 * d1 - k2 * d2 - k3 * d3;
 
-    double beta = betas[i];
-    double beta_k = (26 - (double)(total_neighbours)) * lambda * beta * 0.5;
+    REAL beta = betas[i];
+    REAL beta_k = (26 - (REAL)(total_neighbours)) * lambda * beta * 0.5;
     beta_2_factor = 1.0 - beta_k;
     beta_1_factor = 1.0 / (1 + beta_k);
   }
 
-  double current = pressure[i];
-  double previous = previous_pressure[i];
-  double d1_sum = 0.0;
-  double d2_sum = 0.0;
-  double d3_sum = 0.0;
+  REAL current = pressure[i];
+  REAL previous = previous_pressure[i];
+  REAL d1_sum = 0.0;
+  REAL d2_sum = 0.0;
+  REAL d3_sum = 0.0;
 
   // D1 - 1x neighbours
   if (d1 != 0.0) {
@@ -259,9 +303,9 @@ compact_schema_step(__global double *previous_pressure,
       d3_sum += pressure[i + w_stride + h_stride + d_stride];
   }
 
-  double stencil_sum = d1 * d1_sum + d2 * d2_sum + d3 * d3_sum;
-  double current_sum = neighbour_factor * current;
-  double next_value =
+  REAL stencil_sum = d1 * d1_sum + d2 * d2_sum + d3 * d3_sum;
+  REAL current_sum = neighbour_factor * current;
+  REAL next_value =
       beta_1_factor * (stencil_sum + current_sum - beta_2_factor * previous);
 
   if (is_source && !isnan(signal)) {
@@ -273,67 +317,542 @@ compact_schema_step(__global double *previous_pressure,
   }
 
   pressure_next[i] = next_value;
+
+#ifdef FUSE_ANALYSIS
+  // the analysis uses the current pressure, which the stencil already read
+  accumulate_analysis(analysis + band * size * size_a, size, i,
+                      (ACCUMULATOR)current, dt, time_elapsed);
+#endif
 }
 
-__kernel void analysis_step(__global double *pressure,
-                            __global double *analysis, __global char *geometry,
-                            uint size_w, uint size_h, uint size_d, uint size_a,
-                            double rho, double dt, double time_elapsed) {
-  size_t i = get_global_id(0);
+// Cells with all (used) neighbours in the air: no betas, neighbour flags or
+// per-neighbour branches. Branches on d1/d2/d3 are equal for all work items.
+__kernel void
+interior_schema_step(__global REAL *previous_pressure,
+                     __global REAL *pressure, __global REAL *pressure_next,
+                     __global char *geometry, uint size_w, uint size_h,
+                     uint size_d, REAL d1, REAL d2, REAL d3, REAL d4,
+                     __global REAL *signals, uint signal_index,
+                     __global uint *cells, __global ACCUMULATOR *analysis,
+                     uint size_a, ACCUMULATOR dt, ACCUMULATOR time_elapsed) {
+
+  size_t d_stride = 1;
+  size_t h_stride = size_d;
+  size_t w_stride = size_d * size_h;
+
+  size_t i = cells[get_global_id(0)];
+  size_t size = size_d * size_h * size_w;
+
+  size_t band = get_global_id(1);
+  size_t band_count = get_global_size(1);
+  size_t band_offset = band * size;
+  previous_pressure += band_offset;
+  pressure += band_offset;
+  pressure_next += band_offset;
+
+  REAL current = pressure[i];
+  REAL previous = previous_pressure[i];
+
+  // D1 - 1x neighbours
+  REAL d1_sum = 0.0;
+  if (d1 != 0.0) {
+    d1_sum = pressure[i - w_stride] + pressure[i + w_stride] +
+             pressure[i - h_stride] + pressure[i + h_stride] +
+             pressure[i - d_stride] + pressure[i + d_stride];
+  }
+
+  // D2 - 2x neighbours
+  REAL d2_sum = 0.0;
+  if (d2 != 0.0) {
+    d2_sum = pressure[i - w_stride - h_stride] +
+             pressure[i - w_stride + h_stride] +
+             pressure[i + w_stride + h_stride] +
+             pressure[i + w_stride - h_stride] +
+             pressure[i - d_stride - h_stride] +
+             pressure[i - d_stride + h_stride] +
+             pressure[i + d_stride + h_stride] +
+             pressure[i + d_stride - h_stride] +
+             pressure[i - w_stride - d_stride] +
+             pressure[i - w_stride + d_stride] +
+             pressure[i + w_stride + d_stride] +
+             pressure[i + w_stride - d_stride];
+  }
+
+  // D3 - 3x neighbours
+  REAL d3_sum = 0.0;
+  if (d3 != 0.0) {
+    d3_sum = pressure[i - w_stride - h_stride - d_stride] +
+             pressure[i - w_stride - h_stride + d_stride] +
+             pressure[i - w_stride + h_stride - d_stride] +
+             pressure[i - w_stride + h_stride + d_stride] +
+             pressure[i + w_stride - h_stride - d_stride] +
+             pressure[i + w_stride - h_stride + d_stride] +
+             pressure[i + w_stride + h_stride - d_stride] +
+             pressure[i + w_stride + h_stride + d_stride];
+  }
+
+  REAL stencil_sum = d1 * d1_sum + d2 * d2_sum + d3 * d3_sum;
+  REAL next_value = stencil_sum + d4 * current - previous;
+
+  bool is_source = geometry[i] >> 1 & 1;
+  REAL signal = signals[signal_index * band_count + band];
+  if (is_source && !isnan(signal)) {
+    if (USE_HYBRID_HARD_SOURCE) {
+      next_value = signal;
+    } else {
+      next_value += signal;
+    }
+  }
+
+  pressure_next[i] = next_value;
+
+#ifdef FUSE_ANALYSIS
+  // the analysis uses the current pressure, which the stencil already read
+  accumulate_analysis(analysis + band * size * size_a, size, i,
+                      (ACCUMULATOR)current, dt, time_elapsed);
+#endif
+}
+
+__kernel void analysis_step(__global REAL *pressure,
+                            __global ACCUMULATOR *analysis,
+                            __global char *geometry, uint size_w, uint size_h,
+                            uint size_d, uint size_a, ACCUMULATOR rho,
+                            ACCUMULATOR dt, ACCUMULATOR time_elapsed,
+                            __global uint *cells) {
+  // only air cells are launched, walls are set once by the host
+  size_t i = cells[get_global_id(0)];
   size_t w = (i / (size_h * size_d)) % size_w;
   size_t h = (i / (size_d)) % size_h;
   size_t d = i % size_d;
 
-  size_t size = size_d * size_h * size_w * size_a;
+  size_t size = size_d * size_h * size_w;
 
-  if (i >= size || i < 0) {
+  size_t band = get_global_id(1);
+  pressure += band * size;
+  analysis += band * size * size_a;
+
+  ACCUMULATOR current_pressure = (ACCUMULATOR)pressure[i];
+  // ACCUMULATOR previous_pressure = pressure_previous[i];
+  // ACCUMULATOR delta_pressure = current_pressure - previous_pressure;
+  // ACCUMULATOR actual_pressure = rho * delta_pressure;
+  ACCUMULATOR actual_pressure = current_pressure;
+  accumulate_analysis(analysis, size, i, actual_pressure, dt, time_elapsed);
+}
+
+// decibel metrics only depend on the latest accumulated values, so they are
+// computed once before the host reads the analysis values instead of every step
+__kernel void finalize_analysis(__global ACCUMULATOR *analysis, uint size_w,
+                                uint size_h, uint size_d, uint size_a,
+                                ACCUMULATOR time_elapsed,
+                                __global uint *cells) {
+  size_t i = cells[get_global_id(0)];
+  size_t size = size_d * size_h * size_w;
+
+  size_t band = get_global_id(1);
+  analysis += band * size * size_a;
+
+  if (time_elapsed <= 0) {
     return;
   }
 
-  // size_t pres_i = i * size_a + 0;
-  size_t rms_i = i * size_a + 1;
-  size_t leq_i = i * size_a + 2;
-  // size_t ewma_i = i * size_a + 3;
-  // size_t ewma_db_i = i * size_a + 4;
+#ifdef LEQ_INDEX
+  ACCUMULATOR iteration_factor = 1.0 / time_elapsed;
 
-  char geometry_type = geometry[i];
+  // note: log sqrt x = 0.5 * log x
+  ACCUMULATOR rms_value = iteration_factor * analysis[RMS_INDEX * size + i];
+  analysis[LEQ_INDEX * size + i] = rms_value > 0 ? 10.0 * log10(rms_value) : 0;
+#endif
 
-  bool is_wall = geometry_type & 1;
-  bool is_source = geometry_type >> 1 & 1;
-  bool is_listener = geometry_type >> 3 & 1;
-  double alpha = dt / ALPHA_TIMING;
+#ifdef EWMA_L_INDEX
+  ACCUMULATOR ewma = analysis[EWMA_INDEX * size + i];
+  analysis[EWMA_L_INDEX * size + i] = ewma > 0 ? 10.0 * log10(ewma) : 0;
+#endif
+}
 
-  if (is_wall) {
-    // if (!is_listener) {
-    // analysis[ewma_db_i] = NAN;
-    analysis[leq_i] = NAN;
-    return;
+#ifdef TIME_BLOCK
+// Temporal blocking: a work group loads a tile of TILE_SIZE^3 cells plus a
+// halo of TIME_BLOCK cells on every side into local memory and advances it
+// TIME_BLOCK iterations. Every iteration the valid region shrinks by one cell,
+// so only the core of the tile is written back.
+#define TILE_EXTENT (TILE_SIZE + 2 * TIME_BLOCK)
+#define TILE_CELLS (TILE_EXTENT * TILE_EXTENT * TILE_EXTENT)
+
+// same as compact_schema_step, on a local memory tile
+inline REAL tile_schema_value(__local REAL *previous_pressure,
+                              __local REAL *pressure, size_t j,
+                              uint neighbour_flag, REAL beta, REAL lambda,
+                              REAL d1, REAL d2, REAL d3, REAL d4) {
+  size_t d_stride = 1;
+  size_t h_stride = TILE_EXTENT;
+  size_t w_stride = TILE_EXTENT * TILE_EXTENT;
+
+  REAL current = pressure[j];
+  REAL previous = previous_pressure[j];
+
+  // cells without walls around them, like interior_schema_step
+  if (neighbour_flag == K_FULL) {
+    REAL d1_sum = pressure[j - w_stride] + pressure[j + w_stride] +
+                  pressure[j - h_stride] + pressure[j + h_stride] +
+                  pressure[j - d_stride] + pressure[j + d_stride];
+    REAL d2_sum = pressure[j - w_stride - h_stride] +
+                  pressure[j - w_stride + h_stride] +
+                  pressure[j + w_stride + h_stride] +
+                  pressure[j + w_stride - h_stride] +
+                  pressure[j - d_stride - h_stride] +
+                  pressure[j - d_stride + h_stride] +
+                  pressure[j + d_stride + h_stride] +
+                  pressure[j + d_stride - h_stride] +
+                  pressure[j - w_stride - d_stride] +
+                  pressure[j - w_stride + d_stride] +
+                  pressure[j + w_stride + d_stride] +
+                  pressure[j + w_stride - d_stride];
+    REAL d3_sum = pressure[j - w_stride - h_stride - d_stride] +
+                  pressure[j - w_stride - h_stride + d_stride] +
+                  pressure[j - w_stride + h_stride - d_stride] +
+                  pressure[j - w_stride + h_stride + d_stride] +
+                  pressure[j + w_stride - h_stride - d_stride] +
+                  pressure[j + w_stride - h_stride + d_stride] +
+                  pressure[j + w_stride + h_stride - d_stride] +
+                  pressure[j + w_stride + h_stride + d_stride];
+    REAL stencil_sum = d1 * d1_sum + d2 * d2_sum + d3 * d3_sum;
+    return stencil_sum + d4 * current - previous;
   }
 
-  double current_pressure = pressure[i];
-  // double previous_pressure = pressure_previous[i];
-  // double delta_pressure = current_pressure - previous_pressure;
-  // double actual_pressure = rho * delta_pressure;
-  double actual_pressure = current_pressure;
-  // TODO: enable again if needed
-  // analysis[pres_i] = actual_pressure;
+  uint k_neighbour_1 = popcount(neighbour_flag & K1_BITMASK);
+  uint k_neighbour_2 = popcount(neighbour_flag & K2_BITMASK);
+  uint k_neighbour_3 = popcount(neighbour_flag & K3_BITMASK);
+  uint total_neighbours = popcount(neighbour_flag);
+  bool has_k1_neighbours = d1 == 0.0 || k_neighbour_1 == 6;
+  bool has_k2_neighbours = d2 == 0.0 || k_neighbour_2 == 12;
+  bool has_k3_neighbours = d3 == 0.0 || k_neighbour_3 == 8;
+  bool has_wall_neighbours =
+      !has_k1_neighbours || !has_k2_neighbours || !has_k3_neighbours;
 
-  double rms_addition = actual_pressure * actual_pressure * 25e8;
+  REAL neighbour_factor = d4;
+  REAL beta_1_factor = 1.0;
+  REAL beta_2_factor = 1.0;
 
-  double rms_sum = analysis[rms_i] + dt * rms_addition;
-  analysis[rms_i] = rms_sum;
+  if (has_wall_neighbours) {
+    REAL k1 = (REAL)(k_neighbour_1);
+    REAL k2 = (REAL)(k_neighbour_2);
+    REAL k3 = (REAL)(k_neighbour_3);
+    neighbour_factor = 2 - k1 * d1 - k2 * d2 - k3 * d3;
 
-  if (time_elapsed > 0) {
-    double iteration_factor = 1.0 / time_elapsed;
+    REAL beta_k = (26 - (REAL)(total_neighbours)) * lambda * beta * 0.5;
+    beta_2_factor = 1.0 - beta_k;
+    beta_1_factor = 1.0 / (1 + beta_k);
+  }
+
+  REAL d1_sum = 0.0;
+  REAL d2_sum = 0.0;
+  REAL d3_sum = 0.0;
+
+  // D1 - 1x neighbours
+  if (d1 != 0.0) {
+    if (neighbour_flag >> 0 & 1)
+      d1_sum += pressure[j - w_stride];
+    if (neighbour_flag >> 1 & 1)
+      d1_sum += pressure[j + w_stride];
+    if (neighbour_flag >> 2 & 1)
+      d1_sum += pressure[j - h_stride];
+    if (neighbour_flag >> 3 & 1)
+      d1_sum += pressure[j + h_stride];
+    if (neighbour_flag >> 4 & 1)
+      d1_sum += pressure[j - d_stride];
+    if (neighbour_flag >> 5 & 1)
+      d1_sum += pressure[j + d_stride];
+  }
+
+  // D2 - 2x neighbours
+  if (d2 != 0.0) {
+    if (neighbour_flag >> 6 & 1)
+      d2_sum += pressure[j - w_stride - h_stride];
+    if (neighbour_flag >> 7 & 1)
+      d2_sum += pressure[j - w_stride + h_stride];
+    if (neighbour_flag >> 8 & 1)
+      d2_sum += pressure[j + w_stride + h_stride];
+    if (neighbour_flag >> 9 & 1)
+      d2_sum += pressure[j + w_stride - h_stride];
+    if (neighbour_flag >> 10 & 1)
+      d2_sum += pressure[j - d_stride - h_stride];
+    if (neighbour_flag >> 11 & 1)
+      d2_sum += pressure[j - d_stride + h_stride];
+    if (neighbour_flag >> 12 & 1)
+      d2_sum += pressure[j + d_stride + h_stride];
+    if (neighbour_flag >> 13 & 1)
+      d2_sum += pressure[j + d_stride - h_stride];
+    if (neighbour_flag >> 14 & 1)
+      d2_sum += pressure[j - w_stride - d_stride];
+    if (neighbour_flag >> 15 & 1)
+      d2_sum += pressure[j - w_stride + d_stride];
+    if (neighbour_flag >> 16 & 1)
+      d2_sum += pressure[j + w_stride + d_stride];
+    if (neighbour_flag >> 17 & 1)
+      d2_sum += pressure[j + w_stride - d_stride];
+  }
+
+  // D3 - 3x neighbours
+  if (d3 != 0.0) {
+    if (neighbour_flag >> 18 & 1)
+      d3_sum += pressure[j - w_stride - h_stride - d_stride];
+    if (neighbour_flag >> 19 & 1)
+      d3_sum += pressure[j - w_stride - h_stride + d_stride];
+    if (neighbour_flag >> 20 & 1)
+      d3_sum += pressure[j - w_stride + h_stride - d_stride];
+    if (neighbour_flag >> 21 & 1)
+      d3_sum += pressure[j - w_stride + h_stride + d_stride];
+    if (neighbour_flag >> 22 & 1)
+      d3_sum += pressure[j + w_stride - h_stride - d_stride];
+    if (neighbour_flag >> 23 & 1)
+      d3_sum += pressure[j + w_stride - h_stride + d_stride];
+    if (neighbour_flag >> 24 & 1)
+      d3_sum += pressure[j + w_stride + h_stride - d_stride];
+    if (neighbour_flag >> 25 & 1)
+      d3_sum += pressure[j + w_stride + h_stride + d_stride];
+  }
+
+  REAL stencil_sum = d1 * d1_sum + d2 * d2_sum + d3 * d3_sum;
+  REAL current_sum = neighbour_factor * current;
+  return beta_1_factor *
+         (stencil_sum + current_sum - beta_2_factor * previous);
+}
+
+// Advances TIME_BLOCK iterations, reading (previous, current) and writing the
+// last two pressure levels to (previous_out, pressure_out). The analysis is
+// accumulated for every iteration, like the fused scheme kernels do.
+__kernel void
+blocked_schema_step(__global REAL *previous_pressure, __global REAL *pressure,
+                    __global REAL *previous_out, __global REAL *pressure_out,
+                    __global REAL *betas, __global char *geometry,
+                    __global uint *neighbours, uint size_w, uint size_h,
+                    uint size_d, REAL lambda, REAL d1, REAL d2, REAL d3,
+                    REAL d4, __global REAL *signals, uint signal_index,
+                    __global ACCUMULATOR *analysis, uint size_a,
+                    ACCUMULATOR dt, ACCUMULATOR time_elapsed) {
+  __local REAL tile_0[TILE_CELLS];
+  __local REAL tile_1[TILE_CELLS];
+  __local REAL tile_2[TILE_CELLS];
+  __local REAL *tile_previous = tile_0;
+  __local REAL *tile_current = tile_1;
+  __local REAL *tile_next = tile_2;
+
+  size_t size = size_d * size_h * size_w;
+  size_t band = get_global_id(1);
+  size_t band_count = get_global_size(1);
+  size_t band_offset = band * size;
+  previous_pressure += band_offset;
+  pressure += band_offset;
+  previous_out += band_offset;
+  pressure_out += band_offset;
+  betas += band_offset;
+  analysis += band_offset * size_a;
+
+  // origin of the tile (including the halo) in the grid
+  int tiles_h = (size_h + TILE_SIZE - 1) / TILE_SIZE;
+  int tiles_d = (size_d + TILE_SIZE - 1) / TILE_SIZE;
+  int tile = get_group_id(0);
+  int origin_w = (tile / (tiles_h * tiles_d)) * TILE_SIZE - TIME_BLOCK;
+  int origin_h = ((tile / tiles_d) % tiles_h) * TILE_SIZE - TIME_BLOCK;
+  int origin_d = (tile % tiles_d) * TILE_SIZE - TIME_BLOCK;
+
+  size_t local_id = get_local_id(0);
+  size_t local_size = get_local_size(0);
+
+  for (size_t j = local_id; j < TILE_CELLS; j += local_size) {
+    int w = origin_w + (int)(j / (TILE_EXTENT * TILE_EXTENT));
+    int h = origin_h + (int)((j / TILE_EXTENT) % TILE_EXTENT);
+    int d = origin_d + (int)(j % TILE_EXTENT);
+    bool inside = w >= 0 && w < (int)size_w && h >= 0 && h < (int)size_h &&
+                  d >= 0 && d < (int)size_d;
+    size_t i = inside ? (size_t)w * size_h * size_d + (size_t)h * size_d + d : 0;
+    tile_previous[j] = inside ? previous_pressure[i] : 0.0;
+    tile_current[j] = inside ? pressure[i] : 0.0;
+  }
+  barrier(CLK_LOCAL_MEM_FENCE);
+
+  for (uint step = 0; step < TIME_BLOCK; step++) {
+    REAL signal = signals[(signal_index + step) * band_count + band];
+    ACCUMULATOR step_time = time_elapsed + step * dt;
+    // cells that still have valid neighbours in the tile
+    int margin = step + 1;
+
+    for (size_t j = local_id; j < TILE_CELLS; j += local_size) {
+      int lw = j / (TILE_EXTENT * TILE_EXTENT);
+      int lh = (j / TILE_EXTENT) % TILE_EXTENT;
+      int ld = j % TILE_EXTENT;
+      if (lw < margin || lw >= TILE_EXTENT - margin || lh < margin ||
+          lh >= TILE_EXTENT - margin || ld < margin ||
+          ld >= TILE_EXTENT - margin) {
+        continue;
+      }
+
+      int w = origin_w + lw;
+      int h = origin_h + lh;
+      int d = origin_d + ld;
+      if (w < 0 || w >= (int)size_w || h < 0 || h >= (int)size_h || d < 0 ||
+          d >= (int)size_d) {
+        continue;
+      }
+      size_t i = (size_t)w * size_h * size_d + (size_t)h * size_d + d;
+
+      // walls are never simulated, they keep their value
+      char geometry_type = geometry[i];
+      if (geometry_type & 1) {
+        tile_next[j] = tile_current[j];
+        continue;
+      }
+
+      bool is_core = lw >= TIME_BLOCK && lw < TILE_EXTENT - TIME_BLOCK &&
+                     lh >= TIME_BLOCK && lh < TILE_EXTENT - TIME_BLOCK &&
+                     ld >= TIME_BLOCK && ld < TILE_EXTENT - TIME_BLOCK;
+      if (is_core) {
+        accumulate_analysis(analysis, size, i, (ACCUMULATOR)tile_current[j],
+                            dt, step_time);
+      }
+
+      REAL next_value =
+          tile_schema_value(tile_previous, tile_current, j, neighbours[i],
+                            betas[i], lambda, d1, d2, d3, d4);
+
+      bool is_source = geometry_type >> 1 & 1;
+      if (is_source && !isnan(signal)) {
+        if (USE_HYBRID_HARD_SOURCE) {
+          next_value = signal;
+        } else {
+          next_value += signal;
+        }
+      }
+      tile_next[j] = next_value;
+    }
+    barrier(CLK_LOCAL_MEM_FENCE);
+
+    __local REAL *tile_swap = tile_previous;
+    tile_previous = tile_current;
+    tile_current = tile_next;
+    tile_next = tile_swap;
+  }
 
-    // note: log sqrt x = 0.5 * log x
-    double rms_value = iteration_factor * rms_sum;
-    analysis[leq_i] = rms_value > 0 ? 10.0 * log10(rms_value) : 0;
+  for (size_t j = local_id; j < TILE_CELLS; j += local_size) {
+    int lw = j / (TILE_EXTENT * TILE_EXTENT);
+    int lh = (j / TILE_EXTENT) % TILE_EXTENT;
+    int ld = j % TILE_EXTENT;
+    int w = origin_w + lw;
+    int h = origin_h + lh;
+    int d = origin_d + ld;
+    if (lw < TIME_BLOCK || lw >= TILE_EXTENT - TIME_BLOCK ||
+        lh < TIME_BLOCK || lh >= TILE_EXTENT - TIME_BLOCK ||
+        ld < TIME_BLOCK || ld >= TILE_EXTENT - TIME_BLOCK || w >= (int)size_w ||
+        h >= (int)size_h || d >= (int)size_d) {
+      continue;
+    }
+    size_t i = (size_t)w * size_h * size_d + (size_t)h * size_d + d;
+    previous_out[i] = tile_previous[j];
+    pressure_out[i] = tile_current[j];
+  }
+}
+#endif
+
+__kernel void gather_cells(__global REAL *values, __global uint *indices,
+                           __global REAL *output, uint size,
+                           uint output_offset) {
+  size_t k = get_global_id(0);
+  size_t count = get_global_size(0);
+  size_t band = get_global_id(1);
+
+  output[output_offset + band * count + k] = values[band * size + indices[k]];
+}
+
+__kernel void gather_accumulator_cells(__global ACCUMULATOR *values,
+                                       __global uint *indices,
+                                       __global ACCUMULATOR *output,
+                                       uint size) {
+  size_t k = get_global_id(0);
+  size_t count = get_global_size(0);
+  // (band, metric) row of the analysis values
+  size_t row = get_global_id(1);
+
+  output[row * count + k] = values[row * size + indices[k]];
+}
+
+__kernel void scatter_cells(__global REAL *values, __global uint *indices,
+                            __global REAL *output, uint size) {
+  size_t k = get_global_id(0);
+  size_t count = get_global_size(0);
+  size_t band = get_global_id(1);
+
+  output[band * size + indices[k]] = values[band * count + k];
+}
+
+// sum, minimum, maximum and count of the values of a metric in the given cells
+// that are not nan, one work group per band with a power of two size
+__kernel void reduce_metric_cells(__global ACCUMULATOR *analysis,
+                                  __global uint *indices, uint count,
+                                  uint size, uint metric, uint metrics,
+                                  __global ACCUMULATOR *output,
+                                  __local ACCUMULATOR *sums,
+                                  __local ACCUMULATOR *minimums,
+                                  __local ACCUMULATOR *maximums,
+                                  __local ACCUMULATOR *counts) {
+  size_t local_id = get_local_id(0);
+  size_t local_size = get_local_size(0);
+  size_t band = get_global_id(1);
+  __global ACCUMULATOR *values = analysis + (band * metrics + metric) * size;
+
+  ACCUMULATOR sum = 0.0;
+  ACCUMULATOR minimum = INFINITY;
+  ACCUMULATOR maximum = -INFINITY;
+  ACCUMULATOR valid = 0.0;
+  for (size_t k = local_id; k < count; k += local_size) {
+    ACCUMULATOR value = values[indices[k]];
+    if (isnan(value)) {
+      continue;
+    }
+    sum += value;
+    minimum = fmin(minimum, value);
+    maximum = fmax(maximum, value);
+    valid += 1.0;
+  }
+  sums[local_id] = sum;
+  minimums[local_id] = minimum;
+  maximums[local_id] = maximum;
+  counts[local_id] = valid;
+
+  for (size_t stride = local_size / 2; stride > 0; stride /= 2) {
+    barrier(CLK_LOCAL_MEM_FENCE);
+    if (local_id < stride) {
+      sums[local_id] += sums[local_id + stride];
+      minimums[local_id] = fmin(minimums[local_id], minimums[local_id + stride]);
+      maximums[local_id] = fmax(maximums[local_id], maximums[local_id + stride]);
+      counts[local_id] += counts[local_id + stride];
+    }
+  }
+
+  if (local_id == 0) {
+    output[band * 4 + 0] = sums[0];
+    output[band * 4 + 1] = minimums[0];
+    output[band * 4 + 2] = maximums[0];
+    output[band * 4 + 3] = counts[0];
+  }
+}
 
-    // TODO: enable again if needed
-    // double current_ewma = analysis[ewma_i];
-    // double ewma = alpha * rms_addition + (1 - alpha) * current_ewma;
-    // analysis[ewma_i] = ewma;
-    // analysis[ewma_db_i] = ewma > 0 ? 10.0 * log10(ewma) : 0;
+// Welford update of the mean and sum of squared differences of a metric with
+// the values of the first band_count bands, count values were added before
+__kernel void accumulate_band_statistics(__global ACCUMULATOR *analysis,
+                                         __global uint *indices, uint size,
+                                         uint metric, uint metrics,
+                                         uint band_count, uint count,
+                                         __global ACCUMULATOR *mean,
+                                         __global ACCUMULATOR *m2) {
+  size_t i = indices[get_global_id(0)];
+  ACCUMULATOR cell_mean = mean[i];
+  ACCUMULATOR cell_m2 = m2[i];
+  for (uint band = 0; band < band_count; band++) {
+    ACCUMULATOR value = analysis[(band * metrics + metric) * size + i];
+    ACCUMULATOR n = count + band + 1;
+    ACCUMULATOR delta = value - cell_mean;
+    cell_mean += delta / n;
+    cell_m2 += delta * (value - cell_mean);
   }
+  mean[i] = cell_mean;
+  m2[i] = cell_m2;
 }
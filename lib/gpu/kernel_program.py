@@ -1,9 +1,12 @@
 
 import os
 import math
+from typing import List
 import pyopencl as cl
 import numpy as np
 
+from lib.analysis.metrics import get_metric_build_options, has_decibel_metrics
+from lib.gpu.program_cache import build_program, get_default_context
 from lib.physical_constants import RHO
 from ..grid import SimulationGrid
 
@@ -19,33 +22,66 @@ class SimulationKernelProgram:
       for device in platform.get_devices():
         print(f'- device: {device.name}')
 
-  def __init__(self, grid: SimulationGrid):
+  def __init__(self, grid: SimulationGrid, band_count: int = 1, fuse_analysis: bool = False, time_block: int = 1, ctx: cl.Context = None, device: cl.Device = None):
     if not grid.is_build:
       raise Exception("Please build the grid before building the program")
 
     params = grid.parameters
     self.parameters = params
+    self.band_count = band_count
+    self.grid_shape = grid.grid_shape
+    self.real_type = np.dtype(params.pressure_dtype).type
+    self.accumulator_type = np.dtype(params.analysis_dtype).type
+    self.analysis_keys = dict(grid.analysis_keys)
+    # accumulate the analysis in the scheme kernels instead of a separate pass
+    self.fuse_analysis = fuse_analysis
+    # iterations per launch of the temporally blocked kernel, 1 disables it
+    self.time_block = time_block
+    self.rotation_offset = 0
 
-    os.environ['PYOPENCL_COMPILER_OUTPUT'] = '1'
-    self.platforms = cl.get_platforms()
+    self.ctx = ctx if ctx is not None else get_default_context()
+    # the device of the queue, a context can hold several
+    self.device = device if device is not None else self.ctx.devices[0]
+    self.tile_size = self.get_tile_size(self.device)
 
-    self.ctx = cl.create_some_context(interactive=False)
-
-    self.queue = cl.CommandQueue(self.ctx)
+    self.queue = cl.CommandQueue(self.ctx, self.device)
     r_flag = cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR
-    rw_flag = cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR
 
-    self.analysis_buffer = cl.Buffer(self.ctx, rw_flag, hostbuf=grid.analysis)
+    band_rw_flag = cl.mem_flags.READ_WRITE
+    band_r_flag = cl.mem_flags.READ_ONLY
+
+    # pressure, analysis and beta values have a leading band dimension,
+    # their contents are written by the simulation before the first step
+    self.analysis_buffer = cl.Buffer(
+        self.ctx, band_rw_flag, size=band_count * grid.analysis.nbytes)
     self.pressure_previous_buffer = cl.Buffer(
-        self.ctx, r_flag, hostbuf=grid.pressure_previous)
-    self.pressure_buffer = cl.Buffer(self.ctx, r_flag, hostbuf=grid.pressure)
+        self.ctx, band_rw_flag, size=band_count * grid.pressure_previous.nbytes)
+    self.pressure_buffer = cl.Buffer(
+        self.ctx, band_rw_flag, size=band_count * grid.pressure.nbytes)
     self.pressure_next_buffer = cl.Buffer(
-        self.ctx, rw_flag, hostbuf=grid.pressure_next)
+        self.ctx, band_rw_flag, size=band_count * grid.pressure_next.nbytes)
     self.geometry_buffer = cl.Buffer(self.ctx, r_flag, hostbuf=grid.geometry)
     self.neighbours_buffer = cl.Buffer(
         self.ctx, r_flag, hostbuf=grid.neighbours)
     self.beta_buffer = cl.Buffer(
-        self.ctx, r_flag, hostbuf=grid.beta)
+        self.ctx, band_rw_flag, size=band_count * grid.beta.nbytes)
+
+    self.listener_indices_buffer = self.create_index_buffer(
+        grid.listener_indices)
+    self.air_indices_buffer = self.create_index_buffer(grid.air_indices)
+    self.interior_indices_buffer = self.create_index_buffer(
+        grid.interior_indices)
+    self.boundary_indices_buffer = self.create_index_buffer(
+        grid.boundary_indices)
+    # betas that change with the materials, uploaded compactly and scattered
+    self.beta_cell_count = grid.beta_cells.size
+    self.beta_cells_buffer = self.create_index_buffer(grid.beta_cells)
+    self.beta_values_buffer = cl.Buffer(
+        self.ctx, band_r_flag, size=band_count * max(1, grid.beta_cells.size) * np.dtype(self.real_type).itemsize)
+
+    # excitation signal per (iteration, band), grown on demand
+    self.signal_capacity = 0
+    self.signal_buffer: cl.Buffer = None
 
     file_directory = os.path.dirname(__file__)
     loc = os.path.join(file_directory, RELATIVE_PROGRAM_FILE)
@@ -53,10 +89,12 @@ class SimulationKernelProgram:
     with open(loc, encoding="utf-8") as file:
       source = file.read()
 
-    prg = cl.Program(self.ctx, source).build()
+    # programs are shared by simulations with the same options, kernels are not
+    prg = build_program(self.ctx, source, self.get_build_options())
+    self.cl_program = prg
 
     # compact step kernel
-    self.step_kernel = prg.compact_step
+    self.step_kernel = cl.Kernel(prg, "compact_step")
     self.step_kernel.set_arg(0, self.pressure_previous_buffer)
     self.step_kernel.set_arg(1, self.pressure_buffer)
     self.step_kernel.set_arg(2, self.pressure_next_buffer)
@@ -68,41 +106,275 @@ class SimulationKernelProgram:
     self.step_kernel.set_arg(7, np.uint32(grid.height_parts))
     self.step_kernel.set_arg(8, np.uint32(grid.depth_parts))
 
-    self.step_kernel.set_arg(9, np.float64(params.lambda_courant))
-    self.step_kernel.set_arg(10, np.float64(0))
+    self.step_kernel.set_arg(9, self.real_type(params.lambda_courant))
+    self.step_kernel.set_arg(10, self.real_type(0))
+
+    # (previous, current, next) pressure buffers, rotated every iteration
+    self.rotations = [
+        (self.pressure_previous_buffer, self.pressure_buffer, self.pressure_next_buffer),
+        (self.pressure_buffer, self.pressure_next_buffer, self.pressure_previous_buffer),
+        (self.pressure_next_buffer, self.pressure_previous_buffer, self.pressure_buffer),
+    ]
+
+    # one kernel instance per rotation, so a step only sets scalar arguments
+    # boundary cells, with betas and neighbour flags
+    self.scheme_step_kernels = self.create_rotated_kernels(
+        prg, "compact_schema_step")
+    for kernel, (previous, current, next_) in zip(self.scheme_step_kernels, self.rotations):
+      kernel.set_arg(0, previous)
+      kernel.set_arg(1, current)
+      kernel.set_arg(2, next_)
+      kernel.set_arg(3, self.beta_buffer)
+      kernel.set_arg(4, self.geometry_buffer)
+      kernel.set_arg(5, self.neighbours_buffer)
+
+      kernel.set_arg(6, np.uint32(grid.width_parts))
+      kernel.set_arg(7, np.uint32(grid.height_parts))
+      kernel.set_arg(8, np.uint32(grid.depth_parts))
+
+      kernel.set_arg(9, self.real_type(params.lambda_courant))
+      kernel.set_arg(10, self.real_type(params.param_a))
+      kernel.set_arg(11, self.real_type(params.param_b))
+      kernel.set_arg(12, self.real_type(params.arg_d1))
+      kernel.set_arg(13, self.real_type(params.arg_d2))
+      kernel.set_arg(14, self.real_type(params.arg_d3))
+      kernel.set_arg(15, self.real_type(params.arg_d4))
 
-    self.scheme_step_kernel = prg.compact_schema_step
-    self.scheme_step_kernel.set_arg(0, self.pressure_previous_buffer)
-    self.scheme_step_kernel.set_arg(1, self.pressure_buffer)
-    self.scheme_step_kernel.set_arg(2, self.pressure_next_buffer)
-    self.scheme_step_kernel.set_arg(3, self.beta_buffer)
-    self.scheme_step_kernel.set_arg(4, self.geometry_buffer)
-    self.scheme_step_kernel.set_arg(5, self.neighbours_buffer)
+      kernel.set_arg(17, np.uint32(0))
+      kernel.set_arg(18, self.boundary_indices_buffer)
+      self.set_fused_analysis_args(kernel, 19)
 
-    self.scheme_step_kernel.set_arg(6, np.uint32(grid.width_parts))
-    self.scheme_step_kernel.set_arg(7, np.uint32(grid.height_parts))
-    self.scheme_step_kernel.set_arg(8, np.uint32(grid.depth_parts))
+    # interior cells
+    self.interior_step_kernels = self.create_rotated_kernels(
+        prg, "interior_schema_step")
+    for kernel, (previous, current, next_) in zip(self.interior_step_kernels, self.rotations):
+      kernel.set_arg(0, previous)
+      kernel.set_arg(1, current)
+      kernel.set_arg(2, next_)
+      kernel.set_arg(3, self.geometry_buffer)
 
-    self.scheme_step_kernel.set_arg(9, np.float64(params.lambda_courant))
-    self.scheme_step_kernel.set_arg(10, np.float64(params.param_a))
-    self.scheme_step_kernel.set_arg(11, np.float64(params.param_b))
-    self.scheme_step_kernel.set_arg(12, np.float64(params.arg_d1))
-    self.scheme_step_kernel.set_arg(13, np.float64(params.arg_d2))
-    self.scheme_step_kernel.set_arg(14, np.float64(params.arg_d3))
-    self.scheme_step_kernel.set_arg(15, np.float64(params.arg_d4))
+      kernel.set_arg(4, np.uint32(grid.width_parts))
+      kernel.set_arg(5, np.uint32(grid.height_parts))
+      kernel.set_arg(6, np.uint32(grid.depth_parts))
 
-    self.scheme_step_kernel.set_arg(16, np.float64(0))
+      kernel.set_arg(7, self.real_type(params.arg_d1))
+      kernel.set_arg(8, self.real_type(params.arg_d2))
+      kernel.set_arg(9, self.real_type(params.arg_d3))
+      kernel.set_arg(10, self.real_type(params.arg_d4))
+
+      kernel.set_arg(12, np.uint32(0))
+      kernel.set_arg(13, self.interior_indices_buffer)
+      self.set_fused_analysis_args(kernel, 14)
 
     # analysis step kernel
-    self.analysis_kernel = prg.analysis_step
-
-    self.analysis_kernel.set_arg(0, self.pressure_next_buffer)
-    self.analysis_kernel.set_arg(1, self.analysis_buffer)
-    self.analysis_kernel.set_arg(2, self.geometry_buffer)
-    self.analysis_kernel.set_arg(3, np.uint32(grid.width_parts))
-    self.analysis_kernel.set_arg(4, np.uint32(grid.height_parts))
-    self.analysis_kernel.set_arg(5, np.uint32(grid.depth_parts))
-    self.analysis_kernel.set_arg(6, np.uint32(grid.analysis_values))
-    self.analysis_kernel.set_arg(7, np.float64(RHO))
-    self.analysis_kernel.set_arg(8, np.float64(params.dt))
-    self.analysis_kernel.set_arg(9, np.float64(0))
+    self.analysis_kernels = self.create_rotated_kernels(prg, "analysis_step")
+    for kernel, (_, current, _) in zip(self.analysis_kernels, self.rotations):
+      kernel.set_arg(0, current)
+      kernel.set_arg(1, self.analysis_buffer)
+      kernel.set_arg(2, self.geometry_buffer)
+      kernel.set_arg(3, np.uint32(grid.width_parts))
+      kernel.set_arg(4, np.uint32(grid.height_parts))
+      kernel.set_arg(5, np.uint32(grid.depth_parts))
+      kernel.set_arg(6, np.uint32(grid.analysis_values))
+      kernel.set_arg(7, self.accumulator_type(RHO))
+      kernel.set_arg(8, self.accumulator_type(params.dt))
+      kernel.set_arg(9, self.accumulator_type(0))
+      kernel.set_arg(10, self.air_indices_buffer)
+
+    # decibel metrics, computed once before the analysis values are read back
+    self.use_finalize = has_decibel_metrics(self.analysis_keys)
+    self.finalize_kernel = cl.Kernel(prg, "finalize_analysis")
+    self.finalize_kernel.set_arg(0, self.analysis_buffer)
+    self.finalize_kernel.set_arg(1, np.uint32(grid.width_parts))
+    self.finalize_kernel.set_arg(2, np.uint32(grid.height_parts))
+    self.finalize_kernel.set_arg(3, np.uint32(grid.depth_parts))
+    self.finalize_kernel.set_arg(4, np.uint32(grid.analysis_values))
+    self.finalize_kernel.set_arg(5, self.accumulator_type(0))
+    self.finalize_kernel.set_arg(6, self.air_indices_buffer)
+
+    # listener gather kernel
+    self.gather_kernels = self.create_rotated_kernels(prg, "gather_cells")
+    for kernel, (_, current, _) in zip(self.gather_kernels, self.rotations):
+      kernel.set_arg(0, current)
+      kernel.set_arg(1, self.listener_indices_buffer)
+      kernel.set_arg(3, np.uint32(grid.grid_size))
+      kernel.set_arg(4, np.uint32(0))
+
+    # listener values for the listener readback, (band, listener) pressure
+    # and (band, metric, listener) analysis values
+    self.listener_count = grid.listener_indices.size
+    self.listener_pressure_buffer = cl.Buffer(
+        self.ctx, cl.mem_flags.WRITE_ONLY, size=max(1, band_count * self.listener_count * np.dtype(self.real_type).itemsize))
+    self.listener_analysis_buffer = cl.Buffer(
+        self.ctx, cl.mem_flags.WRITE_ONLY, size=max(1, band_count * grid.analysis_values * self.listener_count * np.dtype(self.accumulator_type).itemsize))
+    self.listener_pressure_kernel = cl.Kernel(prg, "gather_cells")
+    self.listener_pressure_kernel.set_arg(1, self.listener_indices_buffer)
+    self.listener_pressure_kernel.set_arg(2, self.listener_pressure_buffer)
+    self.listener_pressure_kernel.set_arg(3, np.uint32(grid.grid_size))
+    self.listener_pressure_kernel.set_arg(4, np.uint32(0))
+    self.listener_analysis_kernel = cl.Kernel(prg, "gather_accumulator_cells")
+    self.listener_analysis_kernel.set_arg(0, self.analysis_buffer)
+    self.listener_analysis_kernel.set_arg(1, self.listener_indices_buffer)
+    self.listener_analysis_kernel.set_arg(2, self.listener_analysis_buffer)
+    self.listener_analysis_kernel.set_arg(3, np.uint32(grid.grid_size))
+
+    # (sum, minimum, maximum, count) of a metric over the listeners per band
+    device = self.device
+    self.reduction_size = 2 ** int(math.log2(min(256, device.max_work_group_size)))
+    accumulator_size = np.dtype(self.accumulator_type).itemsize
+    self.listener_reduction_buffer = cl.Buffer(
+        self.ctx, cl.mem_flags.WRITE_ONLY, size=band_count * 4 * accumulator_size)
+    self.reduce_listeners_kernel = cl.Kernel(prg, "reduce_metric_cells")
+    self.reduce_listeners_kernel.set_arg(0, self.analysis_buffer)
+    self.reduce_listeners_kernel.set_arg(1, self.listener_indices_buffer)
+    self.reduce_listeners_kernel.set_arg(2, np.uint32(self.listener_count))
+    self.reduce_listeners_kernel.set_arg(3, np.uint32(grid.grid_size))
+    self.reduce_listeners_kernel.set_arg(5, np.uint32(grid.analysis_values))
+    self.reduce_listeners_kernel.set_arg(6, self.listener_reduction_buffer)
+    for arg in range(7, 11):
+      self.reduce_listeners_kernel.set_arg(
+          arg, cl.LocalMemory(self.reduction_size * accumulator_size))
+
+    # mean and sum of squared differences of a metric over bands, per cell
+    self.band_mean_buffer = cl.Buffer(
+        self.ctx, band_rw_flag, size=grid.grid_size * accumulator_size)
+    self.band_m2_buffer = cl.Buffer(
+        self.ctx, band_rw_flag, size=grid.grid_size * accumulator_size)
+    self.band_statistics_kernel = cl.Kernel(prg, "accumulate_band_statistics")
+    self.band_statistics_kernel.set_arg(0, self.analysis_buffer)
+    self.band_statistics_kernel.set_arg(1, self.air_indices_buffer)
+    self.band_statistics_kernel.set_arg(2, np.uint32(grid.grid_size))
+    self.band_statistics_kernel.set_arg(4, np.uint32(grid.analysis_values))
+    self.band_statistics_kernel.set_arg(7, self.band_mean_buffer)
+    self.band_statistics_kernel.set_arg(8, self.band_m2_buffer)
+
+    # material betas
+    self.scatter_beta_kernel = cl.Kernel(prg, "scatter_cells")
+    self.scatter_beta_kernel.set_arg(0, self.beta_values_buffer)
+    self.scatter_beta_kernel.set_arg(1, self.beta_cells_buffer)
+    self.scatter_beta_kernel.set_arg(2, self.beta_buffer)
+    self.scatter_beta_kernel.set_arg(3, np.uint32(grid.grid_size))
+
+    # temporally blocked scheme, ping-pongs between the pressure buffers of a
+    # rotation and two extra buffers
+    self.blocked_step_kernels: List[List[cl.Kernel]] = []
+    if time_block > 1:
+      self.block_previous_buffer = cl.Buffer(
+          self.ctx, band_rw_flag, size=band_count * grid.pressure.nbytes)
+      self.block_pressure_buffer = cl.Buffer(
+          self.ctx, band_rw_flag, size=band_count * grid.pressure.nbytes)
+      tile_counts = [math.ceil(parts / self.tile_size) for parts in grid.grid_shape]
+      tile_extent = self.tile_size + 2 * time_block
+      device = self.device
+      self.block_local_size = [
+          min(256, device.max_work_group_size, tile_extent ** 3), 1]
+      self.block_global_size = [
+          math.prod(tile_counts) * self.block_local_size[0], band_count]
+      block_buffers = (self.block_previous_buffer, self.block_pressure_buffer)
+      for previous, current, _ in self.rotations:
+        forward = cl.Kernel(prg, "blocked_schema_step")
+        backward = cl.Kernel(prg, "blocked_schema_step")
+        self.set_blocked_step_args(forward, (previous, current), block_buffers)
+        self.set_blocked_step_args(backward, block_buffers, (previous, current))
+        self.blocked_step_kernels.append([forward, backward])
+
+    self.ensure_signal_capacity(1)
+
+  def get_build_options(self) -> List[str]:
+    """Compile time options, mainly the value types and enabled analysis metrics"""
+    c_types = {np.float32: "float", np.float64: "double"}
+    options = [
+        f'-DREAL={c_types[self.real_type]}',
+        f'-DACCUMULATOR={c_types[self.accumulator_type]}',
+    ]
+    if np.float64 in (self.real_type, self.accumulator_type):
+      options.append("-DUSE_FP64")
+    if self.accumulator_type == np.float32:
+      # literals like 1.0 are doubles otherwise
+      options.append("-cl-single-precision-constant")
+    options.extend(get_metric_build_options(self.analysis_keys))
+    if self.fuse_analysis:
+      options.append("-DFUSE_ANALYSIS")
+    if self.time_block > 1:
+      options.append(f'-DTIME_BLOCK={self.time_block}')
+      options.append(f'-DTILE_SIZE={self.tile_size}')
+    return options
+
+  def set_fused_analysis_args(self, kernel: cl.Kernel, first_index: int) -> None:
+    """Set the analysis arguments of a scheme kernel, they are unused unless the analysis is fused"""
+    kernel.set_arg(first_index, self.analysis_buffer)
+    kernel.set_arg(first_index + 1, np.uint32(len(self.analysis_keys)))
+    kernel.set_arg(first_index + 2, self.accumulator_type(self.parameters.dt))
+    kernel.set_arg(first_index + 3, self.accumulator_type(0))
+
+  def create_index_buffer(self, indices: np.ndarray) -> cl.Buffer:
+    """Upload a list of cell indices, buffers cannot be empty so those get a placeholder"""
+    if indices.size == 0:
+      indices = np.zeros(shape=(1,), dtype="uint32")
+    return cl.Buffer(self.ctx, cl.mem_flags.READ_ONLY | cl.mem_flags.COPY_HOST_PTR, hostbuf=indices)
+
+  def create_rotated_kernels(self, prg: cl.Program, name: str) -> List[cl.Kernel]:
+    """Create a kernel instance for every pressure buffer rotation"""
+    return [cl.Kernel(prg, name) for _ in self.rotations]
+
+  def get_tile_size(self, device: cl.Device) -> int:
+    """Largest tile (without halo) of which the three pressure levels fit in local memory"""
+    itemsize = np.dtype(self.real_type).itemsize
+    for tile_size in (16, 12, 8, 4):
+      tile_extent = tile_size + 2 * self.time_block
+      if 3 * tile_extent ** 3 * itemsize <= device.local_mem_size:
+        return tile_size
+    raise ValueError(
+        f"A time block of {self.time_block} iterations does not fit in local memory")
+
+  def set_blocked_step_args(self, kernel: cl.Kernel, inputs, outputs) -> None:
+    """Set the arguments of a temporally blocked kernel reading (previous, current) from inputs"""
+    params = self.parameters
+    grid_shape = self.grid_shape
+    kernel.set_arg(0, inputs[0])
+    kernel.set_arg(1, inputs[1])
+    kernel.set_arg(2, outputs[0])
+    kernel.set_arg(3, outputs[1])
+    kernel.set_arg(4, self.beta_buffer)
+    kernel.set_arg(5, self.geometry_buffer)
+    kernel.set_arg(6, self.neighbours_buffer)
+
+    kernel.set_arg(7, np.uint32(grid_shape[0]))
+    kernel.set_arg(8, np.uint32(grid_shape[1]))
+    kernel.set_arg(9, np.uint32(grid_shape[2]))
+
+    kernel.set_arg(10, self.real_type(params.lambda_courant))
+    kernel.set_arg(11, self.real_type(params.arg_d1))
+    kernel.set_arg(12, self.real_type(params.arg_d2))
+    kernel.set_arg(13, self.real_type(params.arg_d3))
+    kernel.set_arg(14, self.real_type(params.arg_d4))
+
+    kernel.set_arg(16, np.uint32(0))
+    kernel.set_arg(17, self.analysis_buffer)
+    kernel.set_arg(18, np.uint32(len(self.analysis_keys)))
+    kernel.set_arg(19, self.accumulator_type(params.dt))
+    kernel.set_arg(20, self.accumulator_type(0))
+
+  def get_rotation(self, iteration: int) -> int:
+    """Get the index of the pressure buffer rotation used for an iteration"""
+    return (iteration + self.rotation_offset) % len(self.rotations)
+
+  def set_rotation(self, iteration: int, rotation: int) -> None:
+    """Continue with the given rotation at an iteration, after a temporally blocked step"""
+    self.rotation_offset = (rotation - iteration) % len(self.rotations)
+
+  def ensure_signal_capacity(self, step_count: int) -> None:
+    """Make sure the signal buffer can hold the signals of step_count iterations"""
+    if step_count <= self.signal_capacity:
+      return
+
+    self.signal_capacity = step_count
+    self.signal_buffer = cl.Buffer(
+        self.ctx, cl.mem_flags.READ_ONLY, size=step_count * self.band_count * np.dtype(self.real_type).itemsize)
+    for kernel in self.scheme_step_kernels:
+      kernel.set_arg(16, self.signal_buffer)
+    for kernel in self.interior_step_kernels:
+      kernel.set_arg(11, self.signal_buffer)
+    for kernels in self.blocked_step_kernels:
+      for kernel in kernels:
+        kernel.set_arg(15, self.signal_buffer)
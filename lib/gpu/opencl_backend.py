@@ -0,0 +1,432 @@
+from typing import List, Tuple
+
+import numpy as np
+
+import pyopencl as cl
+from lib.gpu.kernel_program import SimulationKernelProgram
+from lib.grid import SimulationGrid
+from lib.simulation_backend import READBACK_FULL, READBACK_LISTENERS, READBACK_REGION, SimulationBackend, StepFuture
+
+
+class OpenCLStepFuture(StepFuture):
+  """Snapshot that is filled by copies still enqueued on the device"""
+
+  def __init__(self, pressure: np.ndarray, analysis: np.ndarray, iteration: int, time: float, events: List[cl.Event]) -> None:
+    super().__init__(pressure, analysis, iteration, time)
+    self.events = events
+
+  def is_done(self) -> bool:
+    return all(event.command_execution_status == cl.command_execution_status.COMPLETE
+               for event in self.events)
+
+  def wait(self) -> Tuple[np.ndarray, np.ndarray]:
+    cl.wait_for_events(self.events)
+    return self.pressure, self.analysis
+
+
+class OpenCLBackend(SimulationBackend):
+  """Runs the simulation with the OpenCL kernels of SimulationKernelProgram"""
+
+  def __init__(self, simulation, fuse_analysis: bool = False, time_block: int = 1, grid: SimulationGrid = None, ctx: cl.Context = None, device: cl.Device = None) -> None:
+    super().__init__(simulation)
+    # the grid of the simulation, or a slab of it
+    self.grid = grid if grid is not None else simulation.grid
+    self.program = SimulationKernelProgram(
+        self.grid, simulation.band_count, fuse_analysis, time_block, ctx, device)
+    self.listener_history_buffer: cl.Buffer = None
+    self.beta_values: np.ndarray = None
+    # two pinned (pressure, analysis) snapshots, used in turns by step_async
+    self.snapshots: List[Tuple[np.ndarray, np.ndarray]] = []
+    self.snapshot_buffers: List[cl.Buffer] = []
+    self.snapshot_index = 0
+
+  def get_name(self) -> str:
+    return self.program.device.platform.name
+
+  def sync_read_buffers(self, beta_cells_only: bool = False) -> None:
+    args = {
+        "is_blocking": False,
+    }
+    sim = self.simulation
+    prog = self.program
+    queue = self.program.queue
+    events = [cl.enqueue_copy(
+        queue, prog.geometry_buffer, sim.grid.geometry, **args)]
+    if beta_cells_only:
+      events.extend(self.upload_beta_cells(
+          sim.band_beta.reshape(sim.band_count, -1)))
+    else:
+      events.append(cl.enqueue_copy(
+          queue, prog.beta_buffer, sim.band_beta, **args))
+    cl.wait_for_events(events)
+
+  def upload_beta_cells(self, band_beta: np.ndarray) -> List[cl.Event]:
+    """Upload the betas of grid.beta_cells from flat (band, cell) betas, the values have to be kept until the events are done"""
+    prog = self.program
+    if prog.beta_cell_count == 0:
+      return []
+    self.beta_values = np.ascontiguousarray(band_beta[:, self.grid.beta_cells])
+    upload_event = cl.enqueue_copy(
+        prog.queue, prog.beta_values_buffer, self.beta_values, is_blocking=False)
+    return [cl.enqueue_nd_range_kernel(
+        prog.queue,
+        prog.scatter_beta_kernel,
+        [prog.beta_cell_count, self.simulation.band_count],
+        None,
+        wait_for=[upload_event])]
+
+  def sync_pressure_buffers(self) -> None:
+    args = {
+        "is_blocking": False,
+    }
+    sim = self.simulation
+    prog = self.program
+    queue = self.program.queue
+    cl.wait_for_events([
+        cl.enqueue_copy(queue, prog.pressure_previous_buffer,
+                        sim.band_pressure_previous, **args),
+        cl.enqueue_copy(queue, prog.pressure_next_buffer,
+                        sim.band_pressure_next, **args),
+        cl.enqueue_copy(queue, prog.pressure_buffer,
+                        sim.band_pressure, **args),
+        cl.enqueue_copy(queue, prog.analysis_buffer,
+                        sim.band_analysis, **args),
+    ])
+
+  def reset(self) -> None:
+    self.program.rotation_offset = 0
+
+  def record_listeners(self, step_count: int) -> None:
+    prog = self.program
+    history_size = step_count * self.simulation.band_count * \
+        self.grid.listener_indices.size
+    if history_size == 0:
+      return
+    self.listener_history_buffer = cl.Buffer(
+        prog.ctx, cl.mem_flags.WRITE_ONLY, size=history_size * np.dtype(prog.real_type).itemsize)
+    for kernel in prog.gather_kernels:
+      kernel.set_arg(2, self.listener_history_buffer)
+
+  def get_listener_history(self) -> np.ndarray:
+    sim = self.simulation
+    history = np.zeros(
+        shape=(sim.record_length, sim.band_count, self.grid.listener_indices.size), dtype=self.program.real_type)
+    if history.size > 0:
+      cl.enqueue_copy(self.program.queue, history,
+                      self.listener_history_buffer, is_blocking=True)
+    return history
+
+  def read_state(self) -> List[np.ndarray]:
+    sim = self.simulation
+    prog = self.program
+    pressure = [np.empty(shape=(sim.band_count, *self.grid.grid_shape), dtype=prog.real_type)
+                for _ in range(3)]
+    buffers = prog.rotations[prog.get_rotation(sim.iteration)]
+    cl.wait_for_events([
+        cl.enqueue_copy(prog.queue, values, buffer, is_blocking=False)
+        for values, buffer in zip(pressure, buffers)
+    ])
+    return pressure
+
+  def write_state(self, pressure: List[np.ndarray]) -> None:
+    sim = self.simulation
+    for values, host in zip(pressure, (sim.band_pressure_previous, sim.band_pressure, sim.band_pressure_next)):
+      np.copyto(host, values)
+    # the host arrays are uploaded in the order of the first rotation
+    self.program.set_rotation(sim.iteration, 0)
+    self.sync_pressure_buffers()
+
+  def enqueue_blocked_steps(self, times: np.ndarray, wait_event: List[cl.Event]):
+    """Enqueue as many temporally blocked launches as fit in the given times, returns the events and the number of steps done"""
+    sim = self.simulation
+    prog = self.program
+    queue = prog.queue
+    block_count = times.size // prog.time_block
+    if block_count == 0:
+      return wait_event, 0
+
+    rotation = prog.get_rotation(sim.iteration)
+    for block in range(block_count):
+      # even launches write to the block buffers, odd launches back
+      kernel = prog.blocked_step_kernels[rotation][block % 2]
+      first_step = block * prog.time_block
+      kernel.set_arg(16, np.uint32(first_step))
+      kernel.set_arg(20, prog.accumulator_type(times[first_step]))
+      wait_event = [cl.enqueue_nd_range_kernel(
+          queue,
+          kernel,
+          prog.block_global_size,
+          prog.block_local_size,
+          wait_for=wait_event)]
+
+    previous, current, _ = prog.rotations[rotation]
+    if block_count % 2 == 1:
+      wait_event = [
+          cl.enqueue_copy(queue, previous, prog.block_previous_buffer,
+                          wait_for=wait_event),
+          cl.enqueue_copy(queue, current, prog.block_pressure_buffer,
+                          wait_for=wait_event),
+      ]
+
+    # the buffers hold (previous, current) of the rotation the blocks started with
+    done_steps = block_count * prog.time_block
+    prog.set_rotation(sim.iteration + done_steps, rotation)
+    return wait_event, done_steps
+
+  def upload_signals(self, signals: np.ndarray) -> List[cl.Event]:
+    """Upload the excitation of all bands for a batch of iterations at once"""
+    prog = self.program
+    prog.ensure_signal_capacity(signals.shape[0])
+    return [cl.enqueue_copy(prog.queue, prog.signal_buffer, signals, is_blocking=False)]
+
+  def enqueue_iteration(self, step: int, time_elapsed: float, wait_event: List[cl.Event]) -> List[cl.Event]:
+    """Enqueue the scheme, analysis and listener recording of an iteration, step is the row in the uploaded signals"""
+    sim = self.simulation
+    grid = self.grid
+    prog = self.program
+    queue = prog.queue
+    iteration = sim.iteration + step
+    rotation = prog.get_rotation(iteration)
+    interior_step_kernel = prog.interior_step_kernels[rotation]
+    scheme_step_kernel = prog.scheme_step_kernels[rotation]
+    analysis_kernel = prog.analysis_kernels[rotation]
+
+    # the signal is read from the uploaded block
+    interior_step_kernel.set_arg(12, np.uint32(step))
+    scheme_step_kernel.set_arg(17, np.uint32(step))
+
+    # set analysis argument
+    time_elapsed = prog.accumulator_type(time_elapsed)
+    if prog.fuse_analysis:
+      interior_step_kernel.set_arg(17, time_elapsed)
+      scheme_step_kernel.set_arg(22, time_elapsed)
+    else:
+      analysis_kernel.set_arg(9, time_elapsed)
+
+    # stream result into right buffer for next kernel run
+    step_events = []
+    if grid.interior_indices.size > 0:
+      step_events.append(cl.enqueue_nd_range_kernel(
+          queue,
+          interior_step_kernel,
+          [grid.interior_indices.size, sim.band_count],
+          None,
+          wait_for=wait_event))
+    if grid.boundary_indices.size > 0:
+      step_events.append(cl.enqueue_nd_range_kernel(
+          queue,
+          scheme_step_kernel,
+          [grid.boundary_indices.size, sim.band_count],
+          None,
+          wait_for=wait_event))
+
+    # the analysis reads the current pressure, so it can run next to the step
+    if not prog.fuse_analysis and grid.air_indices.size > 0:
+      step_events.append(cl.enqueue_nd_range_kernel(
+          queue,
+          analysis_kernel,
+          [grid.air_indices.size, sim.band_count],
+          None,
+          wait_for=wait_event))
+
+    # store the same pressure values the analysis kernel sees
+    record_row = iteration - sim.record_start
+    if 0 <= record_row < sim.record_length and grid.listener_indices.size > 0:
+      history_row_size = sim.band_count * grid.listener_indices.size
+      gather_kernel = prog.gather_kernels[rotation]
+      gather_kernel.set_arg(4, np.uint32(record_row * history_row_size))
+      step_events.append(cl.enqueue_nd_range_kernel(
+          queue,
+          gather_kernel,
+          [grid.listener_indices.size, sim.band_count],
+          None,
+          wait_for=step_events))
+    return step_events
+
+  def enqueue_finalize(self, time_elapsed: float, wait_event: List[cl.Event]) -> List[cl.Event]:
+    """Leq and other decibel values use the sums of the last iteration"""
+    prog = self.program
+    if not prog.use_finalize or self.grid.air_indices.size == 0:
+      return wait_event
+    prog.finalize_kernel.set_arg(5, prog.accumulator_type(time_elapsed))
+    return [cl.enqueue_nd_range_kernel(
+        prog.queue,
+        prog.finalize_kernel,
+        [self.grid.air_indices.size, self.simulation.band_count],
+        None,
+        wait_for=wait_event)]
+
+  def create_pinned_array(self, shape, dtype) -> np.ndarray:
+    """Host array in page locked memory of the device, transfers into it do not need an extra copy"""
+    prog = self.program
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    buffer = cl.Buffer(prog.ctx, cl.mem_flags.READ_WRITE |
+                       cl.mem_flags.ALLOC_HOST_PTR, size=max(1, size))
+    # the buffer stays mapped, the array is only used as copy destination
+    array, _ = cl.enqueue_map_buffer(prog.queue, buffer, cl.map_flags.READ | cl.map_flags.WRITE,
+                                     0, shape, dtype, is_blocking=True)
+    self.snapshot_buffers.append(buffer)
+    return array
+
+  def get_snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+    """The (pressure, analysis) snapshot for the next asynchronous step, in turns"""
+    sim = self.simulation
+    prog = self.program
+    if len(self.snapshots) == 0:
+      self.snapshots = [
+          (self.create_pinned_array((sim.band_count, *self.grid.grid_shape), prog.real_type),
+           self.create_pinned_array((sim.band_count, *self.grid.analysis_shape), prog.accumulator_type))
+          for _ in range(2)]
+    snapshot = self.snapshots[self.snapshot_index]
+    self.snapshot_index = (self.snapshot_index + 1) % len(self.snapshots)
+    return snapshot
+
+  def enqueue_step(self, times: np.ndarray, signals: np.ndarray) -> Tuple[List[cl.Event], cl.Buffer]:
+    """Enqueue all iterations of a step, returns the events and the buffer with the pressure of the last iteration"""
+    sim = self.simulation
+    step_count = times.size
+    prog = self.program
+
+    wait_event = self.upload_signals(signals)
+
+    # temporal blocking, not used while single iterations are recorded
+    first_step = 0
+    if prog.time_block > 1 and sim.iteration >= sim.record_start + sim.record_length:
+      wait_event, first_step = self.enqueue_blocked_steps(times, wait_event)
+
+    for i in range(first_step, step_count):
+      wait_event = self.enqueue_iteration(i, times[i], wait_event)
+
+    wait_event = self.enqueue_finalize(times[-1], wait_event)
+
+    rotation = prog.get_rotation(sim.iteration + step_count - 1)
+    _, current_buffer, _ = prog.rotations[rotation]
+    return wait_event, current_buffer
+
+  def reduce_listeners(self, metric_index: int) -> np.ndarray:
+    sim = self.simulation
+    prog = self.program
+    reduction = np.empty(shape=(sim.band_count, 4), dtype=prog.accumulator_type)
+    if prog.listener_count == 0:
+      reduction[:] = (0.0, np.inf, -np.inf, 0.0)
+      return reduction
+    prog.reduce_listeners_kernel.set_arg(4, np.uint32(metric_index))
+    reduce_event = cl.enqueue_nd_range_kernel(
+        prog.queue, prog.reduce_listeners_kernel, [prog.reduction_size, sim.band_count], [prog.reduction_size, 1])
+    cl.enqueue_copy(prog.queue, reduction, prog.listener_reduction_buffer,
+                    wait_for=[reduce_event], is_blocking=True)
+    return reduction
+
+  def reset_band_statistics(self) -> None:
+    prog = self.program
+    cl.wait_for_events([
+        cl.enqueue_fill_buffer(prog.queue, buffer, prog.accumulator_type(0), 0, buffer.size)
+        for buffer in (prog.band_mean_buffer, prog.band_m2_buffer)])
+
+  def accumulate_band_statistics(self, metric_index: int, band_count: int, count: int) -> None:
+    prog = self.program
+    if self.grid.air_indices.size == 0:
+      return
+    kernel = prog.band_statistics_kernel
+    kernel.set_arg(3, np.uint32(metric_index))
+    kernel.set_arg(5, np.uint32(band_count))
+    kernel.set_arg(6, np.uint32(count))
+    cl.enqueue_nd_range_kernel(
+        prog.queue, kernel, [self.grid.air_indices.size], None).wait()
+
+  def read_band_statistics(self) -> Tuple[np.ndarray, np.ndarray]:
+    prog = self.program
+    statistics = [np.empty(shape=self.grid.grid_shape, dtype=prog.accumulator_type)
+                  for _ in range(2)]
+    cl.wait_for_events([
+        cl.enqueue_copy(prog.queue, values, buffer, is_blocking=False)
+        for values, buffer in zip(statistics, (prog.band_mean_buffer, prog.band_m2_buffer))])
+    return statistics[0], statistics[1]
+
+  def enqueue_listener_readback(self, current_buffer: cl.Buffer, wait_event: List[cl.Event], pressure: np.ndarray = None, analysis: np.ndarray = None) -> List[cl.Event]:
+    """Gather the listener cells on the device, only the compact values are copied. By default into the listener arrays
+    of the simulation, or into the given (band, listener) pressure and (band, metric, listener) analysis arrays."""
+    sim = self.simulation
+    prog = self.program
+    if prog.listener_count == 0:
+      return wait_event
+    pressure = sim.listener_pressure if pressure is None else pressure
+    analysis = sim.listener_analysis if analysis is None else analysis
+    prog.listener_pressure_kernel.set_arg(0, current_buffer)
+    gather_events = [
+        cl.enqueue_nd_range_kernel(prog.queue, prog.listener_pressure_kernel,
+                                   [prog.listener_count, sim.band_count], None, wait_for=wait_event),
+        cl.enqueue_nd_range_kernel(prog.queue, prog.listener_analysis_kernel,
+                                   [prog.listener_count, sim.band_count * self.grid.analysis_values], None, wait_for=wait_event),
+    ]
+    return [
+        cl.enqueue_copy(prog.queue, pressure, prog.listener_pressure_buffer,
+                        wait_for=gather_events, is_blocking=False),
+        cl.enqueue_copy(prog.queue, analysis, prog.listener_analysis_buffer,
+                        wait_for=gather_events, is_blocking=False),
+    ]
+
+  def enqueue_region_readback(self, current_buffer: cl.Buffer, wait_event: List[cl.Event], region=None, w_offset: int = 0) -> List[cl.Event]:
+    """Copy a region of every band and metric into the band arrays, by default the readback region into the same place.
+    The region is in the cells of the grid of this backend, w_offset is the width of its first cell in the band arrays."""
+    sim = self.simulation
+    (w_min, w_max), (h_min, h_max), (d_min, d_max) = sim.readback_region if region is None else region
+    (width, height, depth) = self.grid.grid_shape
+    host_width = sim.grid.width_parts
+    events = []
+    for array, buffer in ((sim.band_pressure, current_buffer), (sim.band_analysis, self.program.analysis_buffer)):
+      itemsize = array.itemsize
+      pitches = (depth * itemsize, height * depth * itemsize)
+      copy_region = ((d_max - d_min) * itemsize, h_max - h_min, w_max - w_min)
+      # (band) or (band, metric) rows of whole grids follow each other
+      for row in range(array.size // sim.grid.grid_size):
+        buffer_origin = (d_min * itemsize, h_min, row * width + w_min)
+        host_origin = (d_min * itemsize, h_min,
+                       row * host_width + w_min + w_offset)
+        events.append(cl.enqueue_copy(self.program.queue, array, buffer, buffer_origin=buffer_origin, host_origin=host_origin,
+                                      region=copy_region, buffer_pitches=pitches, host_pitches=pitches, wait_for=wait_event, is_blocking=False))
+    return events
+
+  def step(self, times: np.ndarray, signals: np.ndarray) -> None:
+    sim = self.simulation
+    prog = self.program
+    queue = self.program.queue
+    args = {
+        "is_blocking": False,
+    }
+    wait_event, current_buffer = self.enqueue_step(times, signals)
+
+    # write back to host
+    if sim.readback == READBACK_FULL:
+      final_events = [
+          cl.enqueue_copy(queue, sim.band_pressure, current_buffer,
+                          wait_for=wait_event, **args),
+          cl.enqueue_copy(
+              queue, sim.band_analysis, prog.analysis_buffer, wait_for=wait_event, **args)
+      ]
+    elif sim.readback == READBACK_LISTENERS:
+      final_events = self.enqueue_listener_readback(current_buffer, wait_event)
+    elif sim.readback == READBACK_REGION:
+      final_events = self.enqueue_region_readback(current_buffer, wait_event)
+    else:
+      final_events = wait_event
+
+    # make sure event is done before processing data further!
+    cl.wait_for_events(final_events)
+
+  def step_async(self, times: np.ndarray, signals: np.ndarray) -> StepFuture:
+    sim = self.simulation
+    prog = self.program
+    wait_event, current_buffer = self.enqueue_step(times, signals)
+
+    # the device continues with the next step while the host reads this snapshot
+    pressure, analysis = self.get_snapshot()
+    events = [
+        cl.enqueue_copy(prog.queue, pressure, current_buffer,
+                        wait_for=wait_event, is_blocking=False),
+        cl.enqueue_copy(prog.queue, analysis, prog.analysis_buffer,
+                        wait_for=wait_event, is_blocking=False),
+    ]
+    prog.queue.flush()
+    return OpenCLStepFuture(pressure, analysis, sim.iteration + times.size,
+                            times[-1] + sim.parameters.dt, events)
@@ -0,0 +1,95 @@
+import hashlib
+import os
+from typing import Dict, List, Tuple
+
+import pyopencl as cl
+
+# built programs of this process by (context, program key)
+PROGRAM_CACHE: Dict[Tuple[int, str], cl.Program] = {}
+# the context used when a program gets none, per process since a forked worker cannot use the context of its parent
+DEFAULT_CONTEXTS: Dict[int, cl.Context] = {}
+
+
+def get_cache_directory() -> str:
+  """Directory of the program binaries, FDTD_KERNEL_CACHE overrides it and an empty value disables the disk cache"""
+  return os.environ.get("FDTD_KERNEL_CACHE", os.path.join(
+      os.path.expanduser("~"), ".cache", "fdtd_kernels"))
+
+
+def get_default_context() -> cl.Context:
+  """A single context for all simulations of a process"""
+  pid = os.getpid()
+  if pid not in DEFAULT_CONTEXTS:
+    DEFAULT_CONTEXTS.clear()
+    PROGRAM_CACHE.clear()
+    DEFAULT_CONTEXTS[pid] = cl.create_some_context(interactive=False)
+  return DEFAULT_CONTEXTS[pid]
+
+
+def get_program_key(source: str, options: List[str], device: cl.Device) -> str:
+  """Hash of everything the binary depends on: source, build options, device and driver"""
+  key = hashlib.sha256()
+  for part in [source, *options, device.name, device.vendor, device.version, device.driver_version,
+               device.platform.version, ".".join(map(str, cl.VERSION))]:
+    key.update(part.encode("utf-8"))
+    key.update(b"\0")
+  return key.hexdigest()
+
+
+def load_binary_program(ctx: cl.Context, paths: List[str], options: List[str]) -> cl.Program:
+  """Build a program from the stored binaries of the devices of a context, None if one is missing or the driver rejects them"""
+  if not all(os.path.exists(path) for path in paths):
+    return None
+  binaries = []
+  for path in paths:
+    with open(path, "rb") as file:
+      binaries.append(file.read())
+  try:
+    return cl.Program(ctx, ctx.devices, binaries).build(options=options)
+  except cl.Error:
+    return None
+
+
+def store_binary_program(program: cl.Program, paths: Dict[int, str]) -> None:
+  """Store the binary of every device of a program, paths are by device pointer"""
+  binaries = program.get_info(cl.program_info.BINARIES)
+  devices = program.get_info(cl.program_info.DEVICES)
+  for device, binary in zip(devices, binaries):
+    if len(binary) == 0:
+      continue
+    path = paths[device.int_ptr]
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      # written next to the final file first, so concurrent workers never read a partial binary
+      temporary_path = f'{path}.{os.getpid()}.tmp'
+      with open(temporary_path, "wb") as file:
+        file.write(binary)
+      os.replace(temporary_path, path)
+    except OSError:
+      # the cache is an optimization, a read only home directory only costs a compile
+      pass
+
+
+def build_program(ctx: cl.Context, source: str, options: List[str]) -> cl.Program:
+  """Get a built program, from the cache of this process, the binaries on disk or by compiling the source"""
+  # a binary only runs on the device it was built for, so every device of the context has its own
+  keys = [get_program_key(source, options, device) for device in ctx.devices]
+  memory_key = (ctx.int_ptr, "".join(keys))
+  if memory_key in PROGRAM_CACHE:
+    return PROGRAM_CACHE[memory_key]
+
+  cache_directory = get_cache_directory()
+  paths = [os.path.join(cache_directory, f'{key}.bin')
+           for key in keys] if cache_directory else None
+  program = load_binary_program(ctx, paths, options) if paths else None
+  if program is None:
+    # show the compiler warnings of the kernels, unless the environment says otherwise
+    os.environ.setdefault('PYOPENCL_COMPILER_OUTPUT', '1')
+    program = cl.Program(ctx, source).build(options=options)
+    if paths:
+      store_binary_program(program, {device.int_ptr: path
+                                     for device, path in zip(ctx.devices, paths)})
+
+  # the context is kept alive by its programs, so its pointer is not reused
+  PROGRAM_CACHE[memory_key] = program
+  return program
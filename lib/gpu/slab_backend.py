@@ -0,0 +1,322 @@
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import pyopencl as cl
+from lib.gpu.opencl_backend import OpenCLBackend
+from lib.gpu.program_cache import get_default_context
+from lib.simulation_backend import READBACK_FULL, READBACK_LISTENERS, READBACK_REGION, SimulationBackend, StepFuture
+
+
+# context of this process, reused so the programs built for it are too
+SLAB_CONTEXTS: Dict[int, cl.Context] = {}
+
+
+def get_slab_context() -> cl.Context:
+  """One context with all devices of the platform of the default context, the slabs get a queue each.
+  Sharing the context lets the halo copies of one slab wait for the events of its neighbours."""
+  pid = os.getpid()
+  if pid not in SLAB_CONTEXTS:
+    SLAB_CONTEXTS.clear()
+    platform = get_default_context().devices[0].platform
+    SLAB_CONTEXTS[pid] = cl.Context(platform.get_devices())
+  return SLAB_CONTEXTS[pid]
+
+
+class SlabBackend(SimulationBackend):
+  """Splits the grid into slabs along the width axis, every slab runs on its own queue, round-robin over the devices.
+  After every iteration the slabs exchange the pressure of their outer planes through the host."""
+
+  def __init__(self, simulation, slab_count: int, fuse_analysis: bool = False) -> None:
+    super().__init__(simulation)
+    grid = simulation.grid
+    if 2 * slab_count > grid.width_parts:
+      raise ValueError(
+          f"Cannot split {grid.width_parts} cells into {slab_count} slabs of at least two cells")
+
+    widths = np.array_split(np.arange(grid.width_parts), slab_count)
+    ctx = get_slab_context()
+    self.slabs: List[OpenCLBackend] = []
+    for slab, width in enumerate(widths):
+      slab_grid = grid.create_slab(int(width[0]), int(width[-1]) + 1)
+      self.slabs.append(OpenCLBackend(
+          simulation, fuse_analysis, grid=slab_grid, ctx=ctx, device=ctx.devices[slab % len(ctx.devices)]))
+
+    # host staging of the exchanged planes as (band, plane row, cell). Row slot and slot + 1 hold the first and last
+    # owned plane of a slab, the even slabs come first and the odd slabs after them. Like that the planes a slab sends
+    # and the halo planes it receives (last plane of the left, first plane of the right neighbour) are adjacent rows.
+    pressure_dtype = simulation.parameters.pressure_dtype
+    self.plane_size = grid.height_parts * grid.depth_parts
+    self.itemsize = np.dtype(pressure_dtype).itemsize
+    self.exchange_values = np.zeros(
+        shape=(simulation.band_count, 2 * slab_count, self.plane_size), dtype=pressure_dtype)
+    odd_slot = 2 * ((slab_count + 1) // 2)
+    slots = [slab if slab % 2 == 0 else odd_slot + slab - 1
+             for slab in range(slab_count)]
+
+    # per slab the (first, end) rows it sends and receives and the slab cells of these rows
+    self.send_rows = []
+    self.receive_rows = []
+    self.send_kernels: List[cl.Kernel] = []
+    self.receive_kernels: List[cl.Kernel] = []
+    self.send_buffers: List[cl.Buffer] = []
+    self.receive_buffers: List[cl.Buffer] = []
+    self.index_buffers: List[cl.Buffer] = []
+    for index, slab in enumerate(self.slabs):
+      has_left = index > 0
+      has_right = index < slab_count - 1
+      first_owned = slab.grid.slab_offset
+      last_owned = first_owned + slab.grid.slab_range[1] - slab.grid.slab_range[0] - 1
+      send_planes = [first_owned] * has_left + [last_owned] * has_right
+      receive_planes = [0] * has_left + [slab.grid.width_parts - 1] * has_right
+      self.send_rows.append((slots[index] + (not has_left),
+                             slots[index] + 1 + has_right))
+      receive_first = slots[index - 1] + 1 if has_left else slots[index + 1]
+      self.receive_rows.append(
+          (receive_first, receive_first + len(receive_planes)))
+
+      self.send_kernels.append(self.create_plane_kernel(
+          slab, "gather_cells", send_planes, self.send_buffers))
+      self.receive_kernels.append(self.create_plane_kernel(
+          slab, "scatter_cells", receive_planes, self.receive_buffers))
+      self.send_kernels[-1].set_arg(2, self.send_buffers[-1])
+      self.send_kernels[-1].set_arg(4, np.uint32(0))
+      self.receive_kernels[-1].set_arg(0, self.receive_buffers[-1])
+
+  def create_plane_kernel(self, slab: OpenCLBackend, name: str, planes: List[int], buffers: List[cl.Buffer]) -> cl.Kernel:
+    """Gather or scatter kernel over the cells of whole planes of a slab, with a compact (band, cell) buffer for them"""
+    prog = slab.program
+    indices = np.concatenate([np.arange(plane * self.plane_size, (plane + 1) * self.plane_size, dtype="uint32")
+                              for plane in planes])
+    self.index_buffers.append(prog.create_index_buffer(indices))
+    buffers.append(cl.Buffer(prog.ctx, cl.mem_flags.READ_WRITE,
+                             size=self.simulation.band_count * indices.size * self.itemsize))
+    kernel = cl.Kernel(prog.cl_program, name)
+    kernel.set_arg(1, self.index_buffers[-1])
+    kernel.set_arg(3, np.uint32(slab.grid.grid_size))
+    return kernel
+
+  def get_name(self) -> str:
+    devices = [slab.program.device.name for slab in self.slabs]
+    return f'{len(self.slabs)} slabs ({", ".join(sorted(set(devices)))})'
+
+  def get_halo_range(self, slab: OpenCLBackend):
+    return slice(*slab.grid.halo_range)
+
+  def sync_read_buffers(self, beta_cells_only: bool = False) -> None:
+    sim = self.simulation
+    for slab in self.slabs:
+      prog = slab.program
+      halo = self.get_halo_range(slab)
+      events = [cl.enqueue_copy(
+          prog.queue, prog.geometry_buffer, slab.grid.geometry)]
+      if beta_cells_only:
+        events.extend(slab.upload_beta_cells(
+            sim.band_beta[:, halo].reshape(sim.band_count, -1)))
+      else:
+        events.append(cl.enqueue_copy(prog.queue, prog.beta_buffer,
+                                      np.ascontiguousarray(sim.band_beta[:, halo])))
+      cl.wait_for_events(events)
+
+  def sync_pressure_buffers(self) -> None:
+    sim = self.simulation
+    for slab in self.slabs:
+      prog = slab.program
+      halo = self.get_halo_range(slab)
+      cl.wait_for_events([
+          cl.enqueue_copy(prog.queue, prog.pressure_previous_buffer,
+                          np.ascontiguousarray(sim.band_pressure_previous[:, halo])),
+          cl.enqueue_copy(prog.queue, prog.pressure_next_buffer,
+                          np.ascontiguousarray(sim.band_pressure_next[:, halo])),
+          cl.enqueue_copy(prog.queue, prog.pressure_buffer,
+                          np.ascontiguousarray(sim.band_pressure[:, halo])),
+          cl.enqueue_copy(prog.queue, prog.analysis_buffer,
+                          np.ascontiguousarray(sim.band_analysis[:, :, halo])),
+      ])
+
+  def reset(self) -> None:
+    for slab in self.slabs:
+      slab.reset()
+
+  def record_listeners(self, step_count: int) -> None:
+    for slab in self.slabs:
+      slab.record_listeners(step_count)
+
+  def get_listener_history(self) -> np.ndarray:
+    # listener indices are sorted, so the slabs hold consecutive listeners
+    return np.concatenate([slab.get_listener_history() for slab in self.slabs], axis=2)
+
+  def read_state(self) -> List[np.ndarray]:
+    sim = self.simulation
+    pressure = [np.empty_like(sim.band_pressure) for _ in range(3)]
+    for slab in self.slabs:
+      w_min, w_max = slab.grid.slab_range
+      owned = slice(slab.grid.slab_offset,
+                    slab.grid.slab_offset + w_max - w_min)
+      for values, slab_values in zip(pressure, slab.read_state()):
+        values[:, w_min:w_max] = slab_values[:, owned]
+    return pressure
+
+  def write_state(self, pressure: List[np.ndarray]) -> None:
+    sim = self.simulation
+    for values, host in zip(pressure, (sim.band_pressure_previous, sim.band_pressure, sim.band_pressure_next)):
+      np.copyto(host, values)
+    for slab in self.slabs:
+      slab.program.set_rotation(sim.iteration, 0)
+    self.sync_pressure_buffers()
+
+  def enqueue_plane_copy(self, slab: int, rows, buffer: cl.Buffer, is_send: bool, wait_for: List[cl.Event]) -> cl.Event:
+    """Copy the exchanged rows of all bands between the compact buffer of a slab and the host staging"""
+    band_count = self.simulation.band_count
+    row_bytes = (rows[1] - rows[0]) * self.plane_size * self.itemsize
+    host_row_bytes = self.exchange_values.shape[1] * self.plane_size * self.itemsize
+    args = {
+        "buffer_origin": (0, 0, 0),
+        "host_origin": (rows[0] * self.plane_size * self.itemsize, 0, 0),
+        "region": (row_bytes, band_count, 1),
+        "buffer_pitches": (row_bytes, row_bytes * band_count),
+        "host_pitches": (host_row_bytes, host_row_bytes * band_count),
+        "wait_for": wait_for,
+        "is_blocking": False,
+    }
+    queue = self.slabs[slab].program.queue
+    if is_send:
+      return cl.enqueue_copy(queue, self.exchange_values, buffer, **args)
+    return cl.enqueue_copy(queue, buffer, self.exchange_values, **args)
+
+  def exchange_halos(self, iteration: int, events: List[List[cl.Event]], writes: List[List[cl.Event]]) -> List[List[cl.Event]]:
+    """Copy the outer owned planes of the pressure written by an iteration into the halo of the neighbouring slabs.
+    Every slab sends and receives all its planes with one copy each, the copies wait for the events of the
+    neighbours, so nothing waits on the host. writes are the receive events of the previous iteration, which
+    read the staging rows that are sent again."""
+    slab_count = len(self.slabs)
+    reads = []
+    for index, slab in enumerate(self.slabs):
+      prog = slab.program
+      buffer = prog.rotations[prog.get_rotation(iteration)][2]
+      kernel = self.send_kernels[index]
+      kernel.set_arg(0, buffer)
+      cell_count = (self.send_rows[index][1] -
+                    self.send_rows[index][0]) * self.plane_size
+      gather_event = cl.enqueue_nd_range_kernel(
+          prog.queue, kernel, [cell_count, self.simulation.band_count], None, wait_for=events[index])
+      neighbour_writes = [event for neighbour in (index - 1, index + 1) if 0 <= neighbour < slab_count
+                          for event in writes[neighbour]]
+      reads.append(self.enqueue_plane_copy(
+          index, self.send_rows[index], self.send_buffers[index], True, [gather_event, *neighbour_writes]))
+
+    received: List[List[cl.Event]] = []
+    for index, slab in enumerate(self.slabs):
+      prog = slab.program
+      neighbour_reads = [reads[neighbour] for neighbour in (
+          index - 1, index + 1) if 0 <= neighbour < slab_count]
+      write_event = self.enqueue_plane_copy(
+          index, self.receive_rows[index], self.receive_buffers[index], False, neighbour_reads)
+      kernel = self.receive_kernels[index]
+      kernel.set_arg(2, prog.rotations[prog.get_rotation(iteration)][2])
+      cell_count = (self.receive_rows[index][1] -
+                    self.receive_rows[index][0]) * self.plane_size
+      received.append([cl.enqueue_nd_range_kernel(
+          prog.queue, kernel, [cell_count, self.simulation.band_count], None, wait_for=[write_event, *events[index]])])
+
+    # the queues have to be submitted, a queue may wait for the commands of another
+    for slab in self.slabs:
+      slab.program.queue.flush()
+    return received
+
+  def enqueue_step(self, times: np.ndarray, signals: np.ndarray) -> List[List[cl.Event]]:
+    """Enqueue all iterations of a step on every slab, returns the events per slab"""
+    sim = self.simulation
+    events = [slab.upload_signals(signals) for slab in self.slabs]
+
+    writes: List[List[cl.Event]] = [[] for _ in self.slabs]
+    for i in range(times.size):
+      events = [slab.enqueue_iteration(i, times[i], slab_events)
+                for slab, slab_events in zip(self.slabs, events)]
+      writes = self.exchange_halos(sim.iteration + i, events, writes)
+      events = [slab_events + slab_writes for slab_events,
+                slab_writes in zip(events, writes)]
+    return [slab.enqueue_finalize(times[-1], slab_events)
+            for slab, slab_events in zip(self.slabs, events)]
+
+  def read_back(self, readback: str, iteration: int, events: List[List[cl.Event]]) -> None:
+    """Copy the values of a readback from the owned part of every slab, iteration is the last one of the step"""
+    sim = self.simulation
+    (_, height, depth) = sim.grid.grid_shape
+    final_events = []
+    listener_values = []
+    for slab, slab_events in zip(self.slabs, events):
+      prog = slab.program
+      _, current_buffer, _ = prog.rotations[prog.get_rotation(iteration)]
+      w_min, w_max = slab.grid.slab_range
+      # widths in the slab are shifted by the halo
+      w_offset = w_min - slab.grid.slab_offset
+      if readback == READBACK_FULL:
+        final_events.extend(slab.enqueue_region_readback(
+            current_buffer, slab_events, ((w_min - w_offset, w_max - w_offset), (0, height), (0, depth)), w_offset))
+      elif readback == READBACK_REGION:
+        (region_min, region_max), *other = sim.readback_region
+        region_min, region_max = max(region_min, w_min), min(region_max, w_max)
+        if region_min < region_max:
+          final_events.extend(slab.enqueue_region_readback(
+              current_buffer, slab_events, ((region_min - w_offset, region_max - w_offset), *other), w_offset))
+      elif readback == READBACK_LISTENERS:
+        values = (np.empty(shape=(sim.band_count, prog.listener_count), dtype=sim.listener_pressure.dtype),
+                  np.empty(shape=(sim.band_count, slab.grid.analysis_values, prog.listener_count), dtype=sim.listener_analysis.dtype))
+        listener_values.append(values)
+        final_events.extend(slab.enqueue_listener_readback(
+            current_buffer, slab_events, *values))
+      else:
+        final_events.extend(slab_events)
+    cl.wait_for_events(final_events)
+
+    # listener indices are sorted, so the slabs hold consecutive listeners
+    if readback == READBACK_LISTENERS:
+      sim.listener_pressure[:] = np.concatenate(
+          [pressure for pressure, _ in listener_values], axis=1)
+      sim.listener_analysis[:] = np.concatenate(
+          [analysis for _, analysis in listener_values], axis=2)
+
+  def step(self, times: np.ndarray, signals: np.ndarray) -> None:
+    events = self.enqueue_step(times, signals)
+    self.read_back(self.simulation.readback,
+                   self.simulation.iteration + times.size - 1, events)
+
+  def step_async(self, times: np.ndarray, signals: np.ndarray) -> StepFuture:
+    # the snapshot is a copy of all values, whatever the readback of step is
+    sim = self.simulation
+    events = self.enqueue_step(times, signals)
+    self.read_back(READBACK_FULL, sim.iteration + times.size - 1, events)
+    return StepFuture(sim.band_pressure.copy(), sim.band_analysis.copy(),
+                      sim.iteration + times.size, times[-1] + sim.parameters.dt)
+
+  def reduce_listeners(self, metric_index: int) -> np.ndarray:
+    # the slabs reduce their own listeners, the partial reductions combine
+    reductions = np.stack([slab.reduce_listeners(metric_index)
+                          for slab in self.slabs]).astype("float64")
+    return np.stack([
+        np.sum(reductions[:, :, 0], axis=0),
+        np.min(reductions[:, :, 1], axis=0),
+        np.max(reductions[:, :, 2], axis=0),
+        np.sum(reductions[:, :, 3], axis=0),
+    ], axis=1)
+
+  def reset_band_statistics(self) -> None:
+    for slab in self.slabs:
+      slab.reset_band_statistics()
+
+  def accumulate_band_statistics(self, metric_index: int, band_count: int, count: int) -> None:
+    for slab in self.slabs:
+      slab.accumulate_band_statistics(metric_index, band_count, count)
+
+  def read_band_statistics(self) -> Tuple[np.ndarray, np.ndarray]:
+    statistics = [np.zeros(shape=self.simulation.grid.grid_shape, dtype="float64")
+                  for _ in range(2)]
+    for slab in self.slabs:
+      w_min, w_max = slab.grid.slab_range
+      owned = slice(slab.grid.slab_offset,
+                    slab.grid.slab_offset + w_max - w_min)
+      for values, slab_values in zip(statistics, slab.read_band_statistics()):
+        values[w_min:w_max] = slab_values[owned]
+    return statistics[0], statistics[1]
@@ -1,3 +1,4 @@
+import copy
 import math
 import sys
 from typing import Tuple, List
@@ -6,6 +7,7 @@ import numpy as np
 from numba import njit, prange, float64
 from numba.experimental import jitclass
 
+from lib.analysis.metrics import ANALYSIS_METRICS, DEFAULT_METRICS, resolve_metrics
 from lib.parameters import SimulationParameters
 
 BIT_0 = 1 << 0
@@ -41,6 +43,10 @@ SOURCE_FLAG = BIT_1
 SOURCE_REGION_FLAG = BIT_2
 LISTENER_FLAG = BIT_3
 
+K1_BITMASK = BIT_6 - 1
+K2_BITMASK = BIT_18 - 1 - K1_BITMASK
+K3_BITMASK = BIT_26 - 1 - K1_BITMASK - K2_BITMASK
+
 BASE_BETA = 0.01
 
 
@@ -97,33 +103,53 @@ class SimulationGrid:
     self.geometry = self.create_grid("uint8")
     self.neighbours = self.create_grid("uint32")
 
-    self.pressure = self.create_grid("float64")
-    self.pressure_previous = self.create_grid("float64")
-    self.pressure_next = self.create_grid("float64")
-
-    self.analysis_keys = {
-        'PRESSURE': 0,
-        'RMS': 1,
-        'LEQ': 2,
-        'EWMA': 3,
-        'EWMA_L': 4,
-        '_TEST': 5,
-    }
-    self.analysis_values = len(self.analysis_keys)
-    # Leq, RMS, ERMS, ...
-    self.analysis_shape = (self.width_parts, self.height_parts,
-                           self.depth_parts, self.analysis_values)
-    self.analysis = np.zeros(shape=self.analysis_shape, dtype="float64")
-    self.beta = self.create_grid("float64")
-
-    float64_buffers = 5 + self.analysis_values
-    int8_buffers = 2
-    self.storage_estimate = self.grid_size * (float64_buffers*8 + int8_buffers)
-    self.source_set: List[Tuple[int, int, int]] = []
+    self.pressure = self.create_grid(parameters.pressure_dtype)
+    self.pressure_previous = self.create_grid(parameters.pressure_dtype)
+    self.pressure_next = self.create_grid(parameters.pressure_dtype)
+
+    self.beta = self.create_grid(parameters.pressure_dtype)
+
+    self.set_analysis_metrics(DEFAULT_METRICS)
+
+    # (w, h, d) of every cell in a source region
+    self.source_set = np.zeros(shape=(0, 3), dtype="int32")
     self.source_count = -1
     self.listener_count = -1
+    self.listener_indices = np.zeros(shape=(0,), dtype="uint32")
+    self.air_indices = np.zeros(shape=(0,), dtype="uint32")
+    self.interior_indices = np.zeros(shape=(0,), dtype="uint32")
+    self.boundary_indices = np.zeros(shape=(0,), dtype="uint32")
+    self.wall_mask = np.zeros(shape=self.grid_shape, dtype="bool")
     self.is_build = False
 
+    # beta of every wall region (fill_region call), in the order mark_regions sets them
+    self.region_betas: List[float] = []
+    self.region_count = 0
+    # last wall region that set the beta of a cell, only used until the build
+    self.beta_regions = np.full(shape=self.grid_shape, fill_value=-1, dtype="int32")
+    # air cells of which the beta depends on the materials, the flat wall cells
+    # they read the beta of and the region of those walls
+    self.beta_cells = np.zeros(shape=(0,), dtype="uint32")
+    self.surface_cells = np.zeros(shape=(0,), dtype="int64")
+    self.surface_regions = np.zeros(shape=(0,), dtype="int32")
+
+  def set_analysis_metrics(self, metrics) -> None:
+    """Only allocate the enabled analysis metrics (and their requirements), stored as one grid per metric"""
+    enabled = resolve_metrics(metrics)
+    self.analysis_keys = {key: index for index, key in enumerate(enabled)}
+    self.analysis_values = len(self.analysis_keys)
+    self.analysis_shape = (self.analysis_values, self.width_parts,
+                           self.height_parts, self.depth_parts)
+    self.analysis = np.zeros(shape=self.analysis_shape,
+                             dtype=self.parameters.analysis_dtype)
+
+    # pressure (3x) and beta, analysis values, neighbours and geometry
+    pressure_bytes = 4 * np.dtype(self.parameters.pressure_dtype).itemsize
+    analysis_bytes = self.analysis_values * \
+        np.dtype(self.parameters.analysis_dtype).itemsize
+    self.storage_estimate = self.grid_size * \
+        (pressure_bytes + analysis_bytes + 4 + 1)
+
   def get_storage_str(self) -> str:
     suffix = "B"
     num = self.storage_estimate
@@ -146,6 +172,17 @@ class SimulationGrid:
     self.pressure_previous.fill(0.0)
     self.pressure_next.fill(0.0)
     self.analysis.fill(0.0)
+    self.mark_walls(self.pressure, self.pressure_previous,
+                    self.pressure_next, self.analysis)
+
+  def mark_walls(self, pressure: np.ndarray, pressure_previous: np.ndarray, pressure_next: np.ndarray, analysis: np.ndarray) -> None:
+    """Walls are never simulated, so their values are set once (over the last axes of the arrays)"""
+    wall_mask = self.wall_mask
+    for values in (pressure, pressure_previous, pressure_next):
+      values[..., wall_mask] = math.nan
+    for key, index in self.analysis_keys.items():
+      if ANALYSIS_METRICS[key].is_decibel:
+        analysis[..., index, wall_mask] = math.nan
 
   def fill_region(self, w_min=0.0, w_max=float("inf"), h_min=0.0, h_max=float("inf"), d_min=0.0, d_max=float("inf"), geometry_flag=WALL_FLAG, beta=0.5) -> None:
     d_min_int = clamp(self.scale(d_min), 0, self.depth_parts - 1)
@@ -156,12 +193,27 @@ class SimulationGrid:
     w_max_int = clamp(self.scale(w_max), w_min_int + 1, self.width_parts)
 
     set_beta = geometry_flag & WALL_FLAG > 0
-    for d in range(d_min_int, d_max_int):
-      for h in range(h_min_int, h_max_int):
-        for w in range(w_min_int, w_max_int):
-          self.geometry[w, h, d] |= geometry_flag
-          if set_beta:
-            self.beta[w, h, d] = beta
+    region = len(self.region_betas)
+    if set_beta:
+      self.region_betas.append(beta)
+    if self.is_build:
+      # the geometry is fixed once build, rebuild applies the region betas
+      return
+
+    cells = (slice(w_min_int, w_max_int), slice(
+        h_min_int, h_max_int), slice(d_min_int, d_max_int))
+    self.geometry[cells] |= geometry_flag
+    if set_beta:
+      self.beta[cells] = beta
+      self.beta_regions[cells] = region
+
+  def fill_regions(self, boxes, geometry_flag=WALL_FLAG, betas=0.5) -> None:
+    """fill_region for every (w_min, w_max, h_min, h_max, d_min, d_max) box in order, with a beta per box or one for all boxes"""
+    boxes = np.asarray(boxes, dtype="float64").reshape(-1, 6)
+    betas = np.broadcast_to(np.asarray(betas, dtype="float64"), (boxes.shape[0],))
+    for (w_min, w_max, h_min, h_max, d_min, d_max), beta in zip(boxes, betas):
+      self.fill_region(w_min, w_max, h_min, h_max, d_min, d_max,
+                       geometry_flag=geometry_flag, beta=float(beta))
 
   def create_grid(self, dtype) -> np.ndarray:
     """Generalised method to create new nd arrays"""
@@ -183,21 +235,100 @@ class SimulationGrid:
     self.populate_inner_beta()
     self.source_set = get_source_locations(self.geometry)
     self.source_count, self.listener_count = count_locations(self.geometry)
+    self.listener_indices = get_listener_indices(self.geometry)
+    self.wall_mask = self.geometry & WALL_FLAG > 0
+    self.air_indices, self.interior_indices, self.boundary_indices = get_cell_indices(
+        self.geometry, self.neighbours, self.get_required_neighbours())
+    self.find_material_cells()
     self.is_build = True
 
-  def select_source_locations(self, locations: List[Tuple[int, int, int]]) -> None:
+  def get_required_neighbours(self) -> int:
+    """Neighbour flags an air cell needs to be updated without betas, given the scheme"""
+    required = 0
+    if self.parameters.arg_d1 != 0.0:
+      required |= K1_BITMASK
+    if self.parameters.arg_d2 != 0.0:
+      required |= K2_BITMASK
+    if self.parameters.arg_d3 != 0.0:
+      required |= K3_BITMASK
+    return required
+
+  def select_source_locations(self, locations) -> None:
+    """Use the given (w, h, d) positions, as a sequence or (N, 3) array, as the sources"""
     unset_source_flag(self.geometry)
-    for position in locations:
-      p_w, p_h, p_d = position
-      self.geometry[p_w, p_h, p_d] |= SOURCE_FLAG
+    positions = np.asarray(locations, dtype="int64").reshape(-1, 3)
+    self.geometry[positions[:, 0], positions[:, 1],
+                  positions[:, 2]] |= SOURCE_FLAG
 
   def populate_inner_beta(self) -> None:
     populate_inner_betas(self.geometry, self.beta, self.edge_betas,
                          self.parameters.arg_d1, self.parameters.arg_d2, self.parameters.arg_d3)
 
+  def find_material_cells(self) -> None:
+    """Find the cells a change of materials affects: air cells next to walls or the grid edges, and the walls around them"""
+    beta_mask, surface_mask = get_material_cell_masks(
+        self.geometry, self.parameters.arg_d1, self.parameters.arg_d2, self.parameters.arg_d3)
+    self.beta_cells = np.flatnonzero(beta_mask).astype("uint32")
+    beta_regions = self.beta_regions.reshape(-1)
+    self.surface_cells = np.flatnonzero(surface_mask.reshape(-1) & (beta_regions >= 0))
+    self.surface_regions = beta_regions[self.surface_cells]
+    self.region_count = len(self.region_betas)
+    self.region_betas = []
+    self.beta_regions = None
+
   def rebuild(self) -> None:
-    """rebuild the geometry"""
-    self.populate_inner_beta()
+    """Apply the region betas of another mark_regions pass, only the cells found by find_material_cells are updated"""
+    if len(self.region_betas) != self.region_count:
+      raise Exception(
+          f"Expected betas for {self.region_count} regions, got {len(self.region_betas)}")
+    if self.region_count > 0:
+      region_betas = np.array(self.region_betas, dtype=self.beta.dtype)
+      self.beta.reshape(-1)[self.surface_cells] = region_betas[self.surface_regions]
+    populate_cell_betas(self.geometry, self.beta, self.edge_betas, self.parameters.arg_d1,
+                        self.parameters.arg_d2, self.parameters.arg_d3, self.beta_cells)
+    self.region_betas = []
+
+  def create_slab(self, w_min: int, w_max: int) -> "SimulationGrid":
+    """Part of the build grid that updates the cells w_min <= w < w_max, it includes a one cell halo of the neighbouring slabs"""
+    if not self.is_build:
+      raise Exception("Please build the grid before splitting it")
+    halo_min = max(w_min - 1, 0)
+    halo_max = min(w_max + 1, self.width_parts)
+
+    slab = copy.copy(self)
+    # owned widths in the full grid, and the width of the first owned plane in the slab
+    slab.slab_range = (w_min, w_max)
+    slab.slab_offset = w_min - halo_min
+    slab.halo_range = (halo_min, halo_max)
+    slab.width_parts = halo_max - halo_min
+    slab.grid_shape = (slab.width_parts, self.height_parts, self.depth_parts)
+    slab.grid_size = slab.width_parts * self.height_parts * self.depth_parts
+    slab.storage_estimate = self.storage_estimate * slab.grid_size // self.grid_size
+
+    # views of the grid, slicing the first axis keeps them contiguous
+    slab.geometry = self.geometry[halo_min:halo_max]
+    slab.neighbours = self.neighbours[halo_min:halo_max]
+    slab.pressure = self.pressure[halo_min:halo_max]
+    slab.pressure_previous = self.pressure_previous[halo_min:halo_max]
+    slab.pressure_next = self.pressure_next[halo_min:halo_max]
+    slab.beta = self.beta[halo_min:halo_max]
+    slab.wall_mask = self.wall_mask[halo_min:halo_max]
+    slab.analysis = self.analysis[:, halo_min:halo_max]
+    slab.analysis_shape = slab.analysis.shape
+
+    # only owned cells are updated, the halo is written by the neighbouring slabs
+    plane_size = self.height_parts * self.depth_parts
+
+    def to_slab_indices(indices: np.ndarray) -> np.ndarray:
+      is_owned = (indices >= w_min * plane_size) & (indices < w_max * plane_size)
+      return (indices[is_owned] - halo_min * plane_size).astype("uint32")
+
+    slab.listener_indices = to_slab_indices(self.listener_indices)
+    slab.air_indices = to_slab_indices(self.air_indices)
+    slab.interior_indices = to_slab_indices(self.interior_indices)
+    slab.boundary_indices = to_slab_indices(self.boundary_indices)
+    slab.beta_cells = to_slab_indices(self.beta_cells)
+    return slab
 
 
 @njit(parallel=True)
@@ -211,16 +342,24 @@ def unset_source_flag(geometry: np.ndarray) -> None:
   return
 
 
-def get_source_locations(geometry: np.ndarray) -> List[Tuple[int, int, int]]:
-  """Count the number of cells that have the SOURCE_REGION_FLAG set"""
-  source_set: List[Tuple[int, int, int]] = []
+def get_source_locations(geometry: np.ndarray) -> np.ndarray:
+  """Get the (w, h, d) positions of all cells that have the SOURCE_REGION_FLAG set, as an (N, 3) array"""
+  return np.argwhere(geometry & SOURCE_REGION_FLAG).astype("int32")
 
-  for w in prange(geometry.shape[0]):
-    for h in prange(geometry.shape[1]):
-      for d in prange(geometry.shape[2]):
-        if geometry[w, h, d] & SOURCE_REGION_FLAG > 0:
-          source_set.append((w, h, d))
-  return source_set
+
+def get_listener_indices(geometry: np.ndarray) -> np.ndarray:
+  """Get the flat indices of all cells that have the LISTENER_FLAG set"""
+  return np.flatnonzero(geometry & LISTENER_FLAG).astype("uint32")
+
+
+def get_cell_indices(geometry: np.ndarray, neighbours: np.ndarray, required_neighbours: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  """Get the flat indices of all air cells, split into interior cells and cells that border a wall"""
+  is_air = geometry & WALL_FLAG == 0
+  is_interior = neighbours & required_neighbours == required_neighbours
+  air_indices = np.flatnonzero(is_air).astype("uint32")
+  interior_indices = np.flatnonzero(is_air & is_interior).astype("uint32")
+  boundary_indices = np.flatnonzero(is_air & ~is_interior).astype("uint32")
+  return air_indices, interior_indices, boundary_indices
 
 
 @njit(parallel=True)
@@ -342,89 +481,111 @@ def populate_neighbours(geometry: np.ndarray, neighbours: np.ndarray) -> None:
         neighbours[w, h, d] = neighour_flags
 
 
-# @njit(parallel=True)
-def populate_inner_betas(geometry: np.ndarray, beta: np.ndarray, edge_betas: GridEdgeBeta, d1: float, d2: float, d3: float) -> None:
-  """Set neighbour flags for geometry"""
-  points: List[Tuple[int, int, int, float]] = [
-      # D1
-      (-1, 0, 0, d1),
-      (1, 0, 0, d1),
-      (0, -1, 0, d1),
-      (0, 1, 0, d1),
-      (0, 0, 1, d1),
-      (0, 0, -1, d1),
-      # D2
-      (-1, -1, 0, d2),
-      (-1, 1, 0, d2),
-      (1, 1, 0, d2),
-      (1, -1, 0, d2),
-      (0, -1, -1, d2),
-      (0, -1, 1, d2),
-      (0, 1, 1, d2),
-      (0, 1, -1, d2),
-      (-1, 0, -1, d2),
-      (-1, 0, 1, d2),
-      (1, 0, 1, d2),
-      (1, 0, -1, d2),
-      # D3
-      (-1, -1, -1, d3),
-      (-1, -1, 1, d3),
-      (-1, 1, -1, d3),
-      (-1, 1, 1, d3),
-      (1, -1, -1, d3),
-      (1, -1, 1, d3),
-      (1, 1, -1, d3),
-      (1, 1, 1, d3),
-  ]
+# neighbour offsets of the scheme and their stencil group (d1, d2 or d3)
+BETA_NEIGHBOUR_OFFSETS = np.array([
+    # D1
+    (-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, 1), (0, 0, -1),
+    # D2
+    (-1, -1, 0), (-1, 1, 0), (1, 1, 0), (1, -1, 0),
+    (0, -1, -1), (0, -1, 1), (0, 1, 1), (0, 1, -1),
+    (-1, 0, -1), (-1, 0, 1), (1, 0, 1), (1, 0, -1),
+    # D3
+    (-1, -1, -1), (-1, -1, 1), (-1, 1, -1), (-1, 1, 1),
+    (1, -1, -1), (1, -1, 1), (1, 1, -1), (1, 1, 1),
+], dtype=np.int64)
+BETA_NEIGHBOUR_GROUPS = np.array([0] * 6 + [1] * 12 + [2] * 8, dtype=np.int64)
+
+
+@njit
+def get_cell_beta(geometry: np.ndarray, beta: np.ndarray, edge_betas: GridEdgeBeta, factors: np.ndarray, w: int, h: int, d: int) -> Tuple[float, float]:
+  """Weighted sum of the betas of the walls and grid edges around a cell, and the sum of their weights"""
+  reflection_count = 0.0
+  beta_average = 0.0
+  for k in range(BETA_NEIGHBOUR_OFFSETS.shape[0]):
+    abs_fac = factors[BETA_NEIGHBOUR_GROUPS[k]]
+    if abs_fac == 0.0:
+      continue
+    pos_w = w + BETA_NEIGHBOUR_OFFSETS[k, 0]
+    pos_h = h + BETA_NEIGHBOUR_OFFSETS[k, 1]
+    pos_d = d + BETA_NEIGHBOUR_OFFSETS[k, 2]
+
+    if pos_w <= 0:
+      beta_average += edge_betas.width_min * abs_fac
+      reflection_count += abs_fac
+    elif pos_w >= geometry.shape[0] - 1:
+      beta_average += edge_betas.width_max * abs_fac
+      reflection_count += abs_fac
+    elif pos_h <= 0:
+      beta_average += edge_betas.height_min * abs_fac
+      reflection_count += abs_fac
+    elif pos_h >= geometry.shape[1] - 1:
+      beta_average += edge_betas.height_max * abs_fac
+      reflection_count += abs_fac
+    elif pos_d <= 0:
+      beta_average += edge_betas.depth_min * abs_fac
+      reflection_count += abs_fac
+    elif pos_d >= geometry.shape[2] - 1:
+      beta_average += edge_betas.depth_max * abs_fac
+      reflection_count += abs_fac
+    elif geometry[pos_w, pos_h, pos_d] & WALL_FLAG > 0:
+      beta_average += beta[pos_w, pos_h, pos_d] * abs_fac
+      reflection_count += abs_fac
+  return beta_average, reflection_count
 
-  for w in prange(geometry.shape[0]):
-    for h in prange(geometry.shape[1]):
-      for d in prange(geometry.shape[2]):
-        reflection_count = 0
-        beta_average = 0
-        for point in points:
-          (_w, _h, _d, fac) = point
-          pos_w = w + _w
-          pos_h = h + _h
-          pos_d = d + _d
-          abs_fac = abs(fac)
-
-          if abs_fac == 0.0:
-            continue
-
-          if pos_w <= 0:
-            beta_average += edge_betas.width_min * abs_fac
-            reflection_count += abs_fac
-            continue
 
-          if pos_w >= geometry.shape[0] - 1:
-            beta_average += edge_betas.width_max * abs_fac
-            reflection_count += abs_fac
-            continue
-
-          if pos_h <= 0:
-            beta_average += edge_betas.height_min * abs_fac
-            reflection_count += abs_fac
-            continue
-
-          if pos_h >= geometry.shape[1] - 1:
-            beta_average += edge_betas.height_max * abs_fac
-            reflection_count += abs_fac
-            continue
+@njit(parallel=True)
+def populate_inner_betas(geometry: np.ndarray, beta: np.ndarray, edge_betas: GridEdgeBeta, d1: float, d2: float, d3: float) -> None:
+  """Set the beta of air cells to the weighted average beta of the walls and grid edges around them"""
+  factors = np.array([abs(d1), abs(d2), abs(d3)])
+  for w in prange(geometry.shape[0]):
+    for h in range(geometry.shape[1]):
+      for d in range(geometry.shape[2]):
+        # wall betas are only read, so cells can be updated in any order
+        if geometry[w, h, d] & WALL_FLAG > 0:
+          continue
+        beta_average, reflection_count = get_cell_beta(
+            geometry, beta, edge_betas, factors, w, h, d)
+        if reflection_count > 0:
+          beta[w, h, d] = beta_average / reflection_count
 
-          if pos_d <= 0:
-            beta_average += edge_betas.depth_min * abs_fac
-            reflection_count += abs_fac
-            continue
 
-          if pos_d >= geometry.shape[2] - 1:
-            beta_average += edge_betas.depth_max * abs_fac
-            reflection_count += abs_fac
+@njit(parallel=True)
+def populate_cell_betas(geometry: np.ndarray, beta: np.ndarray, edge_betas: GridEdgeBeta, d1: float, d2: float, d3: float, cells: np.ndarray) -> None:
+  """populate_inner_betas for the given flat air cells only"""
+  factors = np.array([abs(d1), abs(d2), abs(d3)])
+  plane_size = geometry.shape[1] * geometry.shape[2]
+  for k in prange(cells.size):
+    w = cells[k] // plane_size
+    h = cells[k] // geometry.shape[2] % geometry.shape[1]
+    d = cells[k] % geometry.shape[2]
+    beta_average, reflection_count = get_cell_beta(
+        geometry, beta, edge_betas, factors, w, h, d)
+    if reflection_count > 0:
+      beta[w, h, d] = beta_average / reflection_count
+
+
+@njit
+def get_material_cell_masks(geometry: np.ndarray, d1: float, d2: float, d3: float) -> Tuple[np.ndarray, np.ndarray]:
+  """Masks of the air cells populate_inner_betas sets, and of the wall cells it reads"""
+  factors = np.array([abs(d1), abs(d2), abs(d3)])
+  beta_mask = np.zeros(geometry.shape, dtype=np.bool_)
+  surface_mask = np.zeros(geometry.shape, dtype=np.bool_)
+  for w in range(geometry.shape[0]):
+    for h in range(geometry.shape[1]):
+      for d in range(geometry.shape[2]):
+        if geometry[w, h, d] & WALL_FLAG > 0:
+          continue
+        for k in range(BETA_NEIGHBOUR_OFFSETS.shape[0]):
+          if factors[BETA_NEIGHBOUR_GROUPS[k]] == 0.0:
             continue
-
-          if geometry[pos_w, pos_h, pos_d] & WALL_FLAG > 0:
-            beta_average += beta[pos_w, pos_h, pos_d] * abs_fac
-            reflection_count += abs_fac
-
-        if reflection_count > 0:
-          beta[_w, h, d] = beta_average / reflection_count
+          pos_w = w + BETA_NEIGHBOUR_OFFSETS[k, 0]
+          pos_h = h + BETA_NEIGHBOUR_OFFSETS[k, 1]
+          pos_d = d + BETA_NEIGHBOUR_OFFSETS[k, 2]
+          is_edge = pos_w <= 0 or pos_w >= geometry.shape[0] - 1 or pos_h <= 0 or \
+              pos_h >= geometry.shape[1] - 1 or pos_d <= 0 or pos_d >= geometry.shape[2] - 1
+          if is_edge:
+            beta_mask[w, h, d] = True
+          elif geometry[pos_w, pos_h, pos_d] & WALL_FLAG > 0:
+            beta_mask[w, h, d] = True
+            surface_mask[pos_w, pos_h, pos_d] = True
+  return beta_mask, surface_mask
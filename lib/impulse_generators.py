@@ -1,6 +1,8 @@
 """Module Impulse contains all possible impulse generators"""
 import math
 
+import numpy as np
+
 
 class ImpulseGenerator:
   """Interface for generators"""
@@ -9,6 +11,10 @@ class ImpulseGenerator:
     """Generate a value given the current state of the simulation"""
     return 0.0
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    """Generate the values for a block of iterations at once"""
+    return np.array([self.generate(time, iteration) for time, iteration in zip(times, iterations)], dtype="float64")
+
 
 class HannWindow(ImpulseGenerator):
   def __init__(self, width: float = 0.5, end_signal=0.0) -> None:
@@ -24,6 +30,10 @@ class HannWindow(ImpulseGenerator):
     window_value = sin_factor * sin_factor
     return window_value
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    sin_factor = np.sin(times * self.factor)
+    return np.where(times >= self.width, self.end_signal, sin_factor * sin_factor)
+
 
 class GaussianWindow(ImpulseGenerator):
   def __init__(self, bandwidth: float = 16, bandwidth_reference=-6, cutoff_limit_db=-120) -> None:
@@ -39,6 +49,10 @@ class GaussianWindow(ImpulseGenerator):
     exp_envolope = math.exp(-self.a * t_now * t_now)
     return exp_envolope
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    t_now = times - self.t_0
+    return np.exp(-self.a * t_now * t_now)
+
 
 class WindowModulatedSinoidImpulse(ImpulseGenerator):
   """Generates a windowed sinoid impulse"""
@@ -61,6 +75,14 @@ class WindowModulatedSinoidImpulse(ImpulseGenerator):
         sinoid_param) if self.use_cosine else math.sin(sinoid_param)
     return envelope_factor * sinoid_value
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    envelope_factor = self.window_generator.generate_block(times, iterations)
+    sinoid_param = times * self.frequency * 2 * math.pi
+    sinoid_value = np.cos(
+        sinoid_param) if self.use_cosine else np.sin(sinoid_param)
+    # a nan envelope stays nan
+    return envelope_factor * sinoid_value
+
 
 class SimpleSinoidGenerator(ImpulseGenerator):
   """Generates a windowed sinoid impulse"""
@@ -75,6 +97,10 @@ class SimpleSinoidGenerator(ImpulseGenerator):
         sinoid_param) if self.use_cosine else math.sin(sinoid_param)
     return sinoid_value
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    sinoid_param = times * self.frequency * 2 * math.pi
+    return np.cos(sinoid_param) if self.use_cosine else np.sin(sinoid_param)
+
 
 class GaussianModulatedImpulseGenerator(ImpulseGenerator):
   """Generates a Gaussian modulated cosine impulse"""
@@ -100,6 +126,12 @@ class GaussianModulatedImpulseGenerator(ImpulseGenerator):
     cos_factor = math.sin(t_now * self.frequency * 2 * math.pi)
     return exp_envolope * cos_factor
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    t_now = times - self.t_0
+    exp_envolope = np.exp(-self.a * t_now * t_now)
+    cos_factor = np.sin(t_now * self.frequency * 2 * math.pi)
+    return exp_envolope * cos_factor
+
 
 class GaussianMonopulseGenerator(ImpulseGenerator):
   """Generates a Gaussian modulated cosine impulse"""
@@ -118,9 +150,16 @@ class GaussianMonopulseGenerator(ImpulseGenerator):
     signal = self.exp1_2 * t_over_sg * math.exp(-0.5*t_over_sg*t_over_sg)
     return signal
 
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    t_over_sg = (times - self.t_0) / self.sigma
+    return self.exp1_2 * t_over_sg * np.exp(-0.5*t_over_sg*t_over_sg)
+
 
 class DiracImpulseGenerator(ImpulseGenerator):
   """Generates a dirac impulse"""
 
   def generate(self, time: float, iteration: int) -> float:
     return 1.0 if iteration == 0 else 0.0
+
+  def generate_block(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    return np.where(iterations == 0, 1.0, 0.0)
@@ -6,6 +6,14 @@ from lib.physical_constants import C_AIR
 SQRT_3 = math.sqrt(3)
 EPSILON = 1e-12
 
+# pressure values and analysis values in float64
+PRECISION_DOUBLE = "double"
+# pressure values and analysis values in float32
+PRECISION_SINGLE = "single"
+# pressure values in float32, analysis values in float64
+PRECISION_MIXED = "mixed"
+PRECISIONS = [PRECISION_DOUBLE, PRECISION_SINGLE, PRECISION_MIXED]
+
 
 def eps(value: float) -> float:
   if abs(value) < EPSILON:
@@ -21,6 +29,7 @@ class SimulationParameters:
     self.param_a = 0.0
     self.param_b = 0.0
     self.signal_frequency = 200.0
+    self.precision = PRECISION_DOUBLE
     self.recalc()
 
   def recalc(self) -> None:
@@ -59,3 +68,18 @@ class SimulationParameters:
   def set_max_frequency(self, max_frequency: float) -> None:
     self.max_frequency = max_frequency
     self.recalc()
+
+  def set_precision(self, precision: str) -> None:
+    if precision not in PRECISIONS:
+      raise ValueError(f'Unknown precision "{precision}", use one of {PRECISIONS}')
+    self.precision = precision
+
+  @property
+  def pressure_dtype(self) -> str:
+    """Type of the pressure values and betas"""
+    return "float64" if self.precision == PRECISION_DOUBLE else "float32"
+
+  @property
+  def analysis_dtype(self) -> str:
+    """Type of the analysis values"""
+    return "float32" if self.precision == PRECISION_SINGLE else "float64"
@@ -2,6 +2,7 @@
 Predefined grids besed on a number of scenarios
 """
 import math
+import numpy as np
 from lib.grid import SimulationGrid
 from lib.parameters import SimulationParameters
 from lib.physical_constants import C_AIR
@@ -31,6 +32,28 @@ class Scene:
     self.grid.rebuild()
     return None
 
+  def get_betas(self, frequency: float) -> np.ndarray:
+    """Edge and region betas mark_regions sets at the frequency, the betas of the grid are not changed"""
+    if self.grid is None or not self.grid.is_build:
+      raise Exception("Grid is not build. Please call build before reading the betas!")
+    signal_frequency = self.parameters.signal_frequency
+    self.parameters.set_signal_frequency(frequency)
+    self.mark_regions()
+    self.parameters.set_signal_frequency(signal_frequency)
+    edge_betas = self.grid.edge_betas
+    betas = np.array([edge_betas.width_min, edge_betas.width_max, edge_betas.height_min, edge_betas.height_max,
+                      edge_betas.depth_min, edge_betas.depth_max, *self.grid.region_betas], dtype="float64")
+    self.grid.region_betas = []
+    # the edge betas of the build frequency are used by later rebuilds
+    self.mark_regions()
+    self.grid.region_betas = []
+    return betas
+
+  def has_frequency_dependent_betas(self, frequencies) -> bool:
+    """Check if any of the frequencies gets other betas than the frequency the grid was build with"""
+    build_betas = self.get_betas(self.parameters.signal_frequency)
+    return any(not np.array_equal(self.get_betas(frequency), build_betas) for frequency in frequencies)
+
   def get_room_modes(self) -> List[Tuple[float, int]]:
     frequencies = []
     for i in range(4):
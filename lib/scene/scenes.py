@@ -0,0 +1,33 @@
+from typing import Callable, Dict
+
+from lib.parameters import SimulationParameters
+from lib.scene.scene import Scene
+from lib.scene.BedroomScene import BedroomScene
+from lib.scene.BellBoxScene import BellBoxScene
+from lib.scene.ConcertHallScene import ConcertHallScene
+from lib.scene.CuboidReferenceScene import CuboidReferenceScene
+from lib.scene.LShapedRoomScene import LShapedRoomScene
+from lib.scene.OfficeScene import OfficeScene
+from lib.scene.RealLifeRoomScene import RealLifeRoomScene
+from lib.scene.ShoeboxReferenceScene import ShoeboxReferenceScene
+from lib.scene.StudioRoomScene import StudioRoomScene
+
+# scenes by their command line name
+SCENES: Dict[str, Callable[[SimulationParameters], Scene]] = {
+    "real-reference": lambda parameters: RealLifeRoomScene(parameters, True),
+    "real-scene": RealLifeRoomScene,
+    "bedroom": BedroomScene,
+    "bellbox": BellBoxScene,
+    "concert": ConcertHallScene,
+    "shoebox": ShoeboxReferenceScene,
+    "lshape": LShapedRoomScene,
+    "cuboid": CuboidReferenceScene,
+    "office": OfficeScene,
+    "studio": StudioRoomScene,
+}
+
+
+def create_scene(name: str, parameters: SimulationParameters) -> Scene:
+  if name not in SCENES:
+    raise ValueError(f"Unknown scene {name}, use one of {list(SCENES)}")
+  return SCENES[name](parameters)
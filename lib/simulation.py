@@ -1,175 +1,291 @@
+import json
+import os
+from typing import Iterable, List, Tuple
+
 import numpy as np
 
-import pyopencl as cl
-from lib.gpu.kernel_program import SimulationKernelProgram
-from lib.grid import SimulationGrid
+from lib.analysis.metrics import DEFAULT_METRICS
+from lib.grid import WALL_FLAG, SimulationGrid
 from lib.impulse_generators import ImpulseGenerator
 from lib.parameters import SimulationParameters
+from lib.simulation_backend import BACKEND_OPENCL, READBACK_FULL, READBACK_REGION, READBACKS, StepFuture, create_backend
+
+# files written by Simulation.save_state
+STATE_PRESSURE_FILES = ("pressure_previous.npy", "pressure.npy", "pressure_next.npy")
+STATE_ANALYSIS_FILE = "analysis.npy"
+STATE_FILE = "state.json"
 
 
 class Simulation:
   """Handles the simulation state and can perform a step"""
 
-  def __init__(self, parameters: SimulationParameters, grid: SimulationGrid):
+  def __init__(self, parameters: SimulationParameters, grid: SimulationGrid, band_count: int = 1,
+               metrics: Iterable[str] = DEFAULT_METRICS, fuse_analysis: bool = False, time_block: int = 1,
+               backend: str = BACKEND_OPENCL, slab_count: int = 1):
     self.parameters = parameters
     self.grid = grid
-    self.program = SimulationKernelProgram(grid)
-    self.generator: ImpulseGenerator = None
+    self.band_count = band_count
+    # only the selected analysis metrics are allocated and computed
+    grid.set_analysis_metrics(metrics)
+    self.generators: List[ImpulseGenerator] = [None] * band_count
     self.time = 0
     self.iteration = 0
     self.signal_set = []
     self.time_set = []
-    self.sync_pressure_buffers()
+    self.record_start = 0
+    self.record_length = 0
+    # after the first upload only the betas of grid.beta_cells can change
+    self.is_beta_synced = False
+    # step_async leaves the band arrays behind the device until a full readback
+    self.is_host_stale = False
+
+    # host side state with a leading band dimension. A single band shares its
+    # memory with the grid, so grid.pressure and grid.analysis stay up to date.
+    if band_count == 1:
+      self.band_pressure_previous = grid.pressure_previous[np.newaxis]
+      self.band_pressure = grid.pressure[np.newaxis]
+      self.band_pressure_next = grid.pressure_next[np.newaxis]
+      self.band_analysis = grid.analysis[np.newaxis]
+      self.band_beta = grid.beta[np.newaxis]
+    else:
+      pressure_dtype = parameters.pressure_dtype
+      self.band_pressure_previous = self.create_band_grid(
+          grid.grid_shape, pressure_dtype)
+      self.band_pressure = self.create_band_grid(
+          grid.grid_shape, pressure_dtype)
+      self.band_pressure_next = self.create_band_grid(
+          grid.grid_shape, pressure_dtype)
+      self.band_analysis = self.create_band_grid(
+          grid.analysis_shape, parameters.analysis_dtype)
+      self.band_beta = self.create_band_grid(grid.grid_shape, pressure_dtype)
+      self.band_beta[:] = grid.beta
+
+    # what step copies back, see set_readback
+    self.readback = READBACK_FULL
+    self.readback_region = None
+    self.listener_pressure = self.create_band_grid(
+        (grid.listener_indices.size,), parameters.pressure_dtype)
+    self.listener_analysis = self.create_band_grid(
+        (grid.analysis_values, grid.listener_indices.size), parameters.analysis_dtype)
+
+    self.backend = create_backend(
+        self, backend, fuse_analysis, time_block, slab_count)
+    self.sync_read_buffers()
+    self.reset()
+    self.reset_band_statistics()
+
+  @property
+  def generator(self) -> ImpulseGenerator:
+    """The generator of the first (or only) band"""
+    return self.generators[0]
+
+  @generator.setter
+  def generator(self, generator: ImpulseGenerator) -> None:
+    self.generators[0] = generator
+
+  def create_band_grid(self, shape, dtype) -> np.ndarray:
+    return np.zeros(shape=(self.band_count, *shape), dtype=dtype)
+
+  def set_band(self, band: int, generator: ImpulseGenerator) -> None:
+    """Use the current grid betas and the given generator for a band. Call sync_read_buffers once all bands are set."""
+    self.generators[band] = generator
+    # other betas are the same for every rebuild of the scene
+    beta_cells = self.grid.beta_cells
+    self.band_beta[band].reshape(-1)[beta_cells] = self.grid.beta.reshape(-1)[beta_cells]
+
+  def set_readback(self, readback: str, region=None) -> None:
+    """Select the values step copies back to the host, other values on the host are not updated:
+    - full: band_pressure and band_analysis
+    - listeners: listener_pressure and listener_analysis, in the order of grid.listener_indices
+    - region: band_pressure and band_analysis inside ((w_min, w_max), (h_min, h_max), (d_min, d_max))
+    - none: nothing, for runs that only use the listener history"""
+    if readback not in READBACKS:
+      raise ValueError(f"Unknown readback {readback}, use one of {READBACKS}")
+    if readback == READBACK_REGION:
+      region = tuple((int(low), int(high)) for low, high in (region or ()))
+      if len(region) != 3 or any(not 0 <= low < high <= parts for (low, high), parts in zip(region, self.grid.grid_shape)):
+        raise ValueError(
+            f"Readback region {region} is not inside the grid {self.grid.grid_shape}")
+    self.readback = readback
+    self.readback_region = region
 
   def reset(self) -> None:
     self.grid.reset_values()
+    self.band_pressure_previous.fill(0.0)
+    self.band_pressure.fill(0.0)
+    self.band_pressure_next.fill(0.0)
+    self.band_analysis.fill(0.0)
+    self.grid.mark_walls(self.band_pressure, self.band_pressure_previous,
+                         self.band_pressure_next, self.band_analysis)
     self.time = 0
     self.iteration = 0
     self.signal_set = []
     self.time_set = []
+    self.record_length = 0
+    self.is_host_stale = False
+    self.backend.reset()
     self.sync_pressure_buffers()
 
+  def save_state(self, directory: str) -> None:
+    """Store the pressure, analysis values, iteration and time as .npy files, so a run can continue from this point"""
+    if self.readback != READBACK_FULL:
+      raise ValueError(
+          "The analysis values are only on the host with the full readback")
+    if self.is_host_stale:
+      raise ValueError(
+          "The analysis values on the host are from before step_async, run a step first")
+    os.makedirs(directory, exist_ok=True)
+    for name, values in zip(STATE_PRESSURE_FILES, self.backend.read_state()):
+      np.save(os.path.join(directory, name), values)
+    np.save(os.path.join(directory, STATE_ANALYSIS_FILE), self.band_analysis)
+    with open(os.path.join(directory, STATE_FILE), 'w', encoding="utf-8") as file:
+      json.dump({
+          "iteration": self.iteration,
+          "time": float(self.time),
+          "band_count": self.band_count,
+          "grid_shape": list(self.grid.grid_shape),
+          "analysis_keys": list(self.grid.analysis_keys),
+      }, file)
+
+  def load_state(self, directory: str) -> None:
+    """Continue from a state stored by save_state, the grid and metrics have to match. Generators and betas are not part of the state."""
+    with open(os.path.join(directory, STATE_FILE), 'r', encoding="utf-8") as file:
+      state = json.load(file)
+    if state["band_count"] != self.band_count or tuple(state["grid_shape"]) != self.grid.grid_shape:
+      raise ValueError(
+          f"State of {state['band_count']} band(s) with grid {state['grid_shape']} does not match this simulation")
+    if state["analysis_keys"] != list(self.grid.analysis_keys):
+      raise ValueError(
+          f"State with metrics {state['analysis_keys']} does not match {list(self.grid.analysis_keys)}")
+
+    # memory mapped, the values are only copied once
+    pressure = [np.load(os.path.join(directory, name), mmap_mode="r")
+                for name in STATE_PRESSURE_FILES]
+    np.copyto(self.band_analysis, np.load(os.path.join(
+        directory, STATE_ANALYSIS_FILE), mmap_mode="r"))
+    self.iteration = state["iteration"]
+    self.time = state["time"]
+    self.signal_set = []
+    self.time_set = []
+    self.record_length = 0
+    self.is_host_stale = False
+    self.backend.write_state(pressure)
+
+  def record_listeners(self, step_count: int) -> None:
+    """Record the pressure in all listener cells for the next step_count iterations"""
+    listener_count = self.grid.listener_indices.size
+    history_size = step_count * self.band_count * listener_count
+    if history_size == 0:
+      self.record_length = 0
+      return
+
+    self.backend.record_listeners(step_count)
+    self.record_start = self.iteration
+    self.record_length = step_count
+
+  def get_listener_history(self) -> np.ndarray:
+    """Get the recorded listener pressure as a (iteration, band, listener) array"""
+    recorded = min(self.record_length, self.iteration - self.record_start)
+    return self.backend.get_listener_history()[:recorded]
+
   def print_statistics(self) -> None:
-    print(f'Kernel platform: {self.program.platforms[0].name}')
+    print(f'Kernel platform: {self.backend.get_name()}')
     print(
         f'[Params] w: {self.grid.width_parts}\th:{self.grid.height_parts}\td:{self.grid.depth_parts}')
     print(f'[Params] a={self.parameters.param_a:0.2f}\tb:{self.parameters.param_b:0.2f}\tlambda:{self.parameters.lambda_courant:0.2f}')
     print(f'[Params] d1={self.parameters.arg_d1:0.2f}\td2={self.parameters.arg_d2:0.2f}\td3={self.parameters.arg_d3:0.2f}\td4={self.parameters.arg_d4:0.2f}')
     print(f'[Params] {self.parameters.sampling_frequency}hz target.\t{self.parameters.dt_hz:0.0f}hz speed.\t{self.parameters.dx * 1000:.2f}mm size. ')
     print(
-        f'[Storage] Cells: {self.grid.get_cell_size_str()}\tStorage: {self.grid.get_storage_str()} needed')
+        f'[Storage] Cells: {self.grid.get_cell_size_str()}\tStorage: {self.grid.get_storage_str()} needed\tBands: {self.band_count}')
     print(
         f'[Grid] Listeners: {self.grid.listener_count}\tSources: {self.grid.source_count}')
+    print(
+        f'[Grid] Air cells: {self.grid.air_indices.size}/{self.grid.grid_size}\tInterior: {self.grid.interior_indices.size}\tBoundary: {self.grid.boundary_indices.size}')
 
   def sync_read_buffers(self) -> None:
-    args = {
-        "is_blocking": False,
-    }
-    prog = self.program
-    grid = self.grid
-    queue = self.program.queue
-    cl.wait_for_events([
-        cl.enqueue_copy(queue, prog.beta_buffer, grid.beta, **args),
-        cl.enqueue_copy(queue, prog.geometry_buffer, grid.geometry, **args),
-    ])
+    """Upload the geometry and betas, after the first call only the betas a scene rebuild changes (grid.beta_cells)"""
+    self.backend.sync_read_buffers(self.is_beta_synced)
+    self.is_beta_synced = True
 
   def sync_pressure_buffers(self) -> None:
-    args = {
-        "is_blocking": False,
-    }
-    prog = self.program
-    grid = self.grid
-    queue = self.program.queue
-    cl.wait_for_events([
-        cl.enqueue_copy(queue, prog.pressure_previous_buffer,
-                        grid.pressure_previous, **args),
-        cl.enqueue_copy(queue, prog.pressure_next_buffer,
-                        grid.pressure_next, **args),
-        cl.enqueue_copy(queue, prog.pressure_buffer, grid.pressure, **args),
-        cl.enqueue_copy(queue, prog.analysis_buffer, grid.analysis, **args),
-    ])
-
-  def enqueue_copy(self, dest, src, is_blocking=False, **kwargs) -> cl.Event:
-    # kwargs["is_blocking"] = is_blocking
-    return cl.enqueue_copy(self.program.queue, dest, src, is_blocking=False)
+    self.backend.sync_pressure_buffers()
+
+  def get_step_times(self, step_count: int) -> np.ndarray:
+    """Get the simulation time of the next step_count iterations"""
+    # a cumulative sum adds dt one step at a time, like the iteration loop did
+    increments = np.full(shape=(step_count,), fill_value=self.parameters.dt)
+    increments[0] = self.time
+    return np.cumsum(increments)
+
+  def generate_signals(self, times: np.ndarray, iterations: np.ndarray) -> np.ndarray:
+    """Get the excitation signal of every band for a block of iterations"""
+    signals = np.zeros(shape=(times.size, self.band_count),
+                       dtype=self.parameters.pressure_dtype)
+    for band, generator in enumerate(self.generators):
+      if generator is not None:
+        signals[:, band] = generator.generate_block(times, iterations)
+    return signals
+
+  def get_listener_statistics(self, metric: str = "LEQ") -> List[Tuple[float, float, float]]:
+    """Get the average, minimum and maximum of a metric over the listener cells per band, without a readback.
+    Reduced on the device with OpenCL, bands without valid listener values get zeros like get_avg_spl."""
+    reduction = self.backend.reduce_listeners(self.grid.analysis_keys[metric])
+    return [(float(total / count), float(minimum), float(maximum)) if count > 0 else (0.0, 0.0, 0.0)
+            for total, minimum, maximum, count in reduction.tolist()]
+
+  def reset_band_statistics(self) -> None:
+    """Start new per cell statistics over bands, see accumulate_band_statistics"""
+    self.band_statistics_count = 0
+    self.backend.reset_band_statistics()
+
+  def accumulate_band_statistics(self, metric: str = "LEQ", band_count: int = None) -> None:
+    """Add the metric of the last step of the first band_count (all) bands to the per cell mean and variance"""
+    band_count = self.band_count if band_count is None else band_count
+    if band_count <= 0:
+      return
+    self.backend.accumulate_band_statistics(
+        self.grid.analysis_keys[metric], band_count, self.band_statistics_count)
+    self.band_statistics_count += band_count
+
+  def get_band_statistics(self) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the per cell (mean, variance) of the accumulated bands, nan inside walls like run_sweep_analysis"""
+    mean, m2 = self.backend.read_band_statistics()
+    is_wall = self.grid.geometry & WALL_FLAG > 0
+    variance = m2 / max(1, self.band_statistics_count)
+    return np.where(is_wall, np.nan, mean), np.where(is_wall, np.nan, variance)
+
+  def prepare_step(self, step_count: int):
+    """Get the times and signals of the next step_count iterations and add the samples"""
+    times = self.get_step_times(step_count)
+    iterations = np.arange(self.iteration, self.iteration + step_count)
+    signals = self.generate_signals(times, iterations)
+
+    # add samples
+    self.signal_set.extend(signals[:, 0].tolist())
+    self.time_set.extend(times.tolist())
+    return times, signals
 
   def step(self, step_count: int = 1) -> None:
     """Proceed the simulation one or more steps, note: only writes back pressure and analysis values"""
-    # initial write from host to device
-    prog = self.program
-    grid = self.grid
-    queue = self.program.queue
-    kernel_global_size = [self.grid.pressure.size]
-    kernel_global_shape = self.grid.pressure.shape
-    # kernel_global_size_shaped = self.grid.pressure.shape
-    args = {
-        "is_blocking": False,
-    }
-
-    # wait_event = [
-    #     cl.enqueue_copy(queue, previous_buffer,
-    #                     grid.pressure_previous, **args),
-    #     cl.enqueue_copy(queue, current_buffer, grid.pressure, **args),
-    #     cl.enqueue_copy(queue, prog.analysis_buffer, grid.analysis, **args),
-    # ]
-
-    wait_event = []
-
-    for i in range(step_count):
-      # get next signal value
-      signal = 0.0
-
-      if self.generator is not None:
-        signal = self.generator.generate(
-            self.time, self.iteration)
-
-      # add samples
-      self.signal_set.append(signal)
-      self.time_set.append(self.time)
-
-      # set signal value in kernel
-
-      if self.iteration % 3 == 0:
-        next_buffer = prog.pressure_next_buffer
-        current_buffer = prog.pressure_buffer
-        previous_buffer = prog.pressure_previous_buffer
-      elif self.iteration % 3 == 1:
-        next_buffer = prog.pressure_previous_buffer
-        current_buffer = prog.pressure_next_buffer
-        previous_buffer = prog.pressure_buffer
-      elif self.iteration % 3 == 2:
-        next_buffer = prog.pressure_buffer
-        current_buffer = prog.pressure_previous_buffer
-        previous_buffer = prog.pressure_next_buffer
-
-      self.program.analysis_kernel.set_arg(0, current_buffer)
-      self.program.scheme_step_kernel.set_arg(0, previous_buffer)
-      self.program.scheme_step_kernel.set_arg(1, current_buffer)
-      self.program.scheme_step_kernel.set_arg(2, next_buffer)
-      # self.program.step_kernel.set_arg(0, previous_buffer)
-      # self.program.step_kernel.set_arg(1, current_buffer)
-      # self.program.step_kernel.set_arg(2, next_buffer)
-
-      # run compact step
-      # -- SLF optimised
-      # self.program.step_kernel.set_arg(10, np.float64(signal))
-      # kernel_event1 = cl.enqueue_nd_range_kernel(
-      #     queue, prog.step_kernel, kernel_global_size, None, wait_for=wait_event)
-
-      # -- any scheme
-      self.program.scheme_step_kernel.set_arg(16, np.float64(signal))
-
-      # set analysis argument
-      self.program.analysis_kernel.set_arg(9, np.float64(self.time))
-
-      # stream result into right buffer for next kernel run
-      wait_event = [
-          cl.enqueue_nd_range_kernel(
-              queue,
-              prog.scheme_step_kernel,
-              kernel_global_size,
-              None,
-              wait_for=wait_event
-          ),
-          cl.enqueue_nd_range_kernel(
-              queue,
-              prog.analysis_kernel,
-              kernel_global_size,
-              None,
-              wait_for=wait_event)
-      ]
-
-      # finally, update iteration parameters
-      self.time += self.parameters.dt
-      self.iteration += 1
-
-    # write back to host
-    final_events = [
-        cl.enqueue_copy(queue, grid.pressure, current_buffer,
-                        wait_for=wait_event, **args),
-        cl.enqueue_copy(
-            queue, grid.analysis, prog.analysis_buffer, wait_for=wait_event, **args)
-    ]
-
-    # make sure event is done before processing data further!
-    cl.wait_for_events(final_events)
+    if step_count <= 0:
+      return
+
+    times, signals = self.prepare_step(step_count)
+    self.backend.step(times, signals)
+    if self.readback == READBACK_FULL:
+      self.is_host_stale = False
+
+    # finally, update iteration parameters
+    self.time = times[-1] + self.parameters.dt
+    self.iteration += step_count
+
+  def step_async(self, step_count: int = 1) -> StepFuture:
+    """Start one or more steps without waiting for them. The band arrays are not updated, the values of the step are in
+    the snapshot of the returned future, which stays valid until the step after the next one is started."""
+    times, signals = self.prepare_step(max(1, step_count))
+    future = self.backend.step_async(times, signals)
+    self.is_host_stale = True
+
+    self.time = times[-1] + self.parameters.dt
+    self.iteration += times.size
+    return future
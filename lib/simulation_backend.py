@@ -0,0 +1,144 @@
+from typing import List, Tuple
+
+import numpy as np
+
+BACKEND_OPENCL = "opencl"
+BACKEND_NUMBA = "numba"
+BACKENDS = [BACKEND_OPENCL, BACKEND_NUMBA]
+
+# what Simulation.step copies back to the host
+READBACK_FULL = "full"
+READBACK_LISTENERS = "listeners"
+READBACK_REGION = "region"
+READBACK_NONE = "none"
+READBACKS = [READBACK_FULL, READBACK_LISTENERS,
+             READBACK_REGION, READBACK_NONE]
+
+
+class StepFuture:
+  """Pressure and analysis values after a step, the step may still run on the device"""
+
+  def __init__(self, pressure: np.ndarray, analysis: np.ndarray, iteration: int, time: float) -> None:
+    self.pressure = pressure
+    self.analysis = analysis
+    # iteration and time of the simulation after the step
+    self.iteration = iteration
+    self.time = time
+
+  def is_done(self) -> bool:
+    return True
+
+  def wait(self) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the (band pressure, band analysis) snapshot of the step"""
+    return self.pressure, self.analysis
+
+
+class SimulationBackend:
+  """Runs the scheme and analysis for a simulation, on the band arrays of the simulation"""
+
+  def __init__(self, simulation) -> None:
+    self.simulation = simulation
+
+  def get_name(self) -> str:
+    raise NotImplementedError()
+
+  def sync_read_buffers(self, beta_cells_only: bool = False) -> None:
+    """Use the current betas and geometry of the simulation, optionally only the betas of grid.beta_cells changed"""
+    raise NotImplementedError()
+
+  def sync_pressure_buffers(self) -> None:
+    """Use the current pressure and analysis values of the simulation"""
+    raise NotImplementedError()
+
+  def reset(self) -> None:
+    """Start again from the first iteration, before the pressure is synced"""
+    raise NotImplementedError()
+
+  def record_listeners(self, step_count: int) -> None:
+    """Prepare storage for the listener pressure of step_count iterations"""
+    raise NotImplementedError()
+
+  def get_listener_history(self) -> np.ndarray:
+    """Get the recorded listener pressure as a (iteration, band, listener) array"""
+    raise NotImplementedError()
+
+  def read_state(self) -> List[np.ndarray]:
+    """Get the (previous, current, next) band pressure of the next iteration"""
+    raise NotImplementedError()
+
+  def write_state(self, pressure: List[np.ndarray]) -> None:
+    """Continue at the current iteration of the simulation from the given (previous, current, next) band pressure"""
+    raise NotImplementedError()
+
+  def step(self, times: np.ndarray, signals: np.ndarray) -> None:
+    """Perform an iteration for every time, then write back the values of the selected readback"""
+    raise NotImplementedError()
+
+  def reduce_listeners(self, metric_index: int) -> np.ndarray:
+    """Get the (sum, minimum, maximum, count) of a metric over the listener cells that are not nan, per band.
+    Computed on the host from the band arrays, for backends that have all values on the host."""
+    sim = self.simulation
+    values = sim.band_analysis.reshape(sim.band_count, sim.grid.analysis_values, -1)[
+        :, metric_index, sim.grid.listener_indices].astype("float64")
+    is_valid = ~np.isnan(values)
+    return np.stack([
+        np.sum(values, axis=1, where=is_valid),
+        np.min(values, axis=1, where=is_valid, initial=np.inf),
+        np.max(values, axis=1, where=is_valid, initial=-np.inf),
+        np.count_nonzero(is_valid, axis=1),
+    ], axis=1)
+
+  def reset_band_statistics(self) -> None:
+    """Start new per cell statistics over bands"""
+    shape = self.simulation.grid.grid_shape
+    self.band_mean = np.zeros(shape=shape, dtype="float64")
+    self.band_m2 = np.zeros(shape=shape, dtype="float64")
+
+  def accumulate_band_statistics(self, metric_index: int, band_count: int, count: int) -> None:
+    """Add the metric of the first band_count bands to the per cell mean and sum of squared differences (Welford),
+    count values were added before"""
+    sim = self.simulation
+    for band in range(band_count):
+      values = sim.band_analysis[band, metric_index]
+      delta = values - self.band_mean
+      self.band_mean += delta / (count + band + 1)
+      self.band_m2 += delta * (values - self.band_mean)
+
+  def read_band_statistics(self) -> Tuple[np.ndarray, np.ndarray]:
+    """Get the per cell (mean, sum of squared differences) over bands"""
+    return self.band_mean.copy(), self.band_m2.copy()
+
+  def gather_listener_values(self) -> None:
+    """Fill the listener values of the simulation from its band arrays, for backends that have all values on the host"""
+    sim = self.simulation
+    indices = sim.grid.listener_indices
+    sim.listener_pressure[:] = sim.band_pressure.reshape(
+        sim.band_count, -1)[:, indices]
+    sim.listener_analysis[:] = sim.band_analysis.reshape(
+        sim.band_count, sim.grid.analysis_values, -1)[:, :, indices]
+
+  def step_async(self, times: np.ndarray, signals: np.ndarray) -> StepFuture:
+    """Like step, but the values are only written to the returned snapshot and the step may still be running"""
+    self.step(times, signals)
+    sim = self.simulation
+    return StepFuture(sim.band_pressure.copy(), sim.band_analysis.copy(),
+                      sim.iteration + times.size, times[-1] + sim.parameters.dt)
+
+
+def create_backend(simulation, backend: str, fuse_analysis: bool = False, time_block: int = 1, slab_count: int = 1) -> SimulationBackend:
+  """Backends are imported on use, so OpenCL is only needed when it is selected"""
+  if slab_count > 1:
+    if backend != BACKEND_OPENCL or time_block > 1:
+      raise ValueError(
+          "Slabs are only available for OpenCL without temporal blocking")
+    from lib.gpu.slab_backend import SlabBackend
+    return SlabBackend(simulation, slab_count, fuse_analysis)
+  if backend == BACKEND_OPENCL:
+    from lib.gpu.opencl_backend import OpenCLBackend
+    return OpenCLBackend(simulation, fuse_analysis, time_block)
+  if backend == BACKEND_NUMBA:
+    if time_block > 1:
+      raise ValueError("Temporal blocking is only available for OpenCL")
+    from lib.cpu.numba_backend import NumbaBackend
+    return NumbaBackend(simulation)
+  raise ValueError(f"Unknown backend {backend}, use one of {BACKENDS}")
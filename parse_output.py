@@ -1,4 +1,3 @@
-import csv
 import math
 import os
 import sys
@@ -7,83 +6,69 @@ from pathlib import Path
 import matplotlib
 import matplotlib.pyplot as plt
 
-from typing import List
 
 import numpy as np
 from lib.grid import LISTENER_FLAG, SOURCE_REGION_FLAG, WALL_FLAG
+from lib.analysis.sweep_output import SWEEP_OUTPUT_EXTENSION, load_sweep_output, read_sweep_csv
 from lib.parameters import SimulationParameters
-from lib.scene.ShoeboxReferenceScene import ShoeboxReferenceScene
+from lib.scene.scenes import SCENES, create_scene
 
 if len(sys.argv) == 1:
-  print('No file given. Usage: python parse_output.py <path/to/output.csv>')
+  print('No file given. Usage: python parse_output.py <path/to/output.npz|csv>')
   sys.exit()
 
 parser = argparse.ArgumentParser()
 parser.add_argument("file_path", type=Path)
 parser.add_argument("--export", action=argparse.BooleanOptionalAction)
+# only used for csv files without a .npz next to them, the .npz names its scene
+parser.add_argument("-s", "--scene", default="shoebox", choices=list(SCENES))
+parser.add_argument("-o", "--oversampling", default=16, type=float)
+parser.add_argument("-f", "--frequency", default=200, type=float)
 
 parsed = parser.parse_args()
 should_export = parsed.export
 
 file_dir = os.path.dirname(__file__)
-csv_path = os.path.join(file_dir, parsed.file_path)
-export_path = csv_path + ".png"
-print(csv_path)
-
-csv_file = open(csv_path, 'r', encoding="utf-8", newline='')
-reader = csv.reader(csv_file, delimiter=',', quotechar='|')
+output_path = os.path.join(file_dir, parsed.file_path)
+export_path = output_path + ".png"
+print(output_path)
+
+# prefer the columnar output of a sweep over its csv
+npz_path = os.path.splitext(output_path)[0] + SWEEP_OUTPUT_EXTENSION
+if os.path.exists(npz_path):
+  output = load_sweep_output(npz_path)
+else:
+  output = read_sweep_csv(output_path)
 
 # scene grid
 parameters = SimulationParameters()
-parameters.set_oversampling(16)
-parameters.set_max_frequency(200)
+parameters.set_oversampling(output.metadata.get(
+    "oversampling", parsed.oversampling))
+parameters.set_max_frequency(output.metadata.get(
+    "max_frequency", parsed.frequency))
 
-# scene = OfficeScene(parameters)
-scene = ShoeboxReferenceScene(parameters)
+scene = create_scene(output.metadata.get("scene", parsed.scene), parameters)
+print(f'{scene.__class__.__name__}, {output.indices.size} source set(s)')
 
 grid = scene.build()
 
-base_map = np.zeros(
-    shape=(grid.width_parts, grid.depth_parts, grid.height_parts))
-
-base_map_visible = np.zeros(
-    shape=(grid.width_parts, grid.depth_parts, grid.height_parts), dtype="bool")
-
-site_map = np.zeros(
-    shape=(grid.width_parts, grid.depth_parts, grid.height_parts, 3))
-site_map_visible = np.zeros(
-    shape=(grid.width_parts, grid.depth_parts, grid.height_parts), dtype="bool")
-
-value_map = np.zeros(
-    shape=(grid.width_parts, grid.depth_parts, grid.height_parts))
-value_map_visible = np.zeros(
-    shape=(grid.width_parts, grid.depth_parts, grid.height_parts), dtype="bool")
-
-for w in range(grid.width_parts):
-  for d in range(grid.depth_parts):
-    for h in range(grid.height_parts):
-      # beta = grid.beta[w, h, d]
-      if grid.geometry[w, h, d] & WALL_FLAG > 0:
-        base_map[w, d, h] = grid.beta[w, h, d]
-        base_map_visible[w, d, h] = True
-        continue
-      is_source = False
-      is_listener = False
-      if grid.geometry[w, h, d] & LISTENER_FLAG > 0:
-        is_listener = True
-      if grid.geometry[w, h, d] & SOURCE_REGION_FLAG > 0:
-        is_source = True
-        has_source = True
-
-      if is_source and is_listener:
-        site_map[w, d, h, 1] = 1.0
-      if is_source:
-        site_map[w, d, h, 2] = 1.0
-      elif is_listener:
-        site_map[w, d, h, 0] = 1.0
-      site_map_visible[w, d, h] = is_source or is_listener
-      value_map[w, d, h] = math.nan
-      value_map_visible[w, d, h] = is_source
+# maps are indexed (w, d, h)
+geometry = np.transpose(grid.geometry, (0, 2, 1))
+is_wall = geometry & WALL_FLAG > 0
+is_source = ~is_wall & (geometry & SOURCE_REGION_FLAG > 0)
+is_listener = ~is_wall & (geometry & LISTENER_FLAG > 0)
+
+base_map = np.where(is_wall, np.transpose(grid.beta, (0, 2, 1)), 0.0)
+base_map_visible = is_wall
+
+site_map = np.zeros(shape=(*geometry.shape, 3))
+site_map[..., 0] = is_listener & ~is_source
+site_map[..., 1] = is_source & is_listener
+site_map[..., 2] = is_source
+site_map_visible = is_source | is_listener
+
+value_map = np.where(is_wall, 0.0, math.nan)
+value_map_visible = is_source
 
 # chart
 plt.style.use(os.path.join(file_dir, './styles/paper.mplstyle'))
@@ -113,103 +98,52 @@ for ax in [axis_floor_map, axis_site_map, axis_value_map]:
   ax.set_xlabel("Width index")
   ax.set_zlabel("Height index")
 
-frequencies: List[float] = []
-max_per_frequency = []
-sum_per_frequency = []
-min_per_frequency = []
-values_per_frequency = []
-
-
-def as_float(value: str) -> float:
-  try:
-    return float(value)
-  except:
-    return math.nan
-
-
-count = 0
-max_value = -float('inf')
-max_spl_overall = -float('inf')
-min_spl_overall = float('inf')
-min_value = float('inf')
-best_set = []
-worst_set = []
-location_map = {}
-band_map = {}
-indexes = []
-value_index = []
-
-for i, row in enumerate(reader):
-  float_row = list(map(as_float, row))
-  _, index, w_i, w_m, h_i, h_m, d_i, d_m, dev, spl, _, *bands = float_row
-  if i == 0:
-    frequencies = bands
-    for i, _ in enumerate(bands):
-      # min, max, sum
-      max_per_frequency.append(-float('inf'))
-      min_per_frequency.append(float('inf'))
-      sum_per_frequency.append(0)
-      values_per_frequency.append([])
-    continue
-  derrivative2 = np.diff(bands, n=1)
-  value = np.sum(np.power(derrivative2, 2))
-  if value == 0.0:
-    continue
-  count += 1
-  w = int(w_i)
-  d = int(d_i)
-  h = int(h_i)
-  location_map[i] = (w, h, d)
-  value_map[w, d, h] = value
-  max_value = max(value, max_value)
-  min_value = min(value, min_value)
-  indexes.append(i)
-  value_index.append(value)
-  band_map[i] = bands
-
-  if value == max_value:
-    worst_set = bands
-
-  if value == min_value:
-    best_set = bands
-
-  # print(bands)
-  # axis_spl_all.plot(frequencies, bands)
-  for freq_index, frequency in enumerate(frequencies):
-    value = bands[freq_index]
-    max_per_frequency[freq_index] = max(max_per_frequency[freq_index], value)
-    min_per_frequency[freq_index] = min(min_per_frequency[freq_index], value)
-    sum_per_frequency[freq_index] += value
-    values_per_frequency[freq_index].append(value)
-    max_spl_overall = max(max_spl_overall, value)
-    min_spl_overall = min(min_spl_overall, value)
-
-optimal = sorted(zip(value_index, indexes))
-print("BEST:")
-for i in range(min(5, len(optimal))):
-  value, index = optimal[i]
-  pos = location_map[index]
-  w, h, d = pos
-  min_band = np.min(band_map[index])
-  max_band = np.max(band_map[index])
-  diff = max_band - min_band
-  print(
-      f'{i}: {index} with {value} ({max_band}-{min_band}, d:{diff}) at [{w}, {h}, {d}] = ( {(w + 0.5) * parameters.dx}, {(h + 0.5) * parameters.dx}, {(d + 0.5) * parameters.dx} )')
+frequencies = output.frequencies.tolist()
+
+# flatness of the frequency response of every source set, silent sets are skipped
+values = np.sum(np.power(np.diff(output.spl, n=1, axis=1), 2), axis=1)
+is_used = values != 0.0
+values = values[is_used]
+spl = output.spl[is_used]
+indexes = output.indices[is_used]
+positions = output.positions[is_used]
+
+# the value of a set is shown at its first speaker
+(w, h, d) = positions[:, 0].T
+value_map[w, d, h] = values
+max_value = np.max(values, initial=-float('inf'))
+min_value = np.min(values, initial=float('inf'))
+
+# the last of equal values, like a running comparison
+if values.size > 0:
+  best_set = spl[values.size - 1 - np.argmin(values[::-1])]
+  worst_set = spl[values.size - 1 - np.argmax(values[::-1])]
+else:
+  best_set = []
+  worst_set = []
 
+max_per_frequency = np.max(spl, axis=0, initial=-float('inf'))
+min_per_frequency = np.min(spl, axis=0, initial=float('inf'))
+values_per_frequency = list(spl.T)
+
+
+def print_sets(order: np.ndarray) -> None:
+  for i, row in enumerate(order[:5]):
+    w, h, d = positions[row, 0]
+    min_band = np.min(spl[row])
+    max_band = np.max(spl[row])
+    diff = max_band - min_band
+    print(
+        f'{i}: {indexes[row]} with {values[row]} ({max_band}-{min_band}, d:{diff}) at [{w}, {h}, {d}] = ( {(w + 0.5) * parameters.dx}, {(h + 0.5) * parameters.dx}, {(d + 0.5) * parameters.dx} )')
+
+
+optimal = np.lexsort((indexes, values))
+print("BEST:")
+print_sets(optimal)
 print("WORST:")
-for i in range(min(5, len(optimal))):
-  value, index = optimal[-i-1]
-  pos = location_map[index]
-  w, h, d = pos
-  min_band = np.min(band_map[index])
-  max_band = np.max(band_map[index])
-  diff = max_band - min_band
-  print(
-      f'{i}: {index} with {value} ({max_band}-{min_band}, d:{diff}) at [{w}, {h}, {d}] = ( {(w + 0.5) * parameters.dx}, {(h + 0.5) * parameters.dx}, {(d + 0.5) * parameters.dx} )')
-
-csv_file.close()
-
-axis_scores.plot(indexes, value_index, "-")
+print_sets(optimal[::-1])
+
+axis_scores.plot(indexes, values, "-")
 
 boxplot = axis_boxplot_spl.boxplot(
     values_per_frequency, positions=frequencies, sym="", meanline=True)
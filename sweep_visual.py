@@ -170,7 +170,7 @@ def animate(i) -> None:
   avg_spl, min_spl_value, max_spl_value = get_avg_spl(
       sim.grid.analysis, sim.grid.geometry, analysis_key_index)
 
-  leq_analysis = grid.analysis[:, :, :, analysis_key_index]
+  leq_analysis = grid.analysis[analysis_key_index]
   max_l_eq = np.nanmax(leq_analysis)
   min_l_eq = np.nanmin(leq_analysis)
   slice_leq = leq_analysis[:, SLICE_HEIGHT, :]
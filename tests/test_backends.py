@@ -0,0 +1,35 @@
+import numpy as np
+
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+from lib.simulation_backend import BACKEND_NUMBA, BACKEND_OPENCL
+
+BANDS = 2
+STEPS = 40
+
+
+def run_simulation(backend: str) -> Simulation:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  grid = create_scene("bedroom", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters,
+                   band_count=BANDS, backend=backend)
+  for band in range(BANDS):
+    sim.set_band(band, SimpleSinoidGenerator(80.0 + 40.0 * band))
+  sim.sync_read_buffers()
+  sim.reset()
+  sim.step(STEPS // 2)
+  sim.step(STEPS - STEPS // 2)
+  return sim
+
+
+def test_numba_matches_opencl():
+  reference = run_simulation(BACKEND_OPENCL)
+  sim = run_simulation(BACKEND_NUMBA)
+
+  assert np.nanmax(np.abs(reference.band_pressure)) > 0.0
+  assert np.allclose(sim.band_pressure, reference.band_pressure, equal_nan=True)
+  assert np.allclose(sim.band_analysis, reference.band_analysis, equal_nan=True)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+from lib.simulation_backend import BACKENDS
+
+FREQUENCIES = [63.0, 125.0, 250.0]
+STEPS = 40
+
+
+def create_parameters() -> SimulationParameters:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  return parameters
+
+
+def run_single_band(frequency: float, backend: str) -> Simulation:
+  parameters = create_parameters()
+  parameters.set_signal_frequency(frequency)
+  grid = create_scene("bedroom", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters, backend=backend)
+  sim.generator = SimpleSinoidGenerator(frequency)
+  sim.sync_read_buffers()
+  sim.reset()
+  sim.step(STEPS)
+  return sim
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_bands_match_single_band_runs(backend):
+  parameters = create_parameters()
+  scene = create_scene("bedroom", parameters)
+  grid = scene.build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters,
+                   band_count=len(FREQUENCIES), backend=backend)
+  # every band gets the betas of its frequency, like a sweep
+  for band, frequency in enumerate(FREQUENCIES):
+    parameters.set_signal_frequency(frequency)
+    scene.rebuild()
+    sim.set_band(band, SimpleSinoidGenerator(frequency))
+  sim.sync_read_buffers()
+  sim.reset()
+  sim.step(STEPS)
+
+  for band, frequency in enumerate(FREQUENCIES):
+    reference = run_single_band(frequency, backend)
+    np.testing.assert_array_equal(
+        sim.band_pressure[band], reference.band_pressure[0])
+    np.testing.assert_array_equal(
+        sim.band_analysis[band], reference.band_analysis[0])
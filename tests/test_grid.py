@@ -0,0 +1,81 @@
+import itertools
+
+import numpy as np
+
+from lib.grid import WALL_FLAG, SimulationGrid
+from lib.parameters import SimulationParameters
+
+WALL_BETA = 0.8
+# (width_min, width_max, height_min, height_max, depth_min, depth_max)
+EDGE_BETAS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6)
+
+
+def create_grid(parameters: SimulationParameters) -> SimulationGrid:
+  """7 cells in every direction with a single wall cell at (4, 3, 3)"""
+  dx = parameters.dx
+  grid = SimulationGrid((7 * dx, 7 * dx, 7 * dx), parameters)
+  edges = grid.edge_betas
+  (edges.width_min, edges.width_max, edges.height_min,
+   edges.height_max, edges.depth_min, edges.depth_max) = EDGE_BETAS
+  grid.fill_region(4 * dx, 5 * dx, 3 * dx, 4 * dx, 3 * dx, 4 * dx, beta=WALL_BETA)
+  grid.build()
+  return grid
+
+
+def get_expected_betas(grid: SimulationGrid) -> np.ndarray:
+  """Weighted average of the edge and wall betas around every air cell, by the stencil weight of the neighbour"""
+  params = grid.parameters
+  weights = (abs(params.arg_d1), abs(params.arg_d2), abs(params.arg_d3))
+  shape = grid.grid_shape
+  is_wall = grid.geometry & WALL_FLAG > 0
+  expected = np.zeros(shape=shape)
+  expected[is_wall] = WALL_BETA
+  for w, h, d in itertools.product(*map(range, shape)):
+    if is_wall[w, h, d]:
+      continue
+    total = count = 0.0
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+      weight = weights[sum(map(abs, offset)) - 1] if any(offset) else 0.0
+      if weight == 0.0:
+        continue
+      position = (w + offset[0], h + offset[1], d + offset[2])
+      # the grid edges are checked first, width before height before depth
+      edge = next((EDGE_BETAS[2 * axis + (position[axis] > 0)] for axis in range(3)
+                   if position[axis] <= 0 or position[axis] >= shape[axis] - 1), None)
+      if edge is not None:
+        total, count = total + edge * weight, count + weight
+      elif is_wall[position]:
+        total, count = total + WALL_BETA * weight, count + weight
+    if count > 0.0:
+      expected[w, h, d] = total / count
+  return expected
+
+
+def test_inner_betas_of_the_axis_scheme():
+  grid = create_grid(SimulationParameters())
+
+  # next to the wall, next to the lower width edge, and without walls or edges around
+  assert grid.beta[3, 3, 3] == np.float64(WALL_BETA)
+  assert grid.beta[1, 3, 3] == np.float64(EDGE_BETAS[0])
+  assert grid.beta[2, 3, 3] == 0.0
+  # a corner averages the three lower edges
+  assert np.isclose(grid.beta[1, 1, 1], np.mean(EDGE_BETAS[0::2]))
+  assert np.allclose(grid.beta, get_expected_betas(grid))
+
+
+def test_inner_betas_of_a_scheme_with_diagonals():
+  parameters = SimulationParameters()
+  parameters.set_free_parameters(0.1, 0.02)
+  grid = create_grid(parameters)
+
+  assert np.allclose(grid.beta, get_expected_betas(grid))
+
+
+def test_inner_betas_leave_walls_alone():
+  grid = create_grid(SimulationParameters())
+  is_wall = grid.geometry & WALL_FLAG > 0
+
+  assert is_wall.sum() == 1
+  assert np.all(grid.beta[is_wall] == np.float64(WALL_BETA))
+  grid.populate_inner_beta()
+  assert np.all(grid.beta[is_wall] == np.float64(WALL_BETA))
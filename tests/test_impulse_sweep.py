@@ -0,0 +1,42 @@
+import numpy as np
+
+from lib.analysis.impulse_sweep import compare_with_sinusoid_sweep
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+
+FREQUENCIES = np.array([40.0, 80.0, 160.0])
+SIMULATED_TIME = 0.03
+# in dB, the difference is only floating point rounding
+TOLERANCE = 1e-9
+
+
+def create_parameters() -> SimulationParameters:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  return parameters
+
+
+def test_impulse_sweep_matches_the_sinusoid_sweep():
+  parameters = create_parameters()
+  grid = create_scene("shoebox", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters)
+  sim.sync_read_buffers()
+
+  step_count = int(SIMULATED_TIME / parameters.dt)
+  assert compare_with_sinusoid_sweep(sim, FREQUENCIES, step_count) < TOLERANCE
+
+
+def test_frequency_dependent_betas_are_found():
+  shoebox = create_scene("shoebox", create_parameters())
+  shoebox.build()
+  bedroom = create_scene("bedroom", create_parameters())
+  bedroom.build()
+  beta = bedroom.grid.beta.copy()
+
+  assert not shoebox.has_frequency_dependent_betas(FREQUENCIES)
+  assert bedroom.has_frequency_dependent_betas(FREQUENCIES)
+  # the grid keeps the betas it was build with
+  np.testing.assert_array_equal(bedroom.grid.beta, beta)
+  assert bedroom.parameters.signal_frequency == create_parameters().signal_frequency
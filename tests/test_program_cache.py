@@ -0,0 +1,62 @@
+import os
+
+import numpy as np
+import pyopencl as cl
+
+from lib.gpu import program_cache
+
+SOURCE = """
+__kernel void double_values(__global float *values) {
+  size_t i = get_global_id(0);
+  values[i] = 2.0f * values[i];
+}
+"""
+
+
+class FakeDevice:
+  def __init__(self, int_ptr: int) -> None:
+    self.int_ptr = int_ptr
+
+
+class FakeProgram:
+  """Program of two devices with different binaries"""
+
+  def get_info(self, info):
+    if info == cl.program_info.BINARIES:
+      return [b"first", b"second"]
+    return [FakeDevice(1), FakeDevice(2)]
+
+
+def run_double_values(ctx: cl.Context, program: cl.Program) -> np.ndarray:
+  queue = cl.CommandQueue(ctx)
+  values = np.arange(4, dtype="float32")
+  buffer = cl.Buffer(ctx, cl.mem_flags.READ_WRITE | cl.mem_flags.COPY_HOST_PTR, hostbuf=values)
+  program.double_values(queue, values.shape, None, buffer)
+  cl.enqueue_copy(queue, values, buffer, is_blocking=True)
+  return values
+
+
+def test_every_device_gets_its_own_binary(tmp_path):
+  paths = {1: str(tmp_path / "first.bin"), 2: str(tmp_path / "second.bin")}
+  program_cache.store_binary_program(FakeProgram(), paths)
+
+  with open(paths[1], "rb") as file:
+    assert file.read() == b"first"
+  with open(paths[2], "rb") as file:
+    assert file.read() == b"second"
+
+
+def test_binaries_are_stored_and_loaded_per_device(tmp_path, monkeypatch):
+  monkeypatch.setenv("FDTD_KERNEL_CACHE", str(tmp_path))
+  monkeypatch.setattr(program_cache, "PROGRAM_CACHE", {})
+  ctx = program_cache.get_default_context()
+  program_cache.build_program(ctx, SOURCE, [])
+
+  paths = [os.path.join(str(tmp_path), f'{program_cache.get_program_key(SOURCE, [], device)}.bin')
+           for device in ctx.devices]
+  assert all(os.path.exists(path) for path in paths)
+
+  program = program_cache.load_binary_program(ctx, paths, [])
+  assert program is not None
+  np.testing.assert_array_equal(run_double_values(ctx, program), [0.0, 2.0, 4.0, 6.0])
+  assert program_cache.load_binary_program(ctx, paths[:-1] + [str(tmp_path / "missing.bin")], []) is None
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+from lib.simulation_backend import READBACK_FULL, READBACK_LISTENERS, READBACK_NONE, READBACK_REGION
+
+BANDS = 2
+STEPS = 30
+# a value the simulation never writes, to find untouched host values
+UNTOUCHED = 7.0
+
+
+def run_simulation(readback: str, slab_count: int, region=None) -> Simulation:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  grid = create_scene("bedroom", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters,
+                   band_count=BANDS, slab_count=slab_count)
+  for band in range(BANDS):
+    sim.set_band(band, SimpleSinoidGenerator(80.0 + 40.0 * band))
+  sim.sync_read_buffers()
+  sim.reset()
+  sim.set_readback(readback, region)
+  for values in (sim.band_pressure, sim.band_analysis, sim.listener_pressure, sim.listener_analysis):
+    values.fill(UNTOUCHED)
+  sim.step(STEPS)
+  return sim
+
+
+@pytest.fixture(scope="module")
+def reference() -> Simulation:
+  return run_simulation(READBACK_FULL, 1)
+
+
+@pytest.mark.parametrize("slab_count", [1, 2])
+def test_listener_readback(reference, slab_count):
+  sim = run_simulation(READBACK_LISTENERS, slab_count)
+  indices = reference.grid.listener_indices
+
+  assert indices.size > 0
+  np.testing.assert_array_equal(
+      sim.listener_pressure, reference.band_pressure.reshape(BANDS, -1)[:, indices])
+  np.testing.assert_array_equal(
+      sim.listener_analysis, reference.band_analysis.reshape(BANDS, reference.grid.analysis_values, -1)[:, :, indices])
+  assert np.all(sim.band_pressure == UNTOUCHED)
+  assert np.all(sim.band_analysis == UNTOUCHED)
+
+
+@pytest.mark.parametrize("slab_count", [1, 2])
+def test_region_readback(reference, slab_count):
+  (width, height, depth) = reference.grid.grid_shape
+  region = ((1, width - 2), (2, height), (3, depth - 1))
+  sim = run_simulation(READBACK_REGION, slab_count, region)
+  cells = tuple(slice(low, high) for low, high in region)
+
+  np.testing.assert_array_equal(
+      sim.band_pressure[(slice(None), *cells)], reference.band_pressure[(slice(None), *cells)])
+  np.testing.assert_array_equal(
+      sim.band_analysis[(slice(None), slice(None), *cells)], reference.band_analysis[(slice(None), slice(None), *cells)])
+
+  # everything outside the region keeps its value
+  is_outside = np.ones(shape=reference.grid.grid_shape, dtype="bool")
+  is_outside[cells] = False
+  assert np.all(sim.band_pressure[:, is_outside] == UNTOUCHED)
+  assert np.all(sim.band_analysis[:, :, is_outside] == UNTOUCHED)
+
+
+@pytest.mark.parametrize("slab_count", [1, 2])
+def test_no_readback(reference, slab_count):
+  sim = run_simulation(READBACK_NONE, slab_count)
+
+  for values in (sim.band_pressure, sim.band_analysis, sim.listener_pressure, sim.listener_analysis):
+    assert np.all(values == UNTOUCHED)
+  # the values stay on the device
+  assert np.allclose(sim.get_listener_statistics(),
+                     reference.get_listener_statistics())
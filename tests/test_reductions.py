@@ -0,0 +1,70 @@
+import numpy as np
+
+from lib.grid import WALL_FLAG
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+from lib.simulation_backend import SimulationBackend
+
+BANDS = 3
+STEPS = 40
+
+
+def create_simulation() -> Simulation:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  grid = create_scene("bedroom", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters, band_count=BANDS)
+  sim.sync_read_buffers()
+  return sim
+
+
+def run_bands(sim: Simulation, frequencies) -> None:
+  for band, frequency in enumerate(frequencies):
+    sim.set_band(band, SimpleSinoidGenerator(frequency))
+  sim.reset()
+  sim.step(STEPS)
+
+
+def test_listener_reduction_matches_the_host():
+  sim = create_simulation()
+  run_bands(sim, [60.0, 90.0, 120.0])
+  # the host reduction of the base class works on the band arrays of the full readback
+  host = SimulationBackend(sim)
+
+  for metric, index in sim.grid.analysis_keys.items():
+    np.testing.assert_allclose(sim.backend.reduce_listeners(index), host.reduce_listeners(index),
+                               rtol=1e-12, err_msg=metric)
+
+
+def test_band_statistics_match_the_host():
+  sim = create_simulation()
+  host = SimulationBackend(sim)
+  host.reset_band_statistics()
+  sim.reset_band_statistics()
+  metric = sim.grid.analysis_keys["LEQ"]
+
+  # two batches, the second only uses two of its bands, like the last batch of a sweep
+  leq_values = []
+  count = 0
+  for frequencies, band_count in (([60.0, 90.0, 120.0], 3), ([150.0, 180.0, 210.0], 2)):
+    run_bands(sim, frequencies)
+    sim.accumulate_band_statistics("LEQ", band_count)
+    host.accumulate_band_statistics(metric, band_count, count)
+    count += band_count
+    leq_values.extend(sim.band_analysis[:band_count, metric].copy())
+
+  mean, variance = sim.get_band_statistics()
+  host_mean, host_m2 = host.read_band_statistics()
+  is_air = sim.grid.geometry & WALL_FLAG == 0
+  np.testing.assert_allclose(mean[is_air], host_mean[is_air], rtol=1e-12)
+  np.testing.assert_allclose(
+      variance[is_air], host_m2[is_air] / count, rtol=1e-9, atol=1e-12)
+  # and the plain mean and variance over the bands
+  leq_values = np.array(leq_values)
+  np.testing.assert_allclose(
+      mean[is_air], np.mean(leq_values, axis=0)[is_air], rtol=1e-12)
+  np.testing.assert_allclose(
+      variance[is_air], np.var(leq_values, axis=0)[is_air], rtol=1e-9, atol=1e-12)
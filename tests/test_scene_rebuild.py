@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+from lib.simulation_backend import BACKEND_NUMBA, BACKEND_OPENCL
+
+FIRST_FREQUENCY = 125.0
+SECOND_FREQUENCY = 500.0
+STEPS = 40
+
+
+def create_parameters(frequency: float) -> SimulationParameters:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  parameters.set_signal_frequency(frequency)
+  return parameters
+
+
+def create_simulation(scene, parameters: SimulationParameters, backend: str, slab_count: int) -> Simulation:
+  grid = scene.grid
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters,
+                   backend=backend, slab_count=slab_count)
+  sim.generator = SimpleSinoidGenerator(parameters.signal_frequency)
+  sim.sync_read_buffers()
+  sim.reset()
+  return sim
+
+
+@pytest.mark.parametrize("backend, slab_count", [(BACKEND_OPENCL, 1), (BACKEND_NUMBA, 1), (BACKEND_OPENCL, 2)])
+def test_rebuild_matches_a_full_build(backend, slab_count):
+  parameters = create_parameters(FIRST_FREQUENCY)
+  scene = create_scene("bedroom", parameters)
+  scene.build()
+  first_beta = scene.grid.beta.copy()
+  sim = create_simulation(scene, parameters, backend, slab_count)
+  sim.step(STEPS)
+
+  # like a sweep: rebuild at the next frequency and upload only the changed betas
+  parameters.set_signal_frequency(SECOND_FREQUENCY)
+  scene.rebuild()
+  sim.set_band(0, SimpleSinoidGenerator(parameters.signal_frequency))
+  sim.reset()
+  sim.sync_read_buffers()
+  sim.step(STEPS)
+
+  reference_parameters = create_parameters(SECOND_FREQUENCY)
+  reference_scene = create_scene("bedroom", reference_parameters)
+  reference_scene.build()
+  reference = create_simulation(
+      reference_scene, reference_parameters, backend, slab_count)
+  reference.step(STEPS)
+
+  grid = scene.grid
+  reference_grid = reference_scene.grid
+  assert not np.array_equal(first_beta, reference_grid.beta)
+  # walls without air next to them are never read, rebuild leaves their beta alone
+  is_read = ~grid.wall_mask
+  is_read.reshape(-1)[grid.surface_cells] = True
+  np.testing.assert_array_equal(
+      grid.beta[is_read], reference_grid.beta[is_read])
+  np.testing.assert_array_equal(grid.beta_cells, reference_grid.beta_cells)
+  np.testing.assert_array_equal(
+      grid.surface_cells, reference_grid.surface_cells)
+  np.testing.assert_array_equal(sim.band_pressure, reference.band_pressure)
+  np.testing.assert_array_equal(sim.band_analysis, reference.band_analysis)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+
+
+def create_simulation() -> Simulation:
+  parameters = SimulationParameters()
+  parameters.set_oversampling(5)
+  grid = create_scene("bedroom", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters)
+  sim.generator = SimpleSinoidGenerator(80.0)
+  sim.sync_read_buffers()
+  sim.reset()
+  return sim
+
+
+def test_save_state_after_step_async_raises(tmp_path):
+  sim = create_simulation()
+  sim.step(20)
+  sim.step_async(20).wait()
+  with pytest.raises(ValueError):
+    sim.save_state(str(tmp_path))
+
+
+def test_save_state_after_step_async_and_step(tmp_path):
+  reference = create_simulation()
+  reference.step(20)
+  reference.step(20)
+  reference.step(40)
+
+  sim = create_simulation()
+  sim.step(20)
+  sim.step_async(20).wait()
+  # a synchronous step reads the analysis values back again
+  sim.step(1)
+  sim.save_state(str(tmp_path))
+
+  resumed = create_simulation()
+  resumed.load_state(str(tmp_path))
+  resumed.step(39)
+  np.testing.assert_array_equal(resumed.band_analysis, reference.band_analysis)
+  np.testing.assert_array_equal(resumed.band_pressure, reference.band_pressure)
@@ -0,0 +1,29 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from lib.analysis.source_pairs import iterate_n_pairs_with_min_distance
+
+SPACING = 0.5
+MIN_SPACE = 1.2
+
+
+def get_reference_pairs(locations: np.ndarray, n_count: int) -> list:
+  """All combinations checked pair by pair"""
+  min_distance_squared = (MIN_SPACE / SPACING) ** 2
+  return [list(combination) for combination in itertools.combinations(locations.tolist(), n_count)
+          if all(np.sum((np.array(a) - np.array(b)) ** 2) >= min_distance_squared
+                 for a, b in itertools.combinations(combination, 2))]
+
+
+@pytest.mark.parametrize("n_count", [1, 2, 3])
+@pytest.mark.parametrize("stride", [1, 3])
+def test_pairs_match_itertools_combinations(n_count, stride):
+  rng = np.random.default_rng(4)
+  locations = rng.integers(0, 8, size=(40, 3))
+  pairs = [pair.tolist() for pair in iterate_n_pairs_with_min_distance(
+      locations, n_count, SPACING, MIN_SPACE, stride)]
+
+  assert len(pairs) > 0
+  assert pairs == get_reference_pairs(locations, n_count)[::stride]
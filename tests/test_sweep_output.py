@@ -0,0 +1,22 @@
+import warnings
+
+from lib.analysis.sweep_output import read_sweep_csv
+
+HEADER = "Time,Index,W0 idx,w0 (m),H0 idx,h0 (m),D0 idx,d0 (m),Deviation,SPL (avg dB),Bands (SPL dB):,50.00,100.00\n"
+
+
+def test_read_sweep_csv_skips_a_truncated_row(tmp_path):
+  path = tmp_path / "sweep.csv"
+  path.write_text(HEADER
+                  + "1.5,0,1,0.1,2,0.2,3,0.3,0.5,80.0,,79.0,81.0\n"
+                  + "1.5,4,5,0.5,6,0.6,7,0.7,0.25,82.0,,81.5,82.5\n"
+                  + "1.5,8,9,0.9,1", encoding="utf-8")
+  with warnings.catch_warnings():
+    warnings.simplefilter("error")
+    output = read_sweep_csv(str(path))
+
+  assert output.indices.tolist() == [0, 4]
+  assert output.positions.tolist() == [[[1, 2, 3]], [[5, 6, 7]]]
+  assert output.deviations.tolist() == [0.5, 0.25]
+  assert output.spl.tolist() == [[79.0, 81.0], [81.5, 82.5]]
+  assert output.frequencies.tolist() == [50.0, 100.0]
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from lib.impulse_generators import SimpleSinoidGenerator
+from lib.parameters import SimulationParameters
+from lib.scene.scenes import create_scene
+from lib.simulation import Simulation
+
+BANDS = 2
+
+
+def run_simulation(time_block: int, step_counts) -> Simulation:
+  parameters = SimulationParameters()
+  # 28 cells per axis, so the grid is split into several tiles
+  parameters.set_oversampling(8)
+  grid = create_scene("lshape", parameters).build()
+  grid.select_source_locations(grid.source_set[:1])
+  sim = Simulation(grid=grid, parameters=parameters,
+                   band_count=BANDS, time_block=time_block)
+  for band in range(BANDS):
+    sim.set_band(band, SimpleSinoidGenerator(60.0 + 40.0 * band))
+  sim.sync_read_buffers()
+  sim.reset()
+  for step_count in step_counts:
+    sim.step(step_count)
+  return sim
+
+
+@pytest.mark.parametrize("time_block", [2, 3])
+def test_time_block_matches_single_iterations(time_block):
+  # 7 is not a multiple of the block, the rest runs as single iterations
+  step_counts = [7, 7, 12]
+  reference = run_simulation(1, step_counts)
+  sim = run_simulation(time_block, step_counts)
+
+  assert sim.backend.program.tile_size < max(sim.grid.grid_shape)
+  # the wave has crossed the tile edges by now
+  assert np.count_nonzero(np.nan_to_num(reference.band_pressure)) > reference.band_pressure.size // 4
+  np.testing.assert_array_equal(sim.band_pressure, reference.band_pressure)
+  np.testing.assert_array_equal(sim.band_analysis, reference.band_analysis)
@@ -57,7 +57,8 @@ SLICE_HEIGHT = grid.scale(scene.height / 2)
 # SLICE_HEIGHT = grid.scale(0.15)
 
 
-sim = Simulation(grid=grid, parameters=parameters)
+sim = Simulation(grid=grid, parameters=parameters,
+                 metrics=["LEQ", "EWMA_L"])
 sim.print_statistics()
 
 sim.generator = GaussianMonopulseGenerator(parameters.signal_frequency)
@@ -124,14 +125,23 @@ last_sim_maximum = 1e-32
 
 fig.tight_layout()
 
+# the next step runs on the device while the previous one is drawn
+pending_step = None
+
 
 def animate(i) -> None:
-  global last_sim_maximum, last_an_maximum
+  global last_sim_maximum, last_an_maximum, pending_step
   # if sim.time > 0.01:
   #   return
-  sim.step(ITERATIONS_PER_STEP)
+  if pending_step is None:
+    pending_step = sim.step_async(ITERATIONS_PER_STEP)
+  step = pending_step
+  pending_step = sim.step_async(ITERATIONS_PER_STEP)
+  band_pressure, band_analysis = step.wait()
+  pressure = band_pressure[0]
+  analysis = band_analysis[0]
 
-  x_data.append(sim.time)
+  x_data.append(step.time)
 
   sample_size = 1024
   dt_per_iteration = parameters.dt*ITERATIONS_PER_STEP
@@ -146,7 +156,7 @@ def animate(i) -> None:
   fft_src_plot.set_data(calc_sig_axis[:subset1], db_fft_sig)
 
   source_data.append(
-      grid.pressure[grid.width_parts // 2, SLICE_HEIGHT, grid.depth_parts // 2])
+      pressure[grid.width_parts // 2, SLICE_HEIGHT, grid.depth_parts // 2])
 
   if ITERATIONS_PER_STEP == 1:
     calc_rec = np.fft.rfft(source_data, n=sample_size)
@@ -155,11 +165,11 @@ def animate(i) -> None:
     db_fft_rec = 20 * np.log10(50000 * calc_rec_abs[:subset2])
     fft_rec_plot.set_data(calc_rec_axis[:subset2], db_fft_rec)
 
-  leq_slice = grid.analysis[:, :, :, analysis_key_index]
-  l_ewma_slice = grid.analysis[:, :, :, sim.grid.analysis_keys["EWMA_L"]]
+  leq_slice = analysis[analysis_key_index]
+  l_ewma_slice = analysis[sim.grid.analysis_keys["EWMA_L"]]
   ref_slice_analysis_leq = leq_slice[:, SLICE_HEIGHT, :]
   ref_slice_analysis_ewma = l_ewma_slice[:, SLICE_HEIGHT, :]
-  ref_slice_pressure = grid.pressure[:, SLICE_HEIGHT, :]
+  ref_slice_pressure = pressure[:, SLICE_HEIGHT, :]
 
   leq_max = np.nanmax(leq_slice)
   leq_min = np.nanmin(leq_slice)
@@ -195,7 +205,7 @@ def animate(i) -> None:
     ax.autoscale_view()
 
   fig.canvas.flush_events()
-  print(i, sim.time, sim_maximum, an_maximum)
+  print(i, step.time, sim_maximum, an_maximum)
 
 
 ani = FuncAnimation(plt.gcf(), animate, interval=1000/60)